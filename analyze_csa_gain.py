@@ -0,0 +1,96 @@
+'''
+This script analyzes the datalog(s) of a ``noise_tests.test_csa_gain`` run. The test
+pulses are found from the test pulse DAC writes in the datalog and the mean adc of each
+channel is fit vs the pulse size (DAC counts) with a weighted least squares fit. The
+results are added to a calibration file (.json or .npz, see run_calibration.py) as:
+
+    gain_adc_per_dac | gain_adc_offset | gain_fit_residual | gain_mv_per_dac (if --vref
+    and --vcm are given) | gain_e (e/mV, if --electrons_per_dac is also given)
+
+'''
+
+from __future__ import print_function
+import argparse
+import os
+import time
+import numpy as np
+from os.path import splitext
+from sys import exit
+import helpers.calibration as calibration
+import helpers.testpulse_analysis as testpulse_analysis
+from helpers.calibration_store import CalibrationStore
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-i', '--infile', nargs='+', required=True,
+                    help='datalog files of test_csa_gain runs')
+parser.add_argument('-o', '--outfile', default=None,
+                    help='calibration file to update (default: <first infile>_calib.json)')
+parser.add_argument('-f', '--force', action='store_true')
+parser.add_argument('--vref', type=float, default=None)
+parser.add_argument('--vcm', type=float, default=None)
+parser.add_argument('--electrons_per_dac', type=float, default=None,
+                    help='injected charge per test pulse DAC count (e)')
+parser.add_argument('--min_hits', default=1, type=int,
+                    help='minimum number of hits per pulse size (default: %(default)s)')
+parser.add_argument('--max_adc', default=250., type=float,
+                    help='exclude pulse sizes with a larger mean adc (default: %(default)s)')
+parser.add_argument('--cache', action='store_true',
+                    help='read decoded packets from the packet cache of each infile')
+parser.add_argument('-v', '--verbose', action='store_true')
+args = parser.parse_args()
+
+outfile = args.outfile
+if outfile is None:
+    outfile = splitext(args.infile[0])[0] + '_calib.json'
+if os.path.isfile(outfile) and not args.force:
+    print('Calibration file already exists! Use -f to update.')
+    exit(1)
+
+accumulator = None
+for infile in args.infile:
+    if args.verbose:
+        print('Extracting data from %s' % infile)
+    file_accumulator = testpulse_analysis.CsaGainAccumulator()
+    calibration.extract_calibration_data(infile, [file_accumulator], verbose=args.verbose,
+                                         use_cache=args.cache)
+    file_accumulator.finish()
+    if accumulator is None:
+        accumulator = file_accumulator
+    else:
+        accumulator.merge(file_accumulator)
+
+gain = testpulse_analysis.csa_gain_fit(accumulator, min_hits=args.min_hits,
+                                       max_adc=args.max_adc)
+valid = np.isfinite(gain['slope'])
+if args.verbose:
+    print('%d pulses of %d sizes' % (accumulator.n_pulses, len(accumulator.stats)))
+    print('gain fit for %d channels' % np.count_nonzero(valid))
+    for chipid in np.unique(np.nonzero(valid)[0]):
+        slopes = gain['slope'][chipid][valid[chipid]]
+        print('c%d: %d channels, %.3f +/- %.3f adc/DAC' % (chipid, len(slopes),
+                                                           np.mean(slopes),
+                                                           np.std(slopes)))
+
+cal_store = CalibrationStore(metadata={
+        'script': 'analyze_csa_gain.py',
+        'created': time.time(),
+        'infiles': [os.path.abspath(infile) for infile in args.infile]
+        })
+cal_store.set_field('gain_adc_per_dac', gain['slope'], valid)
+cal_store.set_field('gain_adc_offset', gain['offset'], valid)
+cal_store.set_field('gain_fit_residual', gain['residual'], valid)
+if not args.vref is None and not args.vcm is None:
+    mv_per_adc = 1e3 * abs(calibration.adc_to_v(1, args.vref, args.vcm) -
+                           calibration.adc_to_v(0, args.vref, args.vcm))
+    gain_mv_per_dac = gain['slope'] * mv_per_adc
+    cal_store.set_field('gain_mv_per_dac', gain_mv_per_dac, valid)
+    if not args.electrons_per_dac is None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gain_e = args.electrons_per_dac / gain_mv_per_dac
+        cal_store.set_field('gain_e', gain_e, valid & np.isfinite(gain_e))
+
+if os.path.isfile(outfile):
+    cal_store = CalibrationStore.load(outfile).update(cal_store)
+cal_store.save(outfile)
+if args.verbose:
+    print('gain calibration saved to %s' % outfile)
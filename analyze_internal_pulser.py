@@ -0,0 +1,76 @@
+'''
+This script analyzes the datalog(s) of ``noise_tests.noise_test_internal_pulser`` runs
+(e.g. from check_pedestal_width_internal_pulser.py), where one channel per chip is
+pulsed and the other channels are read out through the cross-trigger. The pulse sequence
+is reconstructed from the test pulse DAC writes, so any number of chips and runs can be
+analyzed at once and re-analyzed with different cuts. The results are saved to a .npz
+file with the arrays:
+
+    n | adc_mean | adc_rms | missed_triggers | extra_triggers (indexed [chipid,
+    channelid]) | n_pulses | pulses_missed | pulses_extra (indexed [chipid]) |
+    chipids | adc_bins | adc_counts (indexed [chip, channelid, adc bin] for ``chipids``)
+
+where the adc mean and rms are the pedestal from cross-triggered hits within
+[--adc_min, --adc_max] and ``adc_counts`` are the full cross-trigger adc distributions.
+
+'''
+
+from __future__ import print_function
+import argparse
+import numpy as np
+from os.path import splitext
+import helpers.calibration as calibration
+import helpers.testpulse_analysis as testpulse_analysis
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-i', '--infile', nargs='+', required=True,
+                    help='datalog files of noise_test_internal_pulser runs')
+parser.add_argument('-o', '--outfile', default=None,
+                    help='output .npz file (default: <first infile>_xtrig.npz)')
+parser.add_argument('--adc_min', default=None, type=int,
+                    help='minimum adc included in the pedestal (optional)')
+parser.add_argument('--adc_max', default=None, type=int,
+                    help='maximum adc included in the pedestal (optional)')
+parser.add_argument('--min_hits', default=1, type=int,
+                    help='minimum number of hits per channel (default: %(default)s)')
+parser.add_argument('--cache', action='store_true',
+                    help='read decoded packets from the packet cache of each infile')
+parser.add_argument('-v', '--verbose', action='store_true')
+args = parser.parse_args()
+
+outfile = args.outfile
+if outfile is None:
+    outfile = splitext(args.infile[0])[0] + '_xtrig.npz'
+
+accumulator = None
+for infile in args.infile:
+    if args.verbose:
+        print('Extracting data from %s' % infile)
+    file_accumulator = testpulse_analysis.CrossTriggerAccumulator()
+    calibration.extract_calibration_data(infile, [file_accumulator], verbose=args.verbose,
+                                         use_cache=args.cache)
+    file_accumulator.finish()
+    if accumulator is None:
+        accumulator = file_accumulator
+    else:
+        accumulator.merge(file_accumulator)
+
+noise = testpulse_analysis.cross_trigger_noise(accumulator, adc_min=args.adc_min,
+                                               adc_max=args.adc_max,
+                                               min_hits=args.min_hits)
+chipids = np.flatnonzero(noise['n_pulses'])
+np.savez(outfile, chipids=chipids, adc_bins=accumulator.adc_hist.bins,
+         adc_counts=accumulator.adc_hist.counts[chipids], **noise)
+
+for chipid in chipids:
+    print('c%d: pulses: %d, pulses with # trigs > # channels: %d, missed trigs: %d' % (
+            chipid, noise['n_pulses'][chipid], noise['pulses_extra'][chipid],
+            noise['pulses_missed'][chipid]))
+    if args.verbose:
+        for channelid in np.flatnonzero(np.isfinite(noise['adc_mean'][chipid])):
+            print('c%d-ch%d adc mean: %.2f, adc rms: %.2f, missed: %d, extra: %d' % (
+                    chipid, channelid, noise['adc_mean'][chipid, channelid],
+                    noise['adc_rms'][chipid, channelid],
+                    noise['missed_triggers'][chipid, channelid],
+                    noise['extra_triggers'][chipid, channelid]))
+print('cross-trigger results saved to %s' % outfile)
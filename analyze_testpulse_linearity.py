@@ -0,0 +1,73 @@
+'''
+This script analyzes the datalog(s) of a ``noise_tests.test_testpulse_linearity`` run,
+where pulses of a fixed size are issued from a range of test pulse DAC start values. The
+mean and rms adc of each channel are collected per DAC start value in one pass and
+DAC start values where the response of a chip deviates from its median response by more
+than --max_deviation adc are flagged as non-linear. The results are saved to a .npz file
+with the arrays:
+
+    dac_start | n | mean | rms | deviation (indexed [dac start, chipid, channelid]) |
+    chip_deviation | nonlinear (indexed [dac start, chipid]) | slope | offset |
+    residual (indexed [chipid, channelid]) | dac_min | dac_max (indexed [chipid])
+
+where ``dac_min`` and ``dac_max`` give the longest linear DAC range of each chip, to be
+used as ``testpulse_dac_min`` and ``testpulse_dac_max`` of other scans.
+
+'''
+
+from __future__ import print_function
+import argparse
+import numpy as np
+from os.path import splitext
+import helpers.calibration as calibration
+import helpers.testpulse_analysis as testpulse_analysis
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-i', '--infile', nargs='+', required=True,
+                    help='datalog files of test_testpulse_linearity runs')
+parser.add_argument('-o', '--outfile', default=None,
+                    help='output .npz file (default: <first infile>_linearity.npz)')
+parser.add_argument('--min_hits', default=1, type=int,
+                    help='minimum number of hits per DAC start value (default: '
+                    '%(default)s)')
+parser.add_argument('--max_deviation', default=2., type=float,
+                    help='maximum deviation of the response of a chip from its median '
+                    '(adc) (default: %(default)s)')
+parser.add_argument('--cache', action='store_true',
+                    help='read decoded packets from the packet cache of each infile')
+parser.add_argument('-v', '--verbose', action='store_true')
+args = parser.parse_args()
+
+outfile = args.outfile
+if outfile is None:
+    outfile = splitext(args.infile[0])[0] + '_linearity.npz'
+
+accumulator = None
+for infile in args.infile:
+    if args.verbose:
+        print('Extracting data from %s' % infile)
+    file_accumulator = testpulse_analysis.TestpulseLinearityAccumulator()
+    calibration.extract_calibration_data(infile, [file_accumulator], verbose=args.verbose,
+                                         use_cache=args.cache)
+    file_accumulator.finish()
+    if accumulator is None:
+        accumulator = file_accumulator
+    else:
+        accumulator.merge(file_accumulator)
+
+linearity = testpulse_analysis.testpulse_linearity(accumulator, min_hits=args.min_hits,
+                                                   max_deviation=args.max_deviation)
+dac_start, n, mean, rms = accumulator.response()
+np.savez(outfile, n=n, mean=mean, rms=rms, **linearity)
+
+print('%d pulses from %d DAC start values, pulse size(s): %s' % (
+        accumulator.n_pulses, len(dac_start),
+        ', '.join(str(pulse_dac) for pulse_dac in sorted(accumulator.pulse_dacs))))
+for chipid in np.nonzero(linearity['dac_max'] >= 0)[0]:
+    nonlinear_starts = dac_start[linearity['nonlinear'][:,chipid]]
+    print('c%d: linear DAC range %d - %d' % (chipid, linearity['dac_min'][chipid],
+                                             linearity['dac_max'][chipid]))
+    if args.verbose and len(nonlinear_starts):
+        print('  non-linear DAC start values: %s' % ', '.join(
+                str(dac) for dac in nonlinear_starts))
+print('linearity results saved to %s' % outfile)
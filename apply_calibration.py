@@ -0,0 +1,69 @@
+'''
+This script fills the calibration columns of an already converted (dat2h5.py) h5 file
+from a calibration .json or .npz file (see run_calibration.py) without reconverting the
+.dat file. By default the converted voltage and calib pedestal voltage columns of the data
+table are updated in place (stored as integer mV, as in dat2h5.py). With --float the
+values are instead stored in separate float64 datasets ``v`` and ``pdst_v`` (mV).
+
+'''
+
+from __future__ import print_function
+import argparse
+import numpy as np
+import h5py
+import helpers.calibration as calibration
+from helpers.calibration_store import CalibrationStore
+
+channelid_col = 0
+chipid_col = 1
+raw_adc_col = 5
+v_col = 10
+pdst_v_col = 11
+
+parser = argparse.ArgumentParser()
+parser.add_argument('infile', help='converted h5 file to update')
+parser.add_argument('calibration', help='calibration .json or .npz file')
+parser.add_argument('--float', action='store_true',
+                    help='store values in new float datasets v and pdst_v instead of '
+                    'the data table')
+parser.add_argument('--chunk_size', default=1000000, type=int,
+                    help='number of rows processed at a time (default: %(default)s)')
+parser.add_argument('-v', '--verbose', action='store_true')
+args = parser.parse_args()
+
+cal_arrays = CalibrationStore.load(args.calibration).arrays(['gain_v', 'gain_vcm',
+                                                              'pedestal_v'])
+
+with h5py.File(args.infile, 'r+') as fo:
+    dset = fo['data']
+    n_rows = dset.shape[0]
+    if args.float:
+        for name in ['v', 'pdst_v']:
+            if name in fo:
+                del fo[name]
+        v_dset = fo.create_dataset('v', shape=(n_rows,), dtype=np.float64)
+        pdst_v_dset = fo.create_dataset('pdst_v', shape=(n_rows,), dtype=np.float64)
+        v_dset.attrs['description'] = 'converted voltage (mV), -1 if not calibrated'
+        pdst_v_dset.attrs['description'] = 'calib pedestal voltage (mV), -1 if not ' \
+            'calibrated'
+    n_calibrated = 0
+    for start in range(0, n_rows, args.chunk_size):
+        stop = min(start + args.chunk_size, n_rows)
+        data = dset[start:stop]
+        v, pdst_v = calibration.calibrated_voltages(cal_arrays, data[:,chipid_col],
+                                                    data[:,channelid_col],
+                                                    data[:,raw_adc_col])
+        n_calibrated += np.count_nonzero(v != -1)
+        if args.float:
+            v_dset[start:stop] = v
+            pdst_v_dset[start:stop] = pdst_v
+        else:
+            data[:,v_col] = v
+            data[:,pdst_v_col] = pdst_v
+            dset[start:stop] = data
+        if args.verbose:
+            print('%d/%d rows' % (stop, n_rows))
+    fo.attrs['calibration'] = args.calibration
+
+if args.verbose:
+    print('%d of %d hits calibrated' % (n_calibrated, n_rows))
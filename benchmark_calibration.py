@@ -0,0 +1,271 @@
+'''
+This script benchmarks the pedestal calibration (helpers/calibration.py) on generated
+pedestal-like .dat files of increasing size and number of chips. Each file is written
+with the larpix data logger and the calibration stages are timed separately:
+
+    extract (read, decode and histogram the file) | peak_find | voltage_remap |
+    json_write (build the calibration data and save it as .json)
+
+Every case (number of chips x number of packets) runs in a fresh process so that the
+peak memory (max resident set size) of each case can be compared. The results are
+written as .json with a fixed layout so that runs on different commits can be compared:
+``
+{
+    'version': 2,
+    'commit': <git commit of this repository, if available>,
+    'python': ..., 'numpy': ..., 'platform': ...,
+    'cases': [
+        {
+        'n_chips': ..., 'n_channels': ..., 'adc_step': ..., 'sparse': ...,
+        'n_packets': ..., 'n_blocks': ...,
+        'file_size': <bytes>,
+        'stages': { '<stage>': { 'time': <s, best of --repeat>,
+                                 'max_rss_mb': <peak of the case up to this stage> },
+                    ... },
+        'packets_per_s': <extract throughput>, 'mb_per_s': <extract throughput>,
+        'total_time': <s>, 'max_rss_mb': ...
+        },
+        ...
+        ]
+}
+``
+'''
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+import numpy as np
+import larpix.larpix as larpix
+from larpix.datalogger import DataLogger
+import helpers.calibration as calibration
+from helpers.calibration_store import CalibrationStore
+
+benchmark_version = 2
+stages = ['extract', 'peak_find', 'voltage_remap', 'json_write']
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-o', '--outfile', default='calibration_benchmark.json',
+                    help='output .json file (default: %(default)s)')
+parser.add_argument('-n', '--n_packets', nargs='+', type=int,
+                    default=[10000, 100000, 1000000],
+                    help='number of data packets per file (default: %(default)s)')
+parser.add_argument('-c', '--n_chips', nargs='+', type=int, default=[1, 8, 64],
+                    help='number of chips per file (default: %(default)s)')
+parser.add_argument('--n_channels', default=32, type=int,
+                    help='number of channels per chip (default: %(default)s)')
+parser.add_argument('--packets_per_block', default=1000, type=int,
+                    help='(default: %(default)s)')
+parser.add_argument('-r', '--repeat', default=3, type=int,
+                    help='number of repetitions of each stage, the fastest is reported '
+                    '(default: %(default)s)')
+parser.add_argument('--adc_step', default=calibration.pedestal_adc_step, type=int,
+                    help='bin width of the pedestal adc distributions (default: '
+                    '%(default)s)')
+parser.add_argument('--sparse', action='store_true',
+                    help='use sparse pedestal adc distributions')
+parser.add_argument('--vref', default=1.5, type=float)
+parser.add_argument('--vcm', default=0.2, type=float)
+parser.add_argument('--datadir', default=None,
+                    help='directory for the generated .dat files, kept after the '
+                    'benchmark (default: temporary directory)')
+parser.add_argument('--seed', default=0, type=int)
+parser.add_argument('-v', '--verbose', action='store_true')
+
+def uart_bytes(packet):
+    '''Formats a packet as it is received over the serial port'''
+    return larpix.Controller.start_byte + packet.bytes() + b'\x00' + \
+        larpix.Controller.stop_byte
+
+def make_packet(packet_type, chipid, channel_id=0, dataword=0, timestamp=0,
+                register_address=0, register_data=0):
+    packet = larpix.Packet()
+    packet.packet_type = packet_type
+    packet.chipid = chipid
+    if packet_type == larpix.Packet.DATA_PACKET:
+        packet.channel_id = channel_id
+        packet.dataword = dataword
+        packet.timestamp = timestamp
+    else:
+        packet.register_address = register_address
+        packet.register_data = register_data
+    packet.assign_parity()
+    return packet
+
+def packet_pool(chipids, n_channels, rng, pool_size=16):
+    '''
+    Returns an array of formatted data packets, ``pool_size`` for each chip and channel
+    with adc values drawn from a gaussian pedestal
+    '''
+    pool = []
+    for chipid in chipids:
+        for channel_id in range(n_channels):
+            pedestal = rng.uniform(30, 80)
+            sigma = rng.uniform(1, 4)
+            for adc in np.clip(np.round(rng.normal(pedestal, sigma, pool_size)), 0, 255):
+                pool.append(uart_bytes(make_packet(
+                            larpix.Packet.DATA_PACKET, chipid, channel_id=channel_id,
+                            dataword=int(adc),
+                            timestamp=rng.randint(0, 1 << 24))))
+    return np.array(pool)
+
+def generate_datalog(filename, n_chips, n_channels, n_packets, packets_per_block, rng):
+    '''
+    Writes a pedestal-like .dat file: a configuration write block followed by read
+    blocks of randomly selected channels. Returns the number of blocks.
+    '''
+    if os.path.isfile(filename):
+        os.remove(filename)
+    chipids = list(range(1, n_chips + 1))
+    logger = DataLogger(filename)
+    start_time = time.time()
+    logger.record({'data_type': 'write', 'time': start_time, 'data': b''.join(
+                uart_bytes(make_packet(larpix.Packet.CONFIG_WRITE_PACKET, chipid,
+                                       register_address=32, register_data=40))
+                for chipid in chipids)})
+    pool = packet_pool(chipids, n_channels, rng)
+    n_blocks = 1
+    for block_start in range(0, n_packets, packets_per_block):
+        block_packets = min(packets_per_block, n_packets - block_start)
+        data = pool[rng.randint(0, len(pool), block_packets)].tobytes()
+        logger.record({'data_type': 'read', 'time': start_time + 0.1 * n_blocks,
+                       'data': data})
+        n_blocks += 1
+        if n_blocks % 100 == 0:
+            logger.flush()
+    logger.flush()
+    return n_blocks
+
+def max_rss_mb():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss / 1e6 # bytes
+    return max_rss / 1e3 # kilobytes
+
+def time_stage(func, repeat):
+    '''Runs ``func`` ``repeat`` times, returns its last result and the fastest time'''
+    best_time = None
+    for _ in range(max(repeat, 1)):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best_time is None or elapsed < best_time:
+            best_time = elapsed
+    return result, best_time
+
+def run_case(case):
+    '''Generates the data file of one case and times each calibration stage'''
+    n_chips, n_packets, args = case
+    rng = np.random.RandomState(args.seed)
+    datadir = args.datadir
+    if datadir is None:
+        datadir = tempfile.mkdtemp(prefix='calibration_benchmark_')
+    filename = os.path.join(datadir, 'pedestal_c%d_n%d.dat' % (n_chips, n_packets))
+    json_file = os.path.splitext(filename)[0] + '_calib.json'
+    try:
+        n_blocks = generate_datalog(filename, n_chips, args.n_channels, n_packets,
+                                    args.packets_per_block, rng)
+        file_size = os.path.getsize(filename)
+        stage_results = {}
+
+        def extract():
+            accumulator = calibration.PulsedAdcAccumulator(
+                adc_min=calibration.pedestal_adc_min,
+                adc_max=calibration.pedestal_adc_max,
+                adc_step=args.adc_step, sparse=args.sparse)
+            calibration.extract_calibration_data(filename, [accumulator],
+                                                 verbose=args.verbose)
+            accumulator.finish()
+            return accumulator.adc_hist
+
+        def peak_find():
+            return calibration.get_peak_values_array(adc_counts, adc_hist.bins)
+
+        def voltage_remap():
+            return calibration.pedestal_voltages(peak_values, args.vref, args.vcm)
+
+        def json_write():
+            cal_data = calibration.pedestal_cal_data(chipids, channelids, peak_values,
+                                                     vref=args.vref, vcm=args.vcm,
+                                                     voltages=(v_mean, v_sigma))
+            CalibrationStore.from_dict(cal_data).save(json_file)
+
+        adc_hist, stage_time = time_stage(extract, args.repeat)
+        stage_results['extract'] = {'time': stage_time, 'max_rss_mb': max_rss_mb()}
+        chipids, channelids = adc_hist.channels()
+        adc_counts = adc_hist.channel_counts(chipids, channelids)
+        peak_values, stage_time = time_stage(peak_find, args.repeat)
+        stage_results['peak_find'] = {'time': stage_time, 'max_rss_mb': max_rss_mb()}
+        (v_mean, v_sigma), stage_time = time_stage(voltage_remap, args.repeat)
+        stage_results['voltage_remap'] = {'time': stage_time, 'max_rss_mb': max_rss_mb()}
+        _, stage_time = time_stage(json_write, args.repeat)
+        stage_results['json_write'] = {'time': stage_time, 'max_rss_mb': max_rss_mb()}
+
+        extract_time = stage_results['extract']['time']
+        return {
+            'n_chips': n_chips,
+            'n_channels': args.n_channels,
+            'adc_step': args.adc_step,
+            'sparse': args.sparse,
+            'n_packets': n_packets,
+            'n_blocks': n_blocks,
+            'file_size': file_size,
+            'stages': stage_results,
+            'packets_per_s': n_packets / extract_time if extract_time > 0 else None,
+            'mb_per_s': file_size / 1e6 / extract_time if extract_time > 0 else None,
+            'total_time': sum(stage_results[stage]['time'] for stage in stages),
+            'max_rss_mb': max_rss_mb()
+            }
+    finally:
+        if args.datadir is None:
+            shutil.rmtree(datadir, ignore_errors=True)
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if not args.datadir is None and not os.path.isdir(args.datadir):
+        os.makedirs(args.datadir)
+    cases = [(n_chips, n_packets, args) for n_chips in args.n_chips
+             for n_packets in args.n_packets]
+    results = {
+        'version': benchmark_version,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'created': time.time(),
+        'cases': []
+        }
+    # one fresh process per case to measure its peak memory
+    pool = Pool(processes=1, maxtasksperchild=1)
+    try:
+        for result in pool.imap(run_case, cases):
+            results['cases'].append(result)
+            print('%3d chips, %8d packets: extract %7.2fs (%9.0f packets/s), peak find '
+                  '%.3fs, voltage remap %.3fs, json write %.3fs, max rss %.0fMB' % (
+                    result['n_chips'], result['n_packets'],
+                    result['stages']['extract']['time'], result['packets_per_s'] or 0,
+                    result['stages']['peak_find']['time'],
+                    result['stages']['voltage_remap']['time'],
+                    result['stages']['json_write']['time'], result['max_rss_mb']))
+    finally:
+        pool.close()
+        pool.join()
+    with open(args.outfile, 'w') as fo:
+        json.dump(results, fo, sort_keys=True, indent=4, separators=(',',': '))
+    print('benchmark results saved to %s' % args.outfile)
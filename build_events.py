@@ -0,0 +1,42 @@
+'''
+This script groups the hits of a converted (dat2h5.py) h5 file into events and stores
+them in the ``events`` group of the same file (or of a separate output file):
+
+    events/hits: same columns as data, sorted by full timestamp
+    events/offsets: event i is events/hits[offsets[i]:offsets[i+1]]
+
+'''
+
+from __future__ import print_function
+import argparse
+import numpy as np
+import h5py
+import helpers.event_builder as event_builder
+
+parser = argparse.ArgumentParser()
+parser.add_argument('infile', help='converted h5 file')
+parser.add_argument('outfile', nargs='?', default=None,
+                    help='output h5 file (default: add events to infile)')
+parser.add_argument('-w', '--window', default=5000, type=int,
+                    help='maximum time between hits of the same event (ns) '
+                    '(default: %(default)s)')
+parser.add_argument('-n', '--min_hits', default=1, type=int,
+                    help='minimum number of hits per event (default: %(default)s)')
+parser.add_argument('--chunk_size', default=100000, type=int,
+                    help='number of hits processed at a time (default: %(default)s)')
+parser.add_argument('-v', '--verbose', action='store_true')
+args = parser.parse_args()
+
+if args.outfile is None:
+    with h5py.File(args.infile, 'r+') as fo:
+        data = np.array(fo['data'])
+        n_events = event_builder.build_events(fo, data, args.window, args.min_hits,
+                                              args.chunk_size)
+else:
+    with h5py.File(args.infile, 'r') as fi:
+        data = np.array(fi['data'])
+    with h5py.File(args.outfile, 'a') as fo:
+        n_events = event_builder.build_events(fo, data, args.window, args.min_hits,
+                                              args.chunk_size)
+if args.verbose:
+    print('%d hits -> %d events' % (len(data), n_events))
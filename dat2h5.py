@@ -16,12 +16,12 @@ from __future__ import print_function
 import argparse
 import numpy as np
 from os.path import splitext
-import json
 from larpix.dataloader import DataLoader
 from larpix.larpix import (Controller, Configuration)
 from larpix.Timestamp import Timestamp
-from larpixgeometry.pixelplane import PixelPlane
-import larpixgeometry.layouts as layouts
+from helpers.geometry import (geom_choices, load_compiled_geometry)
+import helpers.packet_cache as packet_cache
+from helpers.calibration_store import CalibrationStore
 parse = Controller.parse_input
 
 def fix_ADC(raw_adc):
@@ -32,34 +32,55 @@ def fix_ADC(raw_adc):
     '''
     return (raw_adc - 128)//2
 
+def block_packets(block):
+    '''Returns the packets of a block (already decoded if read from the packet cache)'''
+    if 'packets' in block:
+        return block['packets']
+    return parse(bytes(block['data']))
+
 parser = argparse.ArgumentParser()
 parser.add_argument('infile')
 parser.add_argument('outfile', nargs='?', default=None)
-parser.add_argument('-c', '--calibration', default=None)
+parser.add_argument('-c', '--calibration', default=None,
+        help='calibration .json or .npz file')
 parser.add_argument('-v', '--verbose', action='store_true')
 parser.add_argument('--format', choices=['h5', 'root', 'ROOT'],
         required=True)
-geom_choices = {'4chip': 'sensor_plane_28_simple.yaml',
-        '8chip': 'sensor_plane_28_8chip.yaml',
-        '28chip': 'sensor_plane_28_full.yaml'}
 parser.add_argument('-g', '--geometry', choices=geom_choices.keys(),
         required=True, help='The sensor & chip geometry layout')
+parser.add_argument('--event_window', default=None, type=int,
+        help='Build events from hits separated by less than this time '
+        '(ns) and store them in the events group (h5 only)')
+parser.add_argument('--event_min_hits', default=1, type=int,
+        help='Minimum number of hits per event (default: %(default)s)')
+parser.add_argument('--cache', action='store_true',
+        help='Read decoded packets from the packet cache of the infile '
+        '(<infile>_packets/, created on first use)')
 args = parser.parse_args()
 
 infile = args.infile
 outfile = args.outfile
 verbose = args.verbose
-loader = DataLoader(infile)
-calib_data = {}
+if args.cache:
+    cached_blocks = packet_cache.iter_transmissions(
+            packet_cache.load_packet_cache(infile, verbose=verbose))
+else:
+    loader = DataLoader(infile)
+calib_arrays = CalibrationStore().arrays(['gain_v', 'gain_vcm', 'pedestal_v'])
 
 if outfile is None:
     outfile = splitext(infile)[0] + '.' + args.format.lower()
 if args.verbose:
     print(infile + ' -> ' + outfile)
 if not args.calibration is None:
-    calib_data = json.load(open(args.calibration,'r'))
+    calib_arrays = CalibrationStore.load(args.calibration).arrays(['gain_v',
+            'gain_vcm', 'pedestal_v'])
+gain_vs = calib_arrays['gain_v']
+gain_vcms = calib_arrays['gain_vcm']
+pedestal_vs = calib_arrays['pedestal_v']
 if args.format == 'h5':
     import h5py
+    import helpers.event_builder as event_builder
     use_root = False
 elif args.format.lower() == 'root':
     use_root = True
@@ -95,8 +116,11 @@ elif args.format.lower() == 'root':
     ttree.Branch('pixel_trim', root_pixel_trim, 'pixel_trim/I')
     ttree.Branch('global_threshold', root_global_threshold, 'global_threshold/I')
 
-#geometry = PixelPlane.fromDict(layouts.load('sensor_plane_28_simple.yaml'))
-geometry = PixelPlane.fromDict(layouts.load(geom_choices[args.geometry]))
+pixels = load_compiled_geometry(args.geometry, verbose=verbose)
+pixel_ids = pixels['pixelid']
+pixel_xs = pixels['x']
+pixel_ys = pixels['y']
+n_chipids, n_channels = pixel_ids.shape
 
 numpy_arrays = []
 index_limit = 10000
@@ -107,12 +131,15 @@ current_index = 0
 last_timestamp = {}
 chip_threshold = {}
 while True:
-    block = loader.next_block()
+    if args.cache:
+        block = next(cached_blocks, None)
+    else:
+        block = loader.next_block()
     serialblock += 1
     if block is None: break
     elif block['block_type'] == 'data' and block['data_type'] == 'write':
         # if write to pixel threshold -> store configuration value
-        packets = parse(bytes(block['data']))
+        packets = block_packets(block)
         for packet in packets:
             if packet.packet_type == packet.CONFIG_WRITE_PACKET:
                 chipid = packet.chipid
@@ -128,7 +155,7 @@ while True:
                     except KeyError:
                         chip_threshold[chipid] = { 'global_threshold' : packet.register_data }
     elif block['block_type'] == 'data' and block['data_type'] == 'read':
-        packets = parse(bytes(block['data']))
+        packets = block_packets(block)
         for packet in packets:
             if packet.packet_type == packet.DATA_PACKET:
                 current_array[current_index][0] = packet.channel_id
@@ -146,32 +173,27 @@ while True:
                 except KeyError:
                     current_array[current_index][12] = -1
                     current_array[current_index][13] = -1
-                try:
-                    pixel = geometry.chips[chipid].channel_connections[channel]
-                except KeyError:
-                    pixel = geometry.unconnected_pixel
-                except IndexError:
-                    pixel = geometry.unconnected_pixel
-                if pixel.pixelid is None:
+                pixelid = -1
+                if chipid < n_chipids and channel < n_channels:
+                    pixelid = pixel_ids[chipid, channel]
+                if pixelid < 0:
                     current_array[current_index][2] = -1
                     current_array[current_index][3] = -1
                     current_array[current_index][4] = -1
                 else:
-                    current_array[current_index][2] = pixel.pixelid
-                    current_array[current_index][3] = int(10*pixel.x)
-                    current_array[current_index][4] = int(10*pixel.y)
-
-                try:
-                    current_array[current_index][10] = 1e3*((packet.dataword) * \
-                        calib_data[str(chipid)][str(channel)]['gain_v'] + \
-                        calib_data[str(chipid)][str(channel)]['gain_vcm'])
-                except KeyError:
-                    current_array[current_index][10] = -1
-                try:
-                    current_array[current_index][11] = 1e3 * calib_data[str(chipid)][str(\
-                            channel)]['pedestal_v']
-                except KeyError:
-                    current_array[current_index][11] = -1
+                    current_array[current_index][2] = pixelid
+                    current_array[current_index][3] = int(10*pixel_xs[chipid, channel])
+                    current_array[current_index][4] = int(10*pixel_ys[chipid, channel])
+
+                v = -1
+                pedestal_v = -1
+                if chipid < n_chipids and channel < n_channels:
+                    v = 1e3*(packet.dataword * gain_vs[chipid, channel] + \
+                        gain_vcms[chipid, channel])
+                    pedestal_v = 1e3 * pedestal_vs[chipid, channel]
+                current_array[current_index][10] = -1 if np.isnan(v) else v
+                current_array[current_index][11] = -1 if np.isnan(pedestal_v) else \
+                    pedestal_v
 
                 cpu_time = block['time']
                 ref_time = None
@@ -218,4 +240,9 @@ else:
     channel id | chip id | pixel id | int(10*pixel x) | int(10*pixel y) | raw ADC | raw
     timestamp | 6-bit ADC | full timestamp | serial index | converted voltage (mV) | calib
     pedestal voltage (mV) | chip global threshold | channel trim threshold'''
+        if not args.event_window is None:
+            n_events = event_builder.build_events(outfile, final_array,
+                    args.event_window, args.event_min_hits)
+            if args.verbose:
+                print('%d events' % n_events)
 
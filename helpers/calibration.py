@@ -1,10 +1,14 @@
-from larpix.analyzers import LogAnalyzer
 import larpix.larpix as larpix
 from larpix.Timestamp import Timestamp
+import helpers.packet_cache as packet_cache
 import numpy as np
 import argparse
 import json
 import sys
+import os
+import pickle
+import tempfile
+from multiprocessing import Pool
 
 def adc_to_v(adc, vref, vcm):
     '''
@@ -12,6 +16,25 @@ def adc_to_v(adc, vref, vcm):
     '''
     return adc * (vref - vcm) / 256 + vcm
 
+def calibrated_voltages(cal_arrays, chipid, channelid, adc):
+    '''
+    Vectorized version of the dat2h5.py calibration, returns the converted voltage and
+    pedestal voltage (mV) of each hit (-1 if no calibration is available)
+    '''
+    chipid = np.asarray(chipid, dtype=np.int64)
+    channelid = np.asarray(channelid, dtype=np.int64)
+    n_chips, n_channels = cal_arrays['gain_v'].shape
+    valid = (chipid >= 0) & (chipid < n_chips) & (channelid >= 0) & \
+        (channelid < n_channels)
+    chipid = np.where(valid, chipid, 0)
+    channelid = np.where(valid, channelid, 0)
+    v = 1e3 * (adc * cal_arrays['gain_v'][chipid, channelid] +
+               cal_arrays['gain_vcm'][chipid, channelid])
+    pedestal_v = 1e3 * cal_arrays['pedestal_v'][chipid, channelid]
+    v[~valid | np.isnan(v)] = -1
+    pedestal_v[~valid | np.isnan(pedestal_v)] = -1
+    return v, pedestal_v
+
 def is_good_data(trans):
     if trans['block_type'] != 'data': return False
     if trans['data_type'] != 'read': return False
@@ -36,6 +59,195 @@ def good_bins(values, step=1, min_v=None, max_v=None):
     bins = np.linspace(min_v-step, max_v+step, nsteps)
     return bins
 
+class AdcHistogram(object):
+    '''
+    Accumulates adc distributions for all chips and channels in a dense
+    ``(n_chips, n_channels, n_bins)`` count array. Hits are buffered as arrays by ``fill``
+    and added to the counts with a single ``np.bincount`` over the flattened
+    (chip, channel, bin) index once ``buffer_size`` hits have been collected (or when
+    the counts are accessed).
+    '''
+    def __init__(self, adc_min=0, adc_max=256, adc_step=2, n_chips=256, n_channels=32,
+                 buffer_size=1000000):
+        self.bins = good_bins([], step=adc_step, min_v=adc_min, max_v=adc_max)
+        self.n_bins = len(self.bins) - 1
+        self.shape = (n_chips, n_channels, self.n_bins)
+        self._counts = np.zeros(self.shape, dtype=np.int64)
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffer_len = 0
+
+    def fill(self, chipid, channelid, adc):
+        '''Adds arrays of chip ids, channel ids and adc values to the distributions'''
+        chipid = np.asarray(chipid, dtype=np.int64)
+        channelid = np.asarray(channelid, dtype=np.int64)
+        bin_idx = np.digitize(adc, self.bins) - 1
+        valid = (bin_idx >= 0) & (bin_idx < self.n_bins) & \
+            (chipid < self._counts.shape[0]) & (channelid < self._counts.shape[1])
+        if not np.all(valid):
+            for idx in np.flatnonzero(~valid):
+                print('adc value %d from c%d-ch%d invalid' % (adc[idx], chipid[idx],
+                                                             channelid[idx]))
+        self._buffer.append((chipid[valid] * self._counts.shape[1] + channelid[valid]) *
+                            self.n_bins + bin_idx[valid])
+        self._buffer_len += len(self._buffer[-1])
+        if self._buffer_len >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        '''Adds the buffered hits to the counts'''
+        if not self._buffer:
+            return
+        flat_idx = np.concatenate(self._buffer)
+        self._buffer = []
+        self._buffer_len = 0
+        self._counts += np.bincount(flat_idx, minlength=self._counts.size).reshape(
+            self._counts.shape)
+
+    @property
+    def counts(self):
+        self.flush()
+        return self._counts
+
+    def entries(self):
+        '''Returns the flat (chip, channel, bin) index and count of each occupied bin'''
+        flat_counts = self.counts.reshape(-1)
+        flat_idx = np.flatnonzero(flat_counts)
+        return flat_idx, flat_counts[flat_idx]
+
+    def merge(self, other):
+        '''
+        Adds the distributions of another ``AdcHistogram`` or ``SparseAdcHistogram`` with
+        the same binning
+        '''
+        if not np.array_equal(self.bins, other.bins):
+            raise ValueError('cannot merge adc histograms with different bins')
+        if not isinstance(other, SparseAdcHistogram):
+            self._counts += other.counts
+            return
+        flat_idx, counts = other.entries()
+        self.counts.reshape(-1)[flat_idx] += counts
+
+    def channels(self):
+        '''Returns arrays of the chip ids and channel ids with at least one entry'''
+        return np.nonzero(self.counts.sum(axis=-1))
+
+    def channel_counts(self, chipids, channelids):
+        '''Returns the ``(len(chipids), n_bins)`` distributions of the given channels'''
+        return self.counts[chipids, channelids]
+
+    def to_dict(self):
+        '''
+        Returns the distributions as
+        ``{str(chipid): {str(channelid): (hist, bin_edges)}}`` for all channels with
+        entries
+        '''
+        adc_dist = {}
+        chipids, channelids = self.channels()
+        counts = self.channel_counts(chipids, channelids)
+        for idx, (chipid, channelid) in enumerate(zip(chipids, channelids)):
+            try:
+                adc_dist[str(chipid)][str(channelid)] = (counts[idx].copy(), self.bins)
+            except KeyError:
+                adc_dist[str(chipid)] = {
+                    str(channelid) : (counts[idx].copy(), self.bins)
+                    }
+        return adc_dist
+
+class SparseAdcHistogram(AdcHistogram):
+    '''
+    Same as ``AdcHistogram``, but only stores the occupied bins as sorted flat
+    (chip, channel, bin) indices with their counts, so that fine binning (e.g. 1 adc) for
+    many mostly quiet channels takes little memory. Dense distributions are only made
+    for the requested channels by ``channel_counts`` (``counts`` returns the full dense
+    array).
+    '''
+    def __init__(self, adc_min=0, adc_max=256, adc_step=2, n_chips=256, n_channels=32,
+                 buffer_size=1000000):
+        self.bins = good_bins([], step=adc_step, min_v=adc_min, max_v=adc_max)
+        self.n_bins = len(self.bins) - 1
+        self.shape = (n_chips, n_channels, self.n_bins)
+        self._counts = None
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._values = np.zeros(0, dtype=np.int64)
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffer_len = 0
+
+    def fill(self, chipid, channelid, adc):
+        '''Adds arrays of chip ids, channel ids and adc values to the distributions'''
+        chipid = np.asarray(chipid, dtype=np.int64)
+        channelid = np.asarray(channelid, dtype=np.int64)
+        bin_idx = np.digitize(adc, self.bins) - 1
+        valid = (bin_idx >= 0) & (bin_idx < self.n_bins) & \
+            (chipid < self.shape[0]) & (channelid < self.shape[1])
+        if not np.all(valid):
+            for idx in np.flatnonzero(~valid):
+                print('adc value %d from c%d-ch%d invalid' % (adc[idx], chipid[idx],
+                                                             channelid[idx]))
+        self._buffer.append((chipid[valid] * self.shape[1] + channelid[valid]) *
+                            self.n_bins + bin_idx[valid])
+        self._buffer_len += len(self._buffer[-1])
+        if self._buffer_len >= self.buffer_size:
+            self.flush()
+
+    def _add(self, flat_idx, counts):
+        keys, inverse = np.unique(np.concatenate((self._keys, flat_idx)),
+                                  return_inverse=True)
+        values = np.bincount(inverse.reshape(-1),
+                             weights=np.concatenate((self._values, counts)),
+                             minlength=len(keys))
+        self._keys = keys
+        self._values = np.round(values).astype(np.int64)
+
+    def flush(self):
+        '''Adds the buffered hits to the occupied bins'''
+        if not self._buffer:
+            return
+        flat_idx = np.concatenate(self._buffer)
+        self._buffer = []
+        self._buffer_len = 0
+        self._add(flat_idx, np.ones(len(flat_idx), dtype=np.int64))
+
+    @property
+    def counts(self):
+        self.flush()
+        counts = np.zeros(self.shape, dtype=np.int64)
+        counts.reshape(-1)[self._keys] = self._values
+        return counts
+
+    def entries(self):
+        self.flush()
+        return self._keys, self._values
+
+    def merge(self, other):
+        if not np.array_equal(self.bins, other.bins):
+            raise ValueError('cannot merge adc histograms with different bins')
+        flat_idx, counts = other.entries()
+        self.flush()
+        self._add(flat_idx, counts)
+
+    def channels(self):
+        self.flush()
+        flat_channels = np.unique(self._keys // self.n_bins)
+        return flat_channels // self.shape[1], flat_channels % self.shape[1]
+
+    def channel_counts(self, chipids, channelids):
+        self.flush()
+        flat_channels, inverse = np.unique(
+            np.asarray(chipids, dtype=np.int64) * self.shape[1] +
+            np.asarray(channelids, dtype=np.int64), return_inverse=True)
+        counts = np.zeros((len(flat_channels), self.n_bins), dtype=np.int64)
+        if len(flat_channels) > 0:
+            # occupied bins of each requested channel
+            key_channels = self._keys // self.n_bins
+            pos = np.minimum(np.searchsorted(flat_channels, key_channels),
+                             len(flat_channels) - 1)
+            selected = flat_channels[pos] == key_channels
+            counts[pos[selected], self._keys[selected] % self.n_bins] = \
+                self._values[selected]
+        return counts[inverse.reshape(-1)]
+
 def integral_within_range(hist, x_low, x_high, moment=0):
     '''
     Calculates the integral ``x^m * f(x) dx`` of the distribution within a range
@@ -71,9 +283,10 @@ def find_fwhm(hist, max_bin):
     hm = max/2.
     while( hm_bin_high < len(bin_edges) and dist[hm_bin_high] > hm ):
         hm_bin_high += 1
-    yp = [dist[hm_bin_high-1], dist[hm_bin_high]]
-    xp = [(bin_edges[hm_bin_high-1] + bin_edges[hm_bin_high])/2,
-          (bin_edges[hm_bin_high] + bin_edges[hm_bin_high+1])/2] # bin center
+    # np.interp requires increasing sample points -> interpolate from the high bin down
+    yp = [dist[hm_bin_high], dist[hm_bin_high-1]]
+    xp = [(bin_edges[hm_bin_high] + bin_edges[hm_bin_high+1])/2,
+          (bin_edges[hm_bin_high-1] + bin_edges[hm_bin_high])/2] # bin center
     hm_high = np.interp(hm, yp, xp)
     while( hm_bin_low > 0 and dist[hm_bin_low] > hm ):
         hm_bin_low -= 1
@@ -103,135 +316,902 @@ def get_peak_values(hist):
         }
     return return_dict
 
-def extract_chip_channel_ids(filename, max_trans=None, verbose=False):
-    la = LogAnalyzer(filename)
-    chip_channel_ids = {}
-    loop_data = {
-        'n_trans': 0,
-        'n_trans_cut': 0,
-        'n_packets': 0,
-        'n_packets_cut': 0
+def interp_pairs(x, x0, x1, f0, f1):
+    '''
+    Element-wise equivalent of ``np.interp(x, [x0, x1], [f0, f1])`` for arrays of sample
+    point pairs (``x0 <= x1``)
+    '''
+    dx = x1 - x0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(dx > 0, np.clip((x - x0) / dx, 0, 1), (x >= x1).astype(float))
+    return f0 + t * (f1 - f0)
+
+def integral_within_range_array(dists, bin_edges, x_low, x_high, moment=0):
+    '''
+    Vectorized ``integral_within_range`` over the rows of a ``(n, n_bins)`` array of
+    distributions sharing the same bin edges, with one range per row
+    '''
+    n_bins = dists.shape[1]
+    bin_centers = (bin_edges[:-1] + bin_edges[1:])/2
+    # cumulative integral over whole bins: cum_sum[:,k] = sum(dist[:,:k] * x_k^m)
+    cum_sum = np.zeros((dists.shape[0], n_bins+1))
+    np.cumsum(dists * bin_centers**moment, axis=1, out=cum_sum[:,1:])
+    rows = np.arange(dists.shape[0])
+    low_bin = np.clip(np.digitize(x_low, bin_edges)-1, 0, n_bins-1)
+    high_bin = np.clip(np.digitize(x_high, bin_edges)-1, 0, n_bins-1)
+    same_bin = high_bin == low_bin
+    dx_low = bin_edges[low_bin+1] - bin_edges[low_bin]
+    dx_high = bin_edges[high_bin+1] - bin_edges[high_bin]
+    low_edge = np.where(same_bin, x_high, bin_edges[low_bin+1])
+    total = dists[rows,low_bin] * (low_edge - x_low) / dx_low * \
+        ((low_edge + x_low)/2)**moment
+    total += np.where(same_bin, 0., dists[rows,high_bin] * (x_high - bin_edges[high_bin]) /
+                      dx_high * ((bin_edges[high_bin] + x_high)/2)**moment)
+    total += np.where(high_bin > low_bin + 1,
+                      cum_sum[rows,high_bin] - cum_sum[rows,np.minimum(low_bin+1, n_bins)],
+                      0.)
+    return total
+
+def find_fwhm_array(dists, bin_edges, max_bin):
+    '''
+    Vectorized ``find_fwhm`` over the rows of a ``(n, n_bins)`` array of distributions
+    sharing the same bin edges
+    '''
+    n_bins = dists.shape[1]
+    bin_centers = (bin_edges[:-1] + bin_edges[1:])/2
+    rows = np.arange(dists.shape[0])
+    hm = dists[rows,max_bin] / 2.
+    bin_idx = np.arange(n_bins)
+    below_hm = dists <= hm[:,np.newaxis]
+    # first bin at or above the peak that is not above half max
+    high_bin = np.where(below_hm & (bin_idx >= max_bin[:,np.newaxis]), bin_idx, n_bins-1)\
+        .min(axis=1)
+    high_bin = np.maximum(high_bin, 1)
+    hm_high = interp_pairs(hm, dists[rows,high_bin], dists[rows,high_bin-1],
+                           bin_centers[high_bin], bin_centers[high_bin-1])
+    # last bin at or below the peak that is not above half max
+    low_bin = np.where(below_hm & (bin_idx <= max_bin[:,np.newaxis]), bin_idx, 0)\
+        .max(axis=1)
+    low_bin = np.minimum(low_bin, n_bins-2)
+    hm_low = interp_pairs(hm, dists[rows,low_bin], dists[rows,low_bin+1],
+                          bin_centers[low_bin], bin_centers[low_bin+1])
+    return hm_low, hm_high
+
+def get_peak_values_array(dists, bin_edges):
+    '''
+    Vectorized ``get_peak_values`` over the rows of a ``(n, n_bins)`` array of
+    distributions sharing the same bin edges. Returns a dict of arrays with the peak value,
+    the half max positions, the mean value within the fwhm of peak, and the sigma of the
+    peak (calculated from fwhm) of each row, plus ``valid``. Rows without entries, with
+    the peak in the first or last bin (the fwhm is not contained in the distribution) or
+    without a positive width are not valid and return nan.
+    '''
+    dists = np.asarray(dists, dtype=float)
+    max_bin = np.argmax(dists, axis=1)
+    hm_low, hm_high = find_fwhm_array(dists, bin_edges, max_bin)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_x = integral_within_range_array(dists, bin_edges, hm_low, hm_high, moment=1)/\
+            integral_within_range_array(dists, bin_edges, hm_low, hm_high)
+    valid = (dists.sum(axis=1) > 0) & (max_bin > 0) & (max_bin < dists.shape[1] - 1) & \
+        (hm_high > hm_low) & np.isfinite(mean_x)
+    return_dict = {
+        'peak' : dists[np.arange(len(dists)),max_bin],
+        'hm_low' : np.where(valid, hm_low, np.nan),
+        'hm_high' : np.where(valid, hm_high, np.nan),
+        'mean' : np.where(valid, mean_x, np.nan),
+        'sigma' : np.where(valid, (hm_high - hm_low) / (2 * np.sqrt(2 * np.log(2))), np.nan),
+        'valid' : valid
         }
+    return return_dict
 
-    while True:
-        curr_trans = la.next_transmission()
-        if curr_trans is None: break
-        if loop_data['n_trans'] == max_trans: break
-        loop_data['n_trans'] += 1
-        if verbose and loop_data['n_trans'] % 100 == 0:
-            print('trans: %d, trans_cut: %d, packets: %d, packets_cut: %d\r' %
-                  (loop_data['n_trans'], loop_data['n_trans_cut'], loop_data['n_packets'],
-                   loop_data['n_packets_cut']), end='')
-            sys.stdout.flush()
-        if not is_good_data(curr_trans):
-            loop_data['n_trans_cut'] += 1
-            continue
-        loop_data['n_packets'] += len(curr_trans['packets'])
-        for packet in curr_trans['packets']:
-            if not is_good_packet(packet):
-                loop_data['n_packets_cut'] += 1
-                continue
-            chip_id = str(packet.chipid)
-            channel_id = str(packet.channel_id)
+def gaussian_model(params, x):
+    '''
+    Evaluates ``amplitude * exp(-(x - mean)**2 / (2 * sigma**2)) [+ background]`` for
+    each row of ``params`` (``(n, 3)`` or ``(n, 4)`` with a flat background) and its
+    jacobian with respect to the parameters
+    '''
+    amplitude, mean, sigma = params[:,0:1], params[:,1:2], params[:,2:3]
+    z = (x - mean) / sigma
+    g = np.exp(-0.5 * z**2)
+    model = amplitude * g
+    jacobian = [g, model * z / sigma, model * z**2 / sigma]
+    if params.shape[1] > 3:
+        model = model + params[:,3:4]
+        jacobian.append(np.ones_like(g))
+    return model, np.stack(jacobian, axis=-1)
+
+def fit_gaussians(dists, bin_edges, background=False, fit_range=5., max_iterations=50,
+                  tolerance=1e-6):
+    '''
+    Fits a gaussian (plus a flat background if ``background``) to each row of a ``(n,
+    n_bins)`` array of distributions sharing the same bin edges, all rows at once with
+    batched Levenberg-Marquardt iterations. The model is evaluated at the bin centers and
+    fit within ``fit_range`` sigma of the initial guess (from ``get_peak_values_array``)
+    minimizing chi2 with ``max(counts, 1)`` variances. Returns a dict of arrays:
+
+        ``amplitude``, ``mean``, ``sigma`` (and ``background``): fit parameters
+        ``chi2_ndf``: chi2 per degree of freedom
+        ``converged``: True if the fit converged to a valid peak
+
+    Rows without enough filled bins return nan and are not converged.
+    '''
+    dists = np.asarray(dists, dtype=float)
+    bin_centers = (bin_edges[:-1] + bin_edges[1:])/2
+    bin_width = np.min(np.diff(bin_edges))
+    n_rows = dists.shape[0]
+    n_params = 4 if background else 3
+    # initial guesses from the peak and fwhm
+    peak_values = get_peak_values_array(dists, bin_edges)
+    params = np.zeros((n_rows, n_params))
+    params[:,0] = peak_values['peak']
+    params[:,1] = peak_values['mean']
+    params[:,2] = np.fmax(peak_values['sigma'], bin_width / np.sqrt(12))
+    in_range = np.abs(bin_centers - params[:,1:2]) <= fit_range * params[:,2:3]
+    if background:
+        params[:,3] = np.median(dists, axis=1)
+        params[:,0] -= params[:,3]
+    weights = in_range / np.fmax(dists, 1.)
+    ndf = np.count_nonzero(in_range, axis=1) - n_params
+    active = np.isfinite(params).all(axis=1) & (ndf > 0) & (params[:,0] > 0)
+    params[~active] = np.nan
+    converged = np.zeros(n_rows, dtype=bool)
+    chi2 = np.full(n_rows, np.nan)
+    rows = np.flatnonzero(active)
+    if len(rows):
+        p = params[rows]
+        y = dists[rows]
+        w = weights[rows]
+        model, jacobian = gaussian_model(p, bin_centers)
+        row_chi2 = np.sum(w * (y - model)**2, axis=1)
+        damping = np.full(len(rows), 1e-3)
+        done = np.zeros(len(rows), dtype=bool)
+        stuck_rows = np.zeros(len(rows), dtype=bool)
+        identity = np.eye(n_params)
+        for iteration in range(max_iterations):
+            todo = np.flatnonzero(~done)
+            jac = jacobian[todo]
+            weighted_jacobian = jac * w[todo,:,np.newaxis]
+            hessian = np.einsum('nbk,nbl->nkl', weighted_jacobian, jac)
+            gradient = np.einsum('nbk,nb->nk', weighted_jacobian, y[todo] - model[todo])
+            diagonal = np.einsum('nkk->nk', hessian)
+            scaled = hessian + damping[todo,np.newaxis,np.newaxis] * \
+                (diagonal[:,:,np.newaxis] + 1e-12) * identity
+            with np.errstate(all='ignore'):
+                try:
+                    step = np.linalg.solve(scaled, gradient[:,:,np.newaxis])[:,:,0]
+                except np.linalg.LinAlgError:
+                    step = np.einsum('nkl,nl->nk', np.linalg.pinv(scaled), gradient)
+                new_p = p[todo] + step
+                new_p[:,2] = np.abs(new_p[:,2])
+                new_model, new_jacobian = gaussian_model(new_p, bin_centers)
+                new_chi2 = np.sum(w[todo] * (y[todo] - new_model)**2, axis=1)
+            accept = np.isfinite(new_chi2) & (new_chi2 <= row_chi2[todo])
+            small_change = row_chi2[todo] - new_chi2 <= \
+                tolerance * np.fmax(row_chi2[todo], 1e-12)
+            stuck = ~accept & (damping[todo] > 1e8)
+            accepted = todo[accept]
+            p[accepted] = new_p[accept]
+            model[accepted] = new_model[accept]
+            jacobian[accepted] = new_jacobian[accept]
+            row_chi2[accepted] = new_chi2[accept]
+            damping[todo] = np.where(accept, damping[todo] / 10., damping[todo] * 10.)
+            stuck_rows[todo] = stuck
+            done[todo] = (accept & small_change) | stuck
+            if np.all(done):
+                break
+        # rows where no step lowered chi2 only converged if they are at a minimum, i.e.
+        # the chi2 decrease expected from a gauss-newton step is within the tolerance
+        check = np.flatnonzero(stuck_rows)
+        if len(check):
+            weighted_jacobian = jacobian[check] * w[check,:,np.newaxis]
+            hessian = np.einsum('nbk,nbl->nkl', weighted_jacobian, jacobian[check])
+            gradient = np.einsum('nbk,nb->nk', weighted_jacobian, y[check] - model[check])
+            with np.errstate(all='ignore'):
+                decrease = np.einsum('nk,nkl,nl->n', gradient, np.linalg.pinv(hessian),
+                                     gradient)
+            stuck_rows[check] = ~(decrease <= tolerance * np.fmax(row_chi2[check], 1e-12))
+        params[rows] = p
+        chi2[rows] = row_chi2
+        converged[rows] = done & ~stuck_rows
+    valid = converged & np.isfinite(params).all(axis=1) & (params[:,0] > 0) & \
+        (params[:,2] > 0) & (params[:,1] >= bin_edges[0]) & (params[:,1] <= bin_edges[-1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        chi2_ndf = np.where(ndf > 0, chi2 / ndf, np.nan)
+    return_dict = {
+        'amplitude': params[:,0],
+        'mean': params[:,1],
+        'sigma': params[:,2],
+        'chi2_ndf': chi2_ndf,
+        'converged': valid
+        }
+    if background:
+        return_dict['background'] = params[:,3]
+    return return_dict
+
+robust_tail_sigma = 5. # tails start this many (MAD based) sigma from the median
+
+def histogram_cdf(counts, bin_edges, x):
+    '''
+    Returns the cumulative counts of each row of a ``(n, n_bins)`` array of distributions
+    below ``x`` (one value per row), linearly interpolated within the bin
+    '''
+    counts = np.asarray(counts, dtype=float)
+    rows = np.arange(counts.shape[0])
+    cum_counts = np.concatenate((np.zeros((counts.shape[0], 1)),
+                                 np.cumsum(counts, axis=1)), axis=1)
+    x_bin = np.clip(np.searchsorted(bin_edges, x, side='right') - 1, 0,
+                    counts.shape[1] - 1)
+    frac = np.clip((x - bin_edges[x_bin]) / (bin_edges[x_bin+1] - bin_edges[x_bin]), 0, 1)
+    return cum_counts[rows,x_bin] + frac * counts[rows,x_bin]
+
+def robust_peak_values(dists, bin_edges, tail_sigma=robust_tail_sigma,
+                       n_iterations=40):
+    '''
+    Robust pedestal values of each row of a ``(n, n_bins)`` array of distributions of
+    integer adc values. The entries of a bin ``[e, e+step)`` (adc values ``e`` to
+    ``e+step-1``) are taken as uniform over ``[e-0.5, e+step-0.5)``, so that an adc value
+    ``v`` is centered on ``v``. Returns a dict of arrays with the ``median``, the sigma
+    from the median absolute deviation (``mad_sigma`` = 1.4826 MAD) and the fraction of
+    entries more than ``tail_sigma`` sigma below (``tail_low``) and above
+    (``tail_high``) the median. The MAD is found for all rows at once by bisection. Rows
+    without entries return nan.
+    '''
+    dists = np.asarray(dists, dtype=float)
+    bin_edges = np.asarray(bin_edges, dtype=float) - 0.5
+    total = dists.sum(axis=1)
+    median = histogram_quantile(dists, bin_edges, 0.5)
+    center = np.where(total > 0, median, bin_edges[0])
+    # half of the entries are within median +/- mad
+    low = np.zeros(len(dists))
+    high = np.full(len(dists), float(bin_edges[-1] - bin_edges[0]))
+    for _ in range(n_iterations):
+        mad = 0.5 * (low + high)
+        within = histogram_cdf(dists, bin_edges, center + mad) - \
+            histogram_cdf(dists, bin_edges, center - mad)
+        below_half = within < 0.5 * total
+        low = np.where(below_half, mad, low)
+        high = np.where(below_half, high, mad)
+    mad_sigma = 1.4826 * 0.5 * (low + high)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tail_low = histogram_cdf(dists, bin_edges, center - tail_sigma * mad_sigma) / \
+            total
+        tail_high = 1 - histogram_cdf(dists, bin_edges, center + tail_sigma * mad_sigma) / \
+            total
+    empty = total <= 0
+    return {
+        'median': median,
+        'mad_sigma': np.where(empty, np.nan, mad_sigma),
+        'tail_low': np.where(empty, np.nan, tail_low),
+        'tail_high': np.where(empty, np.nan, tail_high)
+        }
+
+def pedestal_peak_values(dists, bin_edges, fit=None, robust=False):
+    '''
+    Returns the pedestal mean and sigma of each row of ``dists`` as used for the pedestal
+    calibration: the mean within the fwhm of the peak, the gaussian fit values where
+    the fit converged if ``fit`` is one of ``pedestal_fit_choices`` (plus
+    ``fit_chi2_ndf`` and ``fit_converged``), or the median and MAD based sigma if
+    ``robust`` (plus the values of ``robust_peak_values``). ``valid`` is False for the
+    rows without a usable pedestal.
+    '''
+    if robust and not fit is None:
+        raise ValueError('robust pedestals cannot be combined with a fit')
+    peak_values = get_peak_values_array(dists, bin_edges)
+    if not fit is None:
+        fit_values = fit_gaussians(dists, bin_edges, background=fit == 'gaussian_background')
+        converged = fit_values['converged']
+        peak_values['mean'] = np.where(converged, fit_values['mean'], peak_values['mean'])
+        peak_values['sigma'] = np.where(converged, fit_values['sigma'],
+                                        peak_values['sigma'])
+        peak_values['fit_chi2_ndf'] = fit_values['chi2_ndf']
+        peak_values['fit_converged'] = converged
+        peak_values['valid'] = peak_values['valid'] | converged
+    if robust:
+        peak_values.update(robust_peak_values(dists, bin_edges))
+        peak_values['mean'] = peak_values['median']
+        peak_values['sigma'] = peak_values['mad_sigma']
+        peak_values['valid'] = np.isfinite(peak_values['mean']) & \
+            np.isfinite(peak_values['sigma'])
+    return peak_values
+
+def _bootstrap_moments(job):
+    '''
+    Draws ``n_replicas`` multinomial bootstrap replicas of all distributions at once and
+    returns the number, sum and sum of squares of the valid replica pedestal mean and
+    sigma (replicas without a valid peak, or with a nan or negative sigma, are dropped)
+    '''
+    dists, bin_edges, n_replicas, fit, robust, seed = job
+    rng = np.random.default_rng(seed)
+    n = dists.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pvals = np.where(n[:,np.newaxis] > 0, dists / n[:,np.newaxis], 1. / dists.shape[1])
+    moments = np.zeros((2, 3, len(dists)))
+    for _ in range(n_replicas):
+        replica = rng.multinomial(n.astype(np.int64), pvals)
+        peak_values = pedestal_peak_values(replica, bin_edges, fit=fit, robust=robust)
+        with np.errstate(invalid='ignore'):
+            valid = peak_values['valid'] & np.isfinite(peak_values['mean']) & \
+                (peak_values['sigma'] >= 0)
+        for idx, name in enumerate(['mean', 'sigma']):
+            values = np.where(valid, peak_values[name], 0)
+            moments[idx,0] += valid
+            moments[idx,1] += values
+            moments[idx,2] += values**2
+    return moments
+
+def bootstrap_peak_values(dists, bin_edges, n_replicas=100, fit=None, robust=False, jobs=1,
+                          seed=None):
+    '''
+    Estimates the statistical uncertainty of the pedestal mean and sigma of each row of
+    ``dists`` (see ``pedestal_peak_values``) from ``n_replicas`` multinomial bootstrap
+    replicas of the distributions. Each replica is drawn and analyzed for all rows at
+    once, and the replicas are split across ``jobs`` worker processes. Returns a dict
+    with the standard deviation of the valid replica ``mean`` and ``sigma`` (nan for rows
+    with less than two valid replicas).
+    '''
+    dists = np.asarray(dists, dtype=np.int64)
+    jobs = max(min(jobs, n_replicas), 1)
+    seeds = np.random.SeedSequence(seed).spawn(jobs)
+    job_replicas = [n_replicas // jobs + (job < n_replicas % jobs) for job in range(jobs)]
+    job_args = [(dists, bin_edges, job_replicas[job], fit, robust, seeds[job])
+                for job in range(jobs)]
+    if jobs > 1:
+        pool = Pool(jobs)
+        try:
+            moments = sum(pool.map(_bootstrap_moments, job_args))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        moments = _bootstrap_moments(job_args[0])
+    errors = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for idx, name in enumerate(['mean', 'sigma']):
+            n_valid = moments[idx,0]
+            replica_mean = moments[idx,1] / n_valid
+            variance = (moments[idx,2] / n_valid - replica_mean**2) * n_valid / \
+                (n_valid - 1)
+            errors[name] = np.where(n_valid > 1, np.sqrt(np.maximum(variance, 0)), np.nan)
+    return errors
+
+class ChipChannelIdAccumulator(object):
+    '''
+    Keeps track of the channels with good packets on each chip in a fixed size bitmap
+    (``seen``, indexed by ``[chipid, channelid]``). If ``max_idle_blocks`` is set, the
+    accumulator is ``done`` once that many read blocks in a row did not add a new channel.
+    '''
+    requires_silenced = False
+
+    def __init__(self, n_chips=256, n_channels=32, max_idle_blocks=None):
+        self.seen = np.zeros((n_chips, n_channels), dtype=bool)
+        self.max_idle_blocks = max_idle_blocks
+        self.idle_blocks = 0
+
+    @property
+    def done(self):
+        return not self.max_idle_blocks is None and \
+            self.idle_blocks >= self.max_idle_blocks
+
+    @property
+    def chip_channel_ids(self):
+        '''Channels seen as ``{str(chipid): [str(channelid), ...]}``'''
+        chip_channel_ids = {}
+        for chip_id, channel_id in zip(*np.nonzero(self.seen)):
             try:
-                chip_channel_ids[chip_id] += [channel_id]
+                chip_channel_ids[str(chip_id)] += [str(channel_id)]
             except KeyError:
-                chip_channel_ids[chip_id] = [channel_id]
-    print('')
-    print(' N_transmissions: %4d, N_transmissions removed: %4d' % (
-            loop_data['n_trans'], loop_data['n_trans_cut']))
-    print(' N_packets: %4d, N_packets removed: %4d' % (
-            loop_data['n_packets'], loop_data['n_packets_cut']))
-    return chip_channel_ids
+                chip_channel_ids[str(chip_id)] = [str(channel_id)]
+        return chip_channel_ids
 
-def extract_chip_rel_timing(filename, verbose=False, max_trans=None):
-    la = LogAnalyzer(filename)
-    last_timestamp = {}
-    rel_offset = {}
-    loop_data = {
-        'n_trans': 0,
-        'n_trans_cut': 0,
-        'n_packets': 0,
-        'n_packets_cut': 0
-        }
-    chips_silenced = False # cuts out all data before first write command
-    while True:
-        curr_trans = la.next_transmission()
-        if curr_trans is None: break
-        if loop_data['n_trans'] == max_trans: break
-        loop_data['n_trans'] += 1
-        if verbose and loop_data['n_trans'] % 100 == 0:
-            print('trans: %d, trans_cut: %d, packets: %d, packets_cut: %d\r' %
-                  (loop_data['n_trans'], loop_data['n_trans_cut'], loop_data['n_packets'],
-                   loop_data['n_packets_cut']), end='')
-            sys.stdout.flush()
-        if curr_trans['block_type'] is 'data' and curr_trans['data_type'] is 'write':
-            chips_silenced = True # assumes first write is a silence command
-        if not is_good_data(curr_trans):
-            loop_data['n_trans_cut'] += 1
-            continue
-        if not chips_silenced:
-            loop_data['n_trans_cut'] += 1
-            continue
-        loop_data['n_packets'] += len(curr_trans['packets'])
+    def write(self, trans):
+        pass
+
+    def read(self, trans, hits):
+        n_chips, n_channels = self.seen.shape
+        in_range = (hits['chipid'] < n_chips) & (hits['channelid'] < n_channels)
+        chipids = hits['chipid'][in_range]
+        channelids = hits['channelid'][in_range]
+        if np.all(self.seen[chipids, channelids]):
+            self.idle_blocks += 1
+        else:
+            self.seen[chipids, channelids] = True
+            self.idle_blocks = 0
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        pass
+
+    def merge(self, other):
+        self.seen |= other.seen
+
+class BadPacketAccumulator(object):
+    '''
+    Keeps the packets with bad parity of each read transmission for diagnosing link
+    problems. The quarantine table (``table()``) has one entry per bad packet with the
+    block index, the position of the packet in the block, its raw bits (``word``) and
+    the packet type, chip id and channel id as decoded from the bad packet.
+    '''
+    requires_silenced = False
+    done = False
+    fields = [('block_index', np.int64), ('position', np.int64), ('word', np.uint64),
+              ('packet_type', np.uint8), ('chipid', np.uint8), ('channelid', np.uint8)]
+
+    def __init__(self):
+        self.n_packets = 0
+        self._tables = []
+
+    def write(self, trans):
+        pass
+
+    def read(self, trans, hits):
+        words = trans.get('words')
+        if words is None:
+            words = packet_cache.packet_words(trans['packets'])
+        self.n_packets += len(words)
+        position = np.flatnonzero(~packet_cache.parity_ok(words))
+        if len(position) == 0:
+            return
+        words = np.asarray(words, dtype=np.uint64)[position]
+        self._tables.append({
+            'block_index': np.full(len(position), trans.get('block_index', -1)),
+            'position': position,
+            'word': words,
+            'packet_type': packet_cache.word_field(words, larpix.Packet.packet_type_bits),
+            'chipid': packet_cache.word_field(words, larpix.Packet.chipid_bits),
+            'channelid': packet_cache.word_field(words, larpix.Packet.channel_id_bits)
+            })
+
+    def table(self):
+        '''Returns the quarantine table as a dict of columns'''
+        return dict((name, np.concatenate([np.zeros(0, dtype=dtype)] +
+                                          [table[name] for table in self._tables]
+                                          ).astype(dtype))
+                    for name, dtype in self.fields)
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        pass
+
+    def merge(self, other):
+        self.n_packets += other.n_packets
+        self._tables += other._tables
+
+class RelTimingAccumulator(object):
+    '''
+    Accumulates statistics of the time difference ``dt`` between consecutive packets from
+    different chips within a serial read, in fixed memory. For each ``(chipid,
+    prev_chipid)`` pair the count, mean and sum of squared deviations (``n``, ``mean``,
+    ``m2`` arrays indexed by ``[chipid, prev_chipid]``) are updated online, and a bounded
+    histogram of ``dt`` (``dt_hist[(chipid, prev_chipid)]``, with an underflow and an
+    overflow bin) is kept for robust estimates. The channels seen on each chip are kept in
+    ``seen``.
+    '''
+    requires_silenced = True
+    done = False
+
+    def __init__(self, dt_min=-1e5, dt_max=1e5, dt_bins=1000, n_chips=256, n_channels=32,
+                 buffer_size=100000):
+        self.n = np.zeros((n_chips, n_chips), dtype=np.int64)
+        self.mean = np.zeros((n_chips, n_chips))
+        self.m2 = np.zeros((n_chips, n_chips))
+        self.dt_bin_edges = np.linspace(dt_min, dt_max, dt_bins+1)
+        self.dt_hist = {}
+        self.seen = np.zeros((n_chips, n_channels), dtype=bool)
+        self.last_timestamp = {}
+        self.buffer_size = buffer_size
+        self._buffer_pair = []
+        self._buffer_dt = []
+
+    def write(self, trans):
+        pass
+
+    def read(self, trans, hits):
+        n_chips, n_channels = self.seen.shape
+        in_range = (hits['chipid'] < n_chips) & (hits['channelid'] < n_channels)
+        self.seen[hits['chipid'][in_range], hits['channelid'][in_range]] = True
         prev_ns = None
         prev_chip_id = None
-        for packet in curr_trans['packets']:
-            if not is_good_packet(packet):
-                loop_data['n_packets_cut'] += 1
-                continue
-            chip_id = str(packet.chipid)
-            cpu_time = curr_trans['time']
+        for packet in hits['packets']:
+            chip_id = packet.chipid
+            cpu_time = trans['time']
             ref_time = None
-            if chip_id in last_timestamp.keys():
-                ref_time = last_timestamp[str(packet.chipid)]
+            if chip_id in self.last_timestamp.keys():
+                ref_time = self.last_timestamp[chip_id]
             current_timestamp = Timestamp.from_packet(packet, cpu_time, ref_time)
-            if len(last_timestamp.keys()) == 0:
+            if len(self.last_timestamp.keys()) == 0:
                 for chip in range(255):
-                    last_timestamp[str(chip)] = current_timestamp
+                    self.last_timestamp[chip] = current_timestamp
             else:
-                last_timestamp[chip_id] = current_timestamp
+                self.last_timestamp[chip_id] = current_timestamp
             if prev_chip_id is None:
                 prev_ns = current_timestamp.ns
                 prev_chip_id = chip_id
                 continue
-            if chip_id != prev_chip_id:
+            if chip_id != prev_chip_id and chip_id < n_chips and prev_chip_id < n_chips:
                 # two different chips in serial read almost simultaneous
                 #   -> store time difference
-                dt = prev_ns - current_timestamp.ns
-                try:
-                    rel_offset[chip_id][prev_chip_id] += [dt]
-                except KeyError:
-                    rel_offset[chip_id] = { prev_chip_id: [dt] }
+                self._buffer_pair.append(chip_id * n_chips + prev_chip_id)
+                self._buffer_dt.append(prev_ns - current_timestamp.ns)
             prev_chip_id = chip_id
             prev_ns = current_timestamp.ns
-    print('')
-    print(' N_transmissions: %4d, N_transmissions removed: %4d' % (
-            loop_data['n_trans'], loop_data['n_trans_cut']))
-    print(' N_packets: %4d, N_packets removed: %4d' % (
-            loop_data['n_packets'], loop_data['n_packets_cut']))
-    return rel_offset
+        if len(self._buffer_dt) >= self.buffer_size:
+            self.flush()
 
-def extract_pulsed_adc_dist(filename, adc_max=256, adc_min=0, adc_step=2, max_trans=None,
-                            verbose=False):
+    def flush(self):
+        '''Merges the buffered time differences into the pair statistics'''
+        if not self._buffer_dt:
+            return
+        pair = np.array(self._buffer_pair, dtype=np.int64)
+        dt = np.array(self._buffer_dt, dtype=float)
+        self._buffer_pair = []
+        self._buffer_dt = []
+        self.add_moments(*pair_moments(pair, dt, self.n.size))
+        # bounded histograms (only for pairs that occur)
+        n_hist_bins = len(self.dt_bin_edges) + 1
+        hist_bin = np.digitize(dt, self.dt_bin_edges)
+        pairs, pair_idx = np.unique(pair, return_inverse=True)
+        counts = np.bincount(pair_idx * n_hist_bins + hist_bin,
+                             minlength=len(pairs) * n_hist_bins).reshape(len(pairs),
+                                                                         n_hist_bins)
+        n_chips = self.n.shape[0]
+        for idx, pair_id in enumerate(pairs):
+            key = (int(pair_id // n_chips), int(pair_id % n_chips))
+            try:
+                self.dt_hist[key] += counts[idx]
+            except KeyError:
+                self.dt_hist[key] = counts[idx]
+
+    def finish(self):
+        '''Flushes the buffer and drops the per-file timestamp state'''
+        self.flush()
+        self.last_timestamp = {}
+
+    def merge(self, other):
+        '''Adds the statistics of another ``RelTimingAccumulator`` with the same binning'''
+        if not np.array_equal(self.dt_bin_edges, other.dt_bin_edges):
+            raise ValueError('cannot merge timing accumulators with different bins')
+        self.flush()
+        other.flush()
+        self.add_moments(other.n.ravel(), other.mean.ravel(), other.m2.ravel())
+        for key, counts in other.dt_hist.items():
+            try:
+                self.dt_hist[key] += counts
+            except KeyError:
+                self.dt_hist[key] = counts.copy()
+        self.seen |= other.seen
+
+    def add_moments(self, n, mean, m2):
+        '''Merges pair statistics (flat arrays of count, mean, m2) into the totals'''
+        n = n.reshape(self.n.shape)
+        mean = mean.reshape(self.n.shape)
+        m2 = m2.reshape(self.n.shape)
+        n_total = self.n + n
+        filled = n > 0
+        delta = mean - self.mean
+        self.mean[filled] += delta[filled] * n[filled] / n_total[filled]
+        self.m2[filled] += m2[filled] + delta[filled]**2 * self.n[filled] * n[filled] / \
+            n_total[filled]
+        self.n = n_total
+
+    def pair_stats(self):
+        '''
+        Returns ``{str(chipid): {str(prev_chipid): {'n', 'mean', 'sigma', 'median'}}}``
+        '''
+        self.flush()
+        medians = dt_hist_medians(self.dt_hist, self.dt_bin_edges)
+        stats = {}
+        for chipid, prev_chipid in zip(*np.nonzero(self.n)):
+            n = int(self.n[chipid, prev_chipid])
+            pair_stats = {
+                'n': n,
+                'mean': float(self.mean[chipid, prev_chipid]),
+                'sigma': float(np.sqrt(self.m2[chipid, prev_chipid] / n)),
+                'median': float(medians.get((chipid, prev_chipid), np.nan))
+                }
+            try:
+                stats[str(chipid)][str(prev_chipid)] = pair_stats
+            except KeyError:
+                stats[str(chipid)] = { str(prev_chipid): pair_stats }
+        return stats
+
+def pair_moments(pair, values, n_pairs):
     '''
-    Extracts adc distributions for each chip and channel excluding hits from channels that
-    were issued test pulses
+    Returns the count, mean and sum of squared deviations of ``values`` for each pair
+    index (flat arrays of length ``n_pairs``)
+    '''
+    n = np.bincount(pair, minlength=n_pairs)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(n > 0, np.bincount(pair, weights=values, minlength=n_pairs) / n, 0.)
+    m2 = np.bincount(pair, weights=(values - mean[pair])**2, minlength=n_pairs)
+    return n, mean, m2
+
+def histogram_quantile(counts, bin_edges, q):
+    '''
+    Returns the quantile ``q`` of each row of a ``(n, n_bins)`` array of distributions
+    sharing the same bin edges, linearly interpolated within the bin. Rows without entries
+    return nan.
+    '''
+    counts = np.asarray(counts, dtype=float)
+    cum_counts = np.cumsum(counts, axis=1)
+    total = cum_counts[:,-1]
+    target = q * total
+    rows = np.arange(counts.shape[0])
+    q_bin = np.minimum((cum_counts < target[:,np.newaxis]).sum(axis=1), counts.shape[1]-1)
+    below = cum_counts[rows,q_bin] - counts[rows,q_bin]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where(counts[rows,q_bin] > 0,
+                        (target - below) / counts[rows,q_bin], 0.5)
+    quantile = bin_edges[q_bin] + frac * (bin_edges[q_bin+1] - bin_edges[q_bin])
+    return np.where(total > 0, quantile, np.nan)
+
+def dt_hist_medians(dt_hist, dt_bin_edges):
+    '''
+    Returns the median of each pair's bounded dt histogram, nan if the median falls in the
+    underflow or overflow bin
+    '''
+    if not dt_hist:
+        return {}
+    keys = list(dt_hist.keys())
+    counts = np.array([dt_hist[key] for key in keys])
+    total = counts.sum(axis=1)
+    underflow = counts[:,0]
+    in_range = counts[:,1:-1].sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = (0.5 * total - underflow) / in_range
+    medians = histogram_quantile(counts[:,1:-1], dt_bin_edges, q)
+    # median is outside of histogram range
+    outside = (2*underflow >= total) | (2*(underflow + in_range) < total)
+    medians[outside] = np.nan
+    return dict(zip(keys, medians))
+
+class PulsedChannelTracker(object):
+    '''
+    Keeps track of the channels with the test pulser enabled (``pulsed_mask``, indexed
+    by ``[chipid, channelid]``) from the configuration write transmissions
+    '''
+    requires_silenced = True
+    done = False
+
+    def __init__(self, n_chips=256, n_channels=32):
+        self.chip_conf = {} # keep track of chip configuration commands sent
+        self.pulsed_chip_channels = {} # keeps track of channels with test pulser enabled
+        self.pulsed_mask = np.zeros((n_chips, n_channels), dtype=bool)
+
+    def write(self, trans):
+        testpulse_conf_flag = False # marks if testpulse enable configuration has changed
+        for packet in trans['packets']:
+            if packet.packet_type == larpix.Packet.CONFIG_READ_PACKET:
+                continue
+            # update configuration with new packets
+            packet_dict = {packet.register_address: packet.register_data}
+            try:
+                self.chip_conf[packet.chipid].from_dict_registers(packet_dict)
+            except KeyError:
+                self.chip_conf[packet.chipid] = larpix.Configuration()
+                self.chip_conf[packet.chipid].from_dict_registers(packet_dict)
+
+            if packet.register_address in larpix.Configuration.csa_testpulse_enable_addresses:
+                # change test pulse configuration
+                testpulse_conf_flag = True
+                self.pulsed_chip_channels = {} # reset pulsed channels
+        if testpulse_conf_flag:
+            for chipid, conf in self.chip_conf.items():
+                if any([value == 0 for value in conf.csa_testpulse_enable]):
+                    self.pulsed_chip_channels[chipid] = [
+                        channel for channel, value in enumerate(conf.csa_testpulse_enable)
+                        if value == 0]
+            self.pulsed_mask[:] = False
+            for chipid, channels in self.pulsed_chip_channels.items():
+                self.pulsed_mask[chipid, channels] = True
+
+    def is_pulsed(self, hits):
+        '''Returns a mask of the hits from channels with the test pulser enabled'''
+        chipids = hits['chipid']
+        channelids = hits['channelid']
+        in_range = (chipids < self.pulsed_mask.shape[0]) & \
+            (channelids < self.pulsed_mask.shape[1])
+        pulsed = np.zeros(len(chipids), dtype=bool)
+        pulsed[in_range] = self.pulsed_mask[chipids[in_range], channelids[in_range]]
+        return pulsed
+
+    def reset(self):
+        '''Drops the per-file configuration state'''
+        self.chip_conf = {}
+        self.pulsed_chip_channels = {}
+        self.pulsed_mask[:] = False
+
+class PulsedAdcAccumulator(PulsedChannelTracker):
+    '''
+    Fills adc distributions for each chip and channel (``adc_hist``) excluding hits from
+    channels that were issued test pulses. With ``sparse``, the distributions are kept in
+    a ``SparseAdcHistogram``.
+    '''
+    def __init__(self, adc_min=0, adc_max=256, adc_step=2, sparse=False):
+        if sparse:
+            self.adc_hist = SparseAdcHistogram(adc_min=adc_min, adc_max=adc_max,
+                                               adc_step=adc_step)
+        else:
+            self.adc_hist = AdcHistogram(adc_min=adc_min, adc_max=adc_max,
+                                         adc_step=adc_step)
+        PulsedChannelTracker.__init__(self, *self.adc_hist.shape[:2])
+        self.n_packets_cut = 0
+
+    def read(self, trans, hits):
+        pulsed = self.is_pulsed(hits)
+        self.n_packets_cut += np.count_nonzero(pulsed)
+        self.adc_hist.fill(hits['chipid'][~pulsed], hits['channelid'][~pulsed],
+                           hits['adc'][~pulsed])
+
+    def flush(self):
+        self.adc_hist.flush()
+
+    def finish(self):
+        '''Flushes the histogram buffer and drops the per-file configuration state'''
+        self.flush()
+        self.reset()
+
+    def merge(self, other):
+        self.adc_hist.merge(other.adc_hist)
+        self.n_packets_cut += other.n_packets_cut
+
+class PedestalDriftAccumulator(PulsedAdcAccumulator):
+    '''
+    Same as ``PulsedAdcAccumulator``, but also fills the adc distributions in bins of
+    block cpu time (``time_bin_width`` seconds, aligned to multiples of the width). The
+    ``counts`` array is indexed by ``[time bin, chip, channelid, adc bin]`` and only holds
+    the time bins and chips with data: entry ``i`` of the time axis is the time bin
+    starting at ``time_bins[i] * time_bin_width`` and the chip axis holds ``chipids``.
+    Each flush of the hit buffer is kept as a separate block of counts, the blocks are
+    only combined into ``counts`` when it is accessed.
     '''
-    la = LogAnalyzer(filename)
-    adc_dist = {}
+    def __init__(self, time_bin_width=600., adc_min=0, adc_max=256, adc_step=2,
+                 n_channels=32, buffer_size=1000000):
+        PulsedAdcAccumulator.__init__(self, adc_min=adc_min, adc_max=adc_max,
+                                      adc_step=adc_step)
+        self.time_bin_width = float(time_bin_width)
+        self._time_bins = np.zeros(0, dtype=np.int64)
+        self._chipids = np.zeros(0, dtype=np.int64)
+        self._counts = np.zeros((0, 0, n_channels, self.adc_hist.n_bins), dtype=np.int64)
+        self._blocks = []
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffer_len = 0
+
+    def read(self, trans, hits):
+        pulsed = self.is_pulsed(hits)
+        self.n_packets_cut += np.count_nonzero(pulsed)
+        chipids = hits['chipid'][~pulsed]
+        channelids = hits['channelid'][~pulsed]
+        adcs = hits['adc'][~pulsed]
+        self.adc_hist.fill(chipids, channelids, adcs)
+        bin_idx = np.digitize(adcs, self.adc_hist.bins) - 1
+        valid = (bin_idx >= 0) & (bin_idx < self.adc_hist.n_bins) & \
+            (channelids < self._counts.shape[2])
+        time_bin = int(np.floor(trans['time'] / self.time_bin_width))
+        self._buffer.append(np.stack((np.full(np.count_nonzero(valid), time_bin),
+                                      chipids[valid], channelids[valid], bin_idx[valid])))
+        self._buffer_len += self._buffer[-1].shape[1]
+        if self._buffer_len >= self.buffer_size:
+            self.flush()
+
+    def _combine(self):
+        '''Adds the blocks of counts to ``counts``, reallocating it once to cover them'''
+        if not self._blocks:
+            return
+        blocks = [(self._time_bins, self._chipids, self._counts)] + self._blocks
+        self._blocks = []
+        time_bins = np.unique(np.concatenate([block[0] for block in blocks]))
+        chipids = np.unique(np.concatenate([block[1] for block in blocks]))
+        self._counts = np.zeros((len(time_bins), len(chipids)) + self._counts.shape[2:],
+                                dtype=np.int64)
+        for block_time_bins, block_chipids, counts in blocks:
+            time_idx = np.searchsorted(time_bins, block_time_bins)
+            chip_idx = np.searchsorted(chipids, block_chipids)
+            self._counts[time_idx[:,np.newaxis],chip_idx] += counts
+        self._time_bins = time_bins
+        self._chipids = chipids
+
+    def flush(self):
+        '''Adds the buffered hits to the time binned counts'''
+        PulsedAdcAccumulator.flush(self)
+        if not self._buffer:
+            return
+        time_bin, chipid, channelid, bin_idx = np.concatenate(self._buffer, axis=1)
+        self._buffer = []
+        self._buffer_len = 0
+        if len(time_bin) == 0:
+            return
+        time_bins, time_idx = np.unique(time_bin, return_inverse=True)
+        chipids, chip_idx = np.unique(chipid, return_inverse=True)
+        shape = (len(time_bins), len(chipids)) + self._counts.shape[2:]
+        flat_idx = np.ravel_multi_index((time_idx, chip_idx, channelid, bin_idx), shape)
+        self._blocks.append((time_bins, chipids, np.bincount(
+                    flat_idx, minlength=int(np.prod(shape))).reshape(shape)))
+
+    @property
+    def counts(self):
+        self.flush()
+        self._combine()
+        return self._counts
+
+    @property
+    def time_bins(self):
+        self.flush()
+        self._combine()
+        return self._time_bins
+
+    @property
+    def chipids(self):
+        self.flush()
+        self._combine()
+        return self._chipids
+
+    def time_bin_start(self):
+        '''Returns the start time of each time bin of ``counts``'''
+        return self.time_bins * self.time_bin_width
+
+    def merge(self, other):
+        if self.time_bin_width != other.time_bin_width:
+            raise ValueError('cannot merge drift accumulators with different time bins')
+        PulsedAdcAccumulator.merge(self, other)
+        if other.counts.shape[0]:
+            self._blocks.append((other.time_bins, other.chipids, other.counts))
+
+def decode_hits(packets, words=None):
+    '''
+    Returns the good packets of a transmission and their chip id, channel id and adc. If
+    the raw ``words`` of the packets are given (see ``packet_cache.stream_words``), all
+    packets are checked and decoded at once.
+    '''
+    if isinstance(packets, packet_cache.CachedPackets):
+        return packet_cache.good_hits(packets)
+    if not words is None:
+        return packet_cache.word_hits(packets, words)
+    good_packets = [packet for packet in packets if is_good_packet(packet)]
+    return {
+        'packets': good_packets,
+        'chipid': np.array([packet.chipid for packet in good_packets], dtype=np.int64),
+        'channelid': np.array([packet.channel_id for packet in good_packets],
+                              dtype=np.int64),
+        'adc': np.array([packet.dataword for packet in good_packets], dtype=np.int64)
+        }
+
+def extract_calibration_data(filename, accumulators, max_trans=None, verbose=False,
+                             use_cache=False, start_block=0, chips_silenced=False):
+    '''
+    Reads the file once, decoding each transmission a single time and passing it to each
+    of the accumulators:
+
+        ``accumulator.write(trans)`` is called for each configuration write transmission
+        ``accumulator.read(trans, hits)`` is called for each good read transmission with
+        the decoded good packets (see ``decode_hits``). If
+        ``accumulator.requires_silenced``, data before the first write command (assumed
+        to be a silence command) is skipped.
+
+    The pass stops early once ``accumulator.done`` is set for all accumulators.
+
+    If ``use_cache``, the decoded packets are read from the file's packet cache (see
+    ``helpers.packet_cache``), which is built on first use.
+    To continue a previous pass, ``start_block`` is the first block to process and
+    ``chips_silenced`` whether a write command was already seen. The returned loop data
+    includes the same values for the next pass (``n_blocks``, ``chips_silenced``).
+    '''
+    if use_cache:
+        transmissions = packet_cache.iter_transmissions(
+            packet_cache.load_packet_cache(filename, verbose=verbose), start=start_block)
+    else:
+        transmissions = packet_cache.read_transmissions(filename, start=start_block)
     loop_data = {
         'n_trans': 0,
         'n_trans_cut': 0,
         'n_packets': 0,
         'n_packets_cut': 0
         }
-    chips_silenced = False # cuts out all data before first write command
-    chip_conf = {} # keep track of chip configuration commands sent
-    pulsed_chip_channels = {} # keeps track of channels with test pulser enabled
-    while True:
-        curr_trans = la.next_transmission()
-        if curr_trans is None: break
+    for curr_trans in transmissions:
         if loop_data['n_trans'] == max_trans: break
         loop_data['n_trans'] += 1
         if verbose and loop_data['n_trans'] % 100 == 0:
@@ -239,150 +1219,510 @@ def extract_pulsed_adc_dist(filename, adc_max=256, adc_min=0, adc_step=2, max_tr
                   (loop_data['n_trans'], loop_data['n_trans_cut'], loop_data['n_packets'],
                    loop_data['n_packets_cut']), end='')
             sys.stdout.flush()
-        if curr_trans['block_type'] is 'data' and curr_trans['data_type'] is 'write':
+        if curr_trans['block_type'] == 'data' and curr_trans['data_type'] == 'write':
             chips_silenced = True # assumes first write is a silence command
-
-            testpulse_conf_flag = False # marks if testpulse enable configuration has changed
-            for packet_idx, packet in enumerate(curr_trans['packets']):
-                if packet.packet_type == larpix.Packet.CONFIG_READ_PACKET:
-                    continue
-                # update configuration with new packets
-                packet_dict = {packet.register_address: packet.register_data}
-                try:
-                    chip_conf[packet.chipid].from_dict_registers(packet_dict)
-                except KeyError:
-                    chip_conf[packet.chipid] = larpix.Configuration()
-                    chip_conf[packet.chipid].from_dict_registers(packet_dict)
-
-                if packet.register_address in larpix.Configuration.csa_testpulse_enable_addresses:
-                    # change test pulse configuration
-                    testpulse_conf_flag = True
-                    pulsed_chip_channels = {} # reset pulsed channels
-            if testpulse_conf_flag:
-                for chipid, conf in chip_conf.items():
-                    if any([value == 0 for value in conf.csa_testpulse_enable]):
-                        pulsed_chip_channels[chipid] = [channel
-                                                        for channel, value in enumerate(conf.csa_testpulse_enable)
-                                                        if value == 0]
+            for accumulator in accumulators:
+                accumulator.write(curr_trans)
         if not is_good_data(curr_trans):
             loop_data['n_trans_cut'] += 1
             continue
-        if not chips_silenced:
-            loop_data['n_trans_cut'] += 1
-            continue
         loop_data['n_packets'] += len(curr_trans['packets'])
-        for packet in curr_trans['packets']:
-            if not is_good_packet(packet):
-                loop_data['n_packets_cut'] += 1
-                continue
-            if (packet.chipid in pulsed_chip_channels.keys() and
-                packet.channel_id in pulsed_chip_channels[packet.chipid]):
-                loop_data['n_packets_cut'] += 1
+        hits = decode_hits(curr_trans['packets'], curr_trans.get('words'))
+        loop_data['n_packets_cut'] += len(curr_trans['packets']) - len(hits['packets'])
+        for accumulator in accumulators:
+            if accumulator.requires_silenced and not chips_silenced:
                 continue
-            chip_id = str(packet.chipid)
-            channel_id = str(packet.channel_id)
-            adc = packet.dataword
-            try:
-                hist, bins = adc_dist[chip_id][channel_id]
-                try:
-                    hist[np.digitize(adc, bins)-1] += 1
-                except IndexError:
-                    print('adc value %d from c%s-ch%s invalid' % (adc, chip_id, channel_id))
-            except KeyError:
-                try:
-                    bins = good_bins([], step=adc_step, min_v=adc_min, max_v=adc_max)
-                    adc_dist[chip_id][channel_id] = np.histogram([adc], bins)
-                except KeyError:
-                    # Entry for chip has not been created
-                    bins = good_bins([], step=adc_step, min_v=adc_min, max_v=adc_max)
-                    adc_dist[chip_id] = {
-                        channel_id : np.histogram([adc], bins)
-                        }
+            accumulator.read(curr_trans, hits)
+        if all(accumulator.done for accumulator in accumulators):
+            if verbose:
+                print('')
+                print('No new data needed, stopping after %d transmissions' %
+                      loop_data['n_trans'])
+            break
+    loop_data['n_blocks'] = start_block + loop_data['n_trans']
+    loop_data['chips_silenced'] = chips_silenced
     print('')
     print(' N_transmissions: %4d, N_transmissions removed: %4d' % (
             loop_data['n_trans'], loop_data['n_trans_cut']))
     print(' N_packets: %4d, N_packets removed: %4d' % (
             loop_data['n_packets'], loop_data['n_packets_cut']))
-    return adc_dist
+    return loop_data
 
-def do_pedestal_calibration(infile, vref=None, vcm=None, verbose=False):
-    adc_max = 257
-    adc_min = -1
-    adc_step = 2
+def extract_chip_channel_ids(filename, max_trans=None, verbose=False,
+                             max_idle_blocks=None):
+    accumulator = ChipChannelIdAccumulator(max_idle_blocks=max_idle_blocks)
+    extract_calibration_data(filename, [accumulator], max_trans=max_trans, verbose=verbose)
+    return accumulator.chip_channel_ids
 
-    pedestal_data = {}
+def extract_chip_rel_timing(filename, verbose=False, max_trans=None):
+    '''
+    Returns the statistics of the time difference between packets from different chips
+    (see ``RelTimingAccumulator.pair_stats``)
+    '''
+    accumulator = RelTimingAccumulator()
+    extract_calibration_data(filename, [accumulator], max_trans=max_trans, verbose=verbose)
+    return accumulator.pair_stats()
 
-    # Get distributions of adc values
+def extract_pulsed_adc_dist(filename, adc_max=256, adc_min=0, adc_step=2, max_trans=None,
+                            verbose=False):
+    '''
+    Extracts adc distributions for each chip and channel excluding hits from channels that
+    were issued test pulses
+    '''
+    accumulator = PulsedAdcAccumulator(adc_min=adc_min, adc_max=adc_max, adc_step=adc_step)
+    extract_calibration_data(filename, [accumulator], max_trans=max_trans, verbose=verbose)
+    return accumulator.adc_hist.to_dict()
+
+pedestal_adc_max = 257
+pedestal_adc_min = -1
+pedestal_adc_step = 2
+
+pedestal_fit_choices = ['gaussian', 'gaussian_background']
+
+def pedestal_calibration(adc_hist, vref=None, vcm=None, verbose=False, fit=None,
+                         robust=False, n_bootstrap=0, jobs=1):
+    '''
+    Calculates the pedestal calibration of every channel with entries in an
+    ``AdcHistogram``, finding the peaks of all channels at once. If ``fit`` is one of
+    ``pedestal_fit_choices``, the pedestal mean and sigma are taken from a gaussian fit
+    (see ``fit_gaussians``) for the channels where it converged, and the fit chi2/ndf
+    and convergence are stored as ``pedestal_fit_chi2_ndf`` and
+    ``pedestal_fit_converged``. If ``robust``, the pedestal mean and sigma are the
+    median and MAD based sigma (see ``robust_peak_values``), which are also stored with
+    the tail fractions as ``pedestal_adc_median``, ``pedestal_adc_mad_sigma``,
+    ``pedestal_tail_low`` and ``pedestal_tail_high``. If ``n_bootstrap`` > 0, the
+    uncertainties of the pedestal values are estimated from that many bootstrap replicas
+    (using ``jobs`` processes, see ``bootstrap_peak_values``) and stored as
+    ``<field>_err``.
+    '''
+    chipids, channelids = adc_hist.channels()
+    adc_counts = adc_hist.channel_counts(chipids, channelids)
+    adc_bins = adc_hist.bins
     if verbose:
-        print('Begin pedestal calibration')
-        print('Extracting data from %s' % infile)
-    adc_dist = extract_pulsed_adc_dist(infile, adc_max, adc_min, adc_step, verbose=verbose)
+        print('Calculating from %d adc dists' % len(chipids))
+    # Fit adc distributions
+    adc_peak_values = pedestal_peak_values(adc_counts, adc_bins, fit=fit, robust=robust)
+    if not fit is None and verbose:
+        print('%d of %d fits converged' % (np.count_nonzero(
+                    adc_peak_values['fit_converged']), len(adc_counts)))
+    if verbose and not np.all(adc_peak_values['valid']):
+        print('Skipping %d channels without a valid pedestal peak' % np.count_nonzero(
+                ~adc_peak_values['valid']))
+    errors = None
+    if n_bootstrap > 0:
+        if verbose:
+            print('Calculating uncertainties from %d bootstrap replicas' % n_bootstrap)
+        errors = bootstrap_peak_values(adc_counts, adc_bins, n_replicas=n_bootstrap,
+                                       fit=fit, robust=robust, jobs=jobs)
+    return pedestal_cal_data(chipids, channelids, adc_peak_values, vref=vref, vcm=vcm,
+                             errors=errors, fit=fit, robust=robust)
 
-    for chipid in adc_dist:
-        for channelid in adc_dist[chipid]:
-            # Fit adc distributions
-            if verbose:
-                print('Calculating from c%s-ch%s adc dist' % (chipid, channelid))
-            adc_peak_values = get_peak_values(adc_dist[chipid][channelid])
-            try:
-                pedestal_data[chipid][channelid] = {
-                    'pedestal_adc': adc_peak_values['mean'],
-                    'pedestal_adc_sigma': adc_peak_values['sigma']
-                    }
-            except KeyError:
-                pedestal_data[chipid] = { channelid: {
-                        'pedestal_adc': adc_peak_values['mean'],
-                        'pedestal_adc_sigma': adc_peak_values['sigma']
-                        }}
+def pedestal_voltages(peak_values, vref, vcm):
+    '''
+    Returns the pedestal mean and sigma in V of the adc ``peak_values`` (see
+    ``pedestal_peak_values``)
+    '''
+    # adc_to_v is linear, so the voltage distribution is the adc distribution with
+    # transformed bin edges -> its peak values follow from the adc peak values
+    v_mean = adc_to_v(peak_values['mean'], vref, vcm)
+    v_sigma = peak_values['sigma'] * abs(adc_to_v(1, vref, vcm) - adc_to_v(0, vref, vcm))
+    return v_mean, v_sigma
 
-            # Calculate voltage distributions
-            if not vref is None and not vcm is None:
-                try:
-                    pedestal_data[chipid][channelid]['pedestal_vref'] = vref
-                    pedestal_data[chipid][channelid]['pedestal_vcm'] = vcm
-                except KeyError:
-                    pedestal_data[chipid] = { channelid: {
-                            'pedestal_vref': vref,
-                            'pedestal_vcm': vcm
-                            }}
-                adc_hist, adc_bins = adc_dist[chipid][channelid]
-                v_bins = np.array([adc_to_v(bin, vref, vcm) for bin in adc_bins],
-                                  dtype=float)
-                v_dist, v_bins = np.histogram([], v_bins)
-                for bin_idx, bin in enumerate(adc_bins[:-1]):
-                    v = adc_to_v(bin, vref, vcm)
-                    v_dist[np.digitize(v, v_bins)-1] += adc_hist[bin_idx]
-                v_peak_values = get_peak_values((v_dist, v_bins))
-                pedestal_data[chipid][channelid]['pedestal_v'] = v_peak_values['mean']
-                pedestal_data[chipid][channelid]['pedestal_v_sigma'] = v_peak_values['sigma']
+def pedestal_cal_data(chipids, channelids, peak_values, vref=None, vcm=None,
+                      voltages=None, errors=None, fit=None, robust=False):
+    '''
+    Builds the nested pedestal calibration data (see ``pedestal_calibration``) of the
+    channels ``chipids``, ``channelids`` from their ``peak_values`` (see
+    ``pedestal_peak_values``), skipping the channels without a valid pedestal. The
+    voltages are only stored if ``vref`` and ``vcm`` are given, ``voltages`` can hold
+    the result of ``pedestal_voltages`` if it was already calculated. ``errors`` are the
+    bootstrap uncertainties (see ``bootstrap_peak_values``), if any.
+    '''
+    pedestal_data = {}
+    if not vref is None and not vcm is None:
+        if voltages is None:
+            voltages = pedestal_voltages(peak_values, vref, vcm)
+        v_mean, v_sigma = voltages
+        v_per_adc = abs(adc_to_v(1, vref, vcm) - adc_to_v(0, vref, vcm))
+    for idx, (chipid, channelid) in enumerate(zip(chipids, channelids)):
+        if not peak_values['valid'][idx]:
+            continue
+        chipid = str(chipid)
+        channelid = str(channelid)
+        try:
+            pedestal_data[chipid][channelid] = {
+                'pedestal_adc': float(peak_values['mean'][idx]),
+                'pedestal_adc_sigma': float(peak_values['sigma'][idx])
+                }
+        except KeyError:
+            pedestal_data[chipid] = { channelid: {
+                    'pedestal_adc': float(peak_values['mean'][idx]),
+                    'pedestal_adc_sigma': float(peak_values['sigma'][idx])
+                    }}
+        if not errors is None:
+            pedestal_data[chipid][channelid]['pedestal_adc_err'] = \
+                float(errors['mean'][idx])
+            pedestal_data[chipid][channelid]['pedestal_adc_sigma_err'] = \
+                float(errors['sigma'][idx])
+        if not fit is None:
+            pedestal_data[chipid][channelid]['pedestal_fit_chi2_ndf'] = \
+                float(peak_values['fit_chi2_ndf'][idx])
+            pedestal_data[chipid][channelid]['pedestal_fit_converged'] = \
+                int(peak_values['fit_converged'][idx])
+        if robust:
+            pedestal_data[chipid][channelid]['pedestal_adc_median'] = \
+                float(peak_values['median'][idx])
+            pedestal_data[chipid][channelid]['pedestal_adc_mad_sigma'] = \
+                float(peak_values['mad_sigma'][idx])
+            pedestal_data[chipid][channelid]['pedestal_tail_low'] = \
+                float(peak_values['tail_low'][idx])
+            pedestal_data[chipid][channelid]['pedestal_tail_high'] = \
+                float(peak_values['tail_high'][idx])
+
+        # Calculate voltage distributions
+        if not vref is None and not vcm is None:
+            pedestal_data[chipid][channelid]['pedestal_vref'] = vref
+            pedestal_data[chipid][channelid]['pedestal_vcm'] = vcm
+            pedestal_data[chipid][channelid]['pedestal_v'] = float(v_mean[idx])
+            pedestal_data[chipid][channelid]['pedestal_v_sigma'] = float(v_sigma[idx])
+            if not errors is None:
+                pedestal_data[chipid][channelid]['pedestal_v_err'] = \
+                    float(errors['mean'][idx] * v_per_adc)
+                pedestal_data[chipid][channelid]['pedestal_v_sigma_err'] = \
+                    float(errors['sigma'][idx] * v_per_adc)
 
     return pedestal_data
 
-def do_gain_calibration(infile, vref=None, vcm=None, verbose=False):
+def pedestal_drift(drift, vref=None, vcm=None, fit=None, min_entries=1, robust=False):
+    '''
+    Calculates the pedestal of each channel in each time bin of a filled
+    ``PedestalDriftAccumulator`` (all bins at once, see ``pedestal_calibration`` for
+    ``fit`` and ``robust``). Returns a drift table as a dict of columns with one row per
+    time bin and channel with at least ``min_entries`` hits and a valid pedestal:
+
+        ``time_start``, ``time_end``: time bin edges (cpu time s)
+        ``chipid``, ``channelid``, ``n``: channel and number of hits in the time bin
+        ``pedestal_adc``, ``pedestal_adc_sigma``: pedestal within the time bin
+        ``drift_adc``: pedestal relative to the pedestal of the whole run
+        ``pedestal_v``, ``pedestal_v_sigma``: (only if ``vref`` and ``vcm`` are given)
+
+    '''
+    counts = drift.counts
+    bins = drift.adc_hist.bins
+    n_entries = counts.sum(axis=-1)
+    time_idx, chip_idx, channelids = np.nonzero(n_entries >= max(min_entries, 1))
+    chipids = drift.chipids[chip_idx]
+    dists = counts[time_idx, chip_idx, channelids]
+    # pedestal of the whole run for each selected channel
+    run_chipids, run_channelids = drift.adc_hist.channels()
+    run_counts = drift.adc_hist.channel_counts(run_chipids, run_channelids)
+    run_idx = np.searchsorted(run_chipids * counts.shape[2] + run_channelids,
+                              chipids * counts.shape[2] + channelids)
+    peak_values = pedestal_peak_values(np.concatenate((dists, run_counts)), bins, fit=fit,
+                                       robust=robust)
+    # only keep the time bins with a valid pedestal
+    valid = peak_values['valid'][:len(dists)]
+    time_idx, chip_idx, channelids = time_idx[valid], chip_idx[valid], channelids[valid]
+    chipids, run_idx = chipids[valid], run_idx[valid]
+    mean = peak_values['mean'][:len(dists)][valid]
+    sigma = peak_values['sigma'][:len(dists)][valid]
+    run_mean = peak_values['mean'][len(dists):]
+    time_start = drift.time_bin_start()[time_idx]
+    drift_table = {
+        'time_start': time_start,
+        'time_end': time_start + drift.time_bin_width,
+        'chipid': chipids,
+        'channelid': channelids,
+        'n': n_entries[time_idx, chip_idx, channelids],
+        'pedestal_adc': mean,
+        'pedestal_adc_sigma': sigma,
+        'drift_adc': mean - run_mean[run_idx]
+        }
+    if not vref is None and not vcm is None:
+        drift_table['pedestal_v'] = adc_to_v(mean, vref, vcm)
+        drift_table['pedestal_v_sigma'] = sigma * abs(adc_to_v(1, vref, vcm) -
+                                                      adc_to_v(0, vref, vcm))
+    return drift_table
+
+def gain_calibration(seen, vref=None, vcm=None):
+    '''
+    Calculates the gain calibration for each chip and channel found (``seen[chipid,
+    channelid]``)
+    '''
     if vref is None or vcm is None:
         return {}
     gain_data = {}
-    id_data = extract_chip_channel_ids(infile, verbose=verbose)
-    for chip_id in id_data:
-        for channel_id in id_data[chip_id]:
-            gain_e = 250. # e/mv
-            gain_v = adc_to_v(1, vref, vcm) - adc_to_v(0, vref, vcm) # v/adc
-            gain_vcm = adc_to_v(0, vref, vcm) # v offset
+    gain_e = 250. # e/mv
+    gain_v = adc_to_v(1, vref, vcm) - adc_to_v(0, vref, vcm) # v/adc
+    gain_vcm = adc_to_v(0, vref, vcm) # v offset
+    for chip_id, channel_id in zip(*np.nonzero(seen)):
+        channel_data = {
+            'gain_v' : gain_v,
+            'gain_e' : gain_e,
+            'gain_vcm' : gain_vcm
+            }
+        try:
+            gain_data[str(chip_id)][str(channel_id)] = channel_data
+        except KeyError:
+            gain_data[str(chip_id)] = { str(channel_id) : channel_data }
+    return gain_data
+
+def timing_calibration(rel_timing, verbose=False):
+    '''
+    Calculates a relative time offset for each chip from the pairwise time differences in
+    a ``RelTimingAccumulator``. Each pair measures ``dt = ns(prev_chip) - ns(chip) =
+    offset(prev_chip) - offset(chip)``, using the median of the pair's dt histogram (or the
+    mean if the median is out of range). The offsets are found with a weighted least
+    squares fit relative to the lowest chip id (offset 0), chips that are not linked to it
+    get zero mean offsets. Subtract ``timing_offset_ns`` from a chip's timestamps to align
+    it with the reference chip.
+    '''
+    rel_timing.flush()
+    chipids, prev_chipids = np.nonzero(rel_timing.n)
+    if len(chipids) == 0:
+        return {}
+    medians = dt_hist_medians(rel_timing.dt_hist, rel_timing.dt_bin_edges)
+    n = rel_timing.n[chipids, prev_chipids]
+    dt = np.array([medians.get(pair, np.nan) for pair in zip(chipids, prev_chipids)])
+    dt = np.where(np.isnan(dt), rel_timing.mean[chipids, prev_chipids], dt)
+    sigma = np.sqrt(rel_timing.m2[chipids, prev_chipids] / n)
+    weight = np.sqrt(n) / np.maximum(sigma, 1.)
+    chips = np.unique(np.concatenate((chipids, prev_chipids)))
+    chip_idx = dict((chip, idx) for idx, chip in enumerate(chips))
+    # rows: one per pair + reference constraint
+    design = np.zeros((len(n) + 1, len(chips)))
+    rows = np.arange(len(n))
+    design[rows, [chip_idx[chip] for chip in prev_chipids]] += weight
+    design[rows, [chip_idx[chip] for chip in chipids]] -= weight
+    design[-1, 0] = weight.sum()
+    offsets = np.linalg.lstsq(design, np.append(dt * weight, 0.), rcond=None)[0]
+    if verbose:
+        for chip, offset in zip(chips, offsets):
+            print('c%d timing offset: %.1f ns' % (chip, offset))
+    timing_data = {}
+    for chip, offset in zip(chips, offsets):
+        for channel in np.flatnonzero(rel_timing.seen[chip]):
+            channel_data = {
+                'timing_offset_ns': float(offset),
+                'timing_ref_chipid': int(chips[0])
+                }
             try:
-                gain_data[chip_id][channel_id] = {
-                    'gain_v' : gain_v,
-                    'gain_e' : gain_e,
-                    'gain_vcm' : gain_vcm
-                    }
+                timing_data[str(chip)][str(channel)] = channel_data
             except KeyError:
-                gain_data[chip_id] = { channel_id : {
-                        'gain_v' : gain_v,
-                        'gain_e' : gain_e,
-                        'gain_vcm' : gain_vcm
-                        }}
-    return gain_data
+                timing_data[str(chip)] = { str(channel): channel_data }
+    return timing_data
 
-def do_timing_calibration(infile, verbose=False):
-    pass
+def make_accumulators(calibration_types, vref=None, vcm=None, max_idle_blocks=None,
+                      adc_step=pedestal_adc_step, sparse=False):
+    '''
+    Returns the accumulators needed for each requested calibration type, the pedestal adc
+    distributions are binned in ``adc_step`` adc counts (sparse if ``sparse``)
+    '''
+    accumulators = {}
+    if 'pedestal' in calibration_types:
+        accumulators['pedestal'] = PulsedAdcAccumulator(adc_min=pedestal_adc_min,
+                                                        adc_max=pedestal_adc_max,
+                                                        adc_step=adc_step, sparse=sparse)
+    if 'gain' in calibration_types and not vref is None and not vcm is None:
+        accumulators['gain'] = ChipChannelIdAccumulator(max_idle_blocks=max_idle_blocks)
+    if 'timing' in calibration_types:
+        accumulators['timing'] = RelTimingAccumulator()
+    return accumulators
+
+def finish_calibrations(accumulators, calibration_types, vref=None, vcm=None,
+                        verbose=False, pedestal_fit=None, pedestal_robust=False,
+                        pedestal_bootstrap=0, jobs=1):
+    '''
+    Calculates the calibration data of each type from filled accumulators, returns a list
+    of calibration data in the order of ``calibration_types``
+    '''
+    cal_data = []
+    for calibration_type in calibration_types:
+        if calibration_type == 'pedestal':
+            cal_data.append(pedestal_calibration(accumulators['pedestal'].adc_hist,
+                                                 vref=vref, vcm=vcm, verbose=verbose,
+                                                 fit=pedestal_fit,
+                                                 robust=pedestal_robust,
+                                                 n_bootstrap=pedestal_bootstrap,
+                                                 jobs=jobs))
+        elif calibration_type == 'gain':
+            if not 'gain' in accumulators:
+                cal_data.append({})
+                continue
+            cal_data.append(gain_calibration(accumulators['gain'].seen,
+                                             vref=vref, vcm=vcm))
+        elif calibration_type == 'timing':
+            cal_data.append(timing_calibration(accumulators['timing'], verbose=verbose))
+    return cal_data
 
+def extract_accumulators(infile, calibration_types, vref=None, vcm=None, verbose=False,
+                         use_cache=False, max_idle_blocks=None, adc_step=pedestal_adc_step,
+                         sparse=False):
+    '''
+    Fills the accumulators for each of the requested calibration types with a single pass
+    over the file. The returned accumulators only hold mergeable state (see
+    ``merge_accumulators``), so this can be run in a worker process.
+    '''
+    return update_accumulators(infile, calibration_types, vref=vref, vcm=vcm,
+                               verbose=verbose, use_cache=use_cache,
+                               max_idle_blocks=max_idle_blocks, adc_step=adc_step,
+                               sparse=sparse)[0]
+
+checkpoint_version = 1
 
+def file_prefix_hash(filename, size, chunk_size=1 << 20):
+    '''Returns the sha1 hash of the first ``size`` bytes of a file'''
+    return packet_cache.file_hash(filename, size=size, chunk_size=chunk_size)
+
+def is_resumable(file_state, infile, accumulator_types, settings, verbose=False):
+    '''
+    Checks that a file was only appended to since ``file_state`` was saved and that the
+    saved accumulators are the ones needed (made with the same ``settings``, see
+    ``update_accumulators``)
+    '''
+    if file_state is None:
+        return False
+    if sorted(file_state['accumulator_types']) != sorted(accumulator_types):
+        return False
+    if file_state.get('settings') != settings:
+        if verbose:
+            print('Accumulator settings of %s changed since the checkpoint (%s, now %s), '
+                  'processing the whole file' % (infile, file_state.get('settings'),
+                                                 settings))
+        return False
+    if os.path.getsize(infile) < file_state['size']:
+        return False
+    return file_prefix_hash(infile, file_state['size']) == file_state['sha1']
+
+def update_accumulators(infile, calibration_types, file_state=None, vref=None, vcm=None,
+                        verbose=False, use_cache=False, max_idle_blocks=None,
+                        adc_step=pedestal_adc_step, sparse=False):
+    '''
+    Same as ``extract_accumulators``, but resumes from ``file_state`` (a previous result
+    of this function for the same file) if the file has only been appended to since, so
+    that only new blocks are processed. Returns the accumulators and the new file state:
+
+        ``size``, ``mtime``, ``sha1``: size, mtime and hash of the processed file
+        ``n_blocks``: number of blocks processed
+        ``chips_silenced``: if a write command has been seen
+        ``accumulator_types``: calibration types of the accumulators
+        ``settings``: settings of the accumulators (``adc_step``, ``sparse``,
+        ``max_idle_blocks``)
+        ``accumulators``: pickled accumulators (before ``finish``)
+
+    '''
+    accumulators = make_accumulators(calibration_types, vref=vref, vcm=vcm,
+                                     max_idle_blocks=max_idle_blocks, adc_step=adc_step,
+                                     sparse=sparse)
+    settings = {
+        'adc_step': adc_step,
+        'sparse': sparse,
+        'max_idle_blocks': max_idle_blocks
+        }
+    stat = os.stat(infile)
+    if is_resumable(file_state, infile, accumulators.keys(), settings, verbose=verbose):
+        if file_state['size'] == stat.st_size and file_state['mtime'] == stat.st_mtime:
+            # file unchanged
+            if verbose:
+                print('No new data in %s' % infile)
+            accumulators = pickle.loads(file_state['accumulators'])
+            for accumulator in accumulators.values():
+                accumulator.finish()
+            return accumulators, file_state
+        accumulators = pickle.loads(file_state['accumulators'])
+        start_block = file_state['n_blocks']
+        chips_silenced = file_state['chips_silenced']
+        if verbose:
+            print('Resuming %s from block %d' % (infile, start_block))
+    else:
+        start_block = 0
+        chips_silenced = False
+    loop_data = {
+        'n_blocks': start_block,
+        'chips_silenced': chips_silenced
+        }
+    if accumulators:
+        if verbose:
+            print('Extracting data from %s' % infile)
+        loop_data = extract_calibration_data(infile, list(accumulators.values()),
+                                             verbose=verbose, use_cache=use_cache,
+                                             start_block=start_block,
+                                             chips_silenced=chips_silenced)
+    for accumulator in accumulators.values():
+        accumulator.flush()
+    new_file_state = {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha1': file_prefix_hash(infile, stat.st_size),
+        'n_blocks': loop_data['n_blocks'],
+        'chips_silenced': loop_data['chips_silenced'],
+        'accumulator_types': list(accumulators.keys()),
+        'settings': settings,
+        'accumulators': pickle.dumps(accumulators, protocol=pickle.HIGHEST_PROTOCOL)
+        }
+    for accumulator in accumulators.values():
+        accumulator.finish()
+    return accumulators, new_file_state
+
+def load_checkpoint(filename):
+    '''
+    Loads a calibration checkpoint (``{'version', 'files': {<abs path>: file_state}}``,
+    see ``update_accumulators``), returns an empty checkpoint if the file does not exist
+    or is not readable
+    '''
+    checkpoint = None
+    if os.path.isfile(filename):
+        try:
+            with open(filename, 'rb') as fi:
+                checkpoint = pickle.load(fi)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError) as error:
+            print('Could not load checkpoint %s: %s' % (filename, error))
+    if checkpoint is None or checkpoint.get('version') != checkpoint_version:
+        checkpoint = {
+            'version': checkpoint_version,
+            'files': {}
+            }
+    return checkpoint
+
+def save_checkpoint(filename, checkpoint):
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_file = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    with os.fdopen(fd, 'wb') as fo:
+        pickle.dump(checkpoint, fo, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file, filename)
+
+def merge_accumulators(accumulators, other_accumulators):
+    '''Merges the accumulators of another file into ``accumulators``'''
+    for calibration_type, accumulator in other_accumulators.items():
+        if calibration_type in accumulators:
+            accumulators[calibration_type].merge(accumulator)
+        else:
+            accumulators[calibration_type] = accumulator
+    return accumulators
+
+def do_calibrations(infile, calibration_types, vref=None, vcm=None, verbose=False,
+                    use_cache=False, max_idle_blocks=None, adc_step=pedestal_adc_step,
+                    sparse=False):
+    '''
+    Performs each of the requested calibrations (``'pedestal'``, ``'gain'``,
+    ``'timing'``) with a single pass over the file, returns a list of calibration data
+    in the order of ``calibration_types``
+    '''
+    accumulators = extract_accumulators(infile, calibration_types, vref=vref, vcm=vcm,
+                                        verbose=verbose, use_cache=use_cache,
+                                        max_idle_blocks=max_idle_blocks,
+                                        adc_step=adc_step, sparse=sparse)
+    return finish_calibrations(accumulators, calibration_types, vref=vref, vcm=vcm,
+                               verbose=verbose)
+
+def do_pedestal_calibration(infile, vref=None, vcm=None, verbose=False):
+    if verbose:
+        print('Begin pedestal calibration')
+    return do_calibrations(infile, ['pedestal'], vref=vref, vcm=vcm, verbose=verbose)[0]
+
+def do_gain_calibration(infile, vref=None, vcm=None, verbose=False, max_idle_blocks=None):
+    return do_calibrations(infile, ['gain'], vref=vref, vcm=vcm, verbose=verbose,
+                           max_idle_blocks=max_idle_blocks)[0]
+
+def do_timing_calibration(infile, verbose=False):
+    return do_calibrations(infile, ['timing'], verbose=verbose)[0]
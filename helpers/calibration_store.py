@@ -0,0 +1,190 @@
+'''
+Calibration data stored as dense arrays indexed by ``[chipid, channelid]``, one array
+and validity mask per calibration field, plus version/provenance metadata. Stores are
+saved as .npz files and can be converted to and from the nested calibration .json format
+(``cal_data[str(chipid)][str(channelid)][field]``, see run_calibration.py).
+Typical usage:
+``
+store = CalibrationStore.load('calib.npz') # or 'calib.json'
+arrays = store.arrays(['gain_v', 'gain_vcm', 'pedestal_v']) # nan if not calibrated
+pedestal_v = arrays['pedestal_v'][chipid, channelid]
+``
+The .npz file holds ``value_<field>`` and ``valid_<field>`` arrays for each field and
+the metadata as a json string (``metadata``).
+'''
+
+import os
+import json
+import time
+import tempfile
+import numpy as np
+
+store_version = 1
+
+class CalibrationStore(object):
+    def __init__(self, n_chips=256, n_channels=32, metadata=None):
+        self.shape = (n_chips, n_channels)
+        self.values = {}
+        self.valid = {}
+        self.metadata = {} if metadata is None else dict(metadata)
+
+    @property
+    def fields(self):
+        return sorted(self.values.keys())
+
+    def add_field(self, field, dtype=np.float64):
+        '''Adds an empty field (all channels invalid) if it does not exist yet'''
+        if not field in self.values:
+            fill_value = np.nan if np.dtype(dtype).kind == 'f' else 0
+            self.values[field] = np.full(self.shape, fill_value, dtype=dtype)
+            self.valid[field] = np.zeros(self.shape, dtype=bool)
+        return self.values[field]
+
+    def set_field(self, field, values, valid=None):
+        '''
+        Sets the values of a field where ``valid`` (default: all channels), keeping the
+        previous values elsewhere
+        '''
+        values = np.asarray(values)
+        if valid is None:
+            valid = np.ones(self.shape, dtype=bool)
+        dtype = values.dtype
+        if field in self.values:
+            dtype = np.result_type(self.values[field].dtype, values.dtype)
+        self.add_field(field, dtype=dtype)
+        if self.values[field].dtype != dtype:
+            self.values[field] = self.values[field].astype(dtype)
+        self.values[field][valid] = values[valid]
+        self.valid[field] |= valid
+
+    def update(self, other):
+        '''Overwrites the fields and channels that are valid in another store'''
+        for field in other.fields:
+            self.set_field(field, other.values[field], other.valid[field])
+        self.metadata.update(other.metadata)
+        return self
+
+    def update_dict(self, cal_data):
+        '''Overwrites the fields and channels present in nested calibration data'''
+        if cal_data is None:
+            return self
+        return self.update(CalibrationStore.from_dict(cal_data, n_chips=self.shape[0],
+                                                      n_channels=self.shape[1]))
+
+    def arrays(self, fields=None):
+        '''
+        Returns float arrays indexed by ``[chipid, channelid]`` for each field (nan if
+        not calibrated), as used by ``calibration.calibrated_voltages``
+        '''
+        if fields is None:
+            fields = self.fields
+        arrays = {}
+        for field in fields:
+            if field in self.values:
+                arrays[field] = np.where(self.valid[field],
+                                         self.values[field].astype(np.float64), np.nan)
+            else:
+                arrays[field] = np.full(self.shape, np.nan)
+        return arrays
+
+    def channels(self):
+        '''Returns the chip and channel ids with at least one valid field'''
+        any_valid = np.zeros(self.shape, dtype=bool)
+        for field in self.fields:
+            any_valid |= self.valid[field]
+        return np.nonzero(any_valid)
+
+    @classmethod
+    def from_dict(cls, cal_data, n_chips=256, n_channels=32, metadata=None):
+        '''
+        Creates a store from nested calibration data, fields with values that are not
+        numbers (or bools) are skipped
+        '''
+        store = cls(n_chips=n_chips, n_channels=n_channels, metadata=metadata)
+        entries = {}
+        for chipid in cal_data:
+            for channelid in cal_data[chipid]:
+                for field, value in cal_data[chipid][channelid].items():
+                    try:
+                        entries[field].append((int(chipid), int(channelid), value))
+                    except KeyError:
+                        entries[field] = [(int(chipid), int(channelid), value)]
+        for field, field_entries in entries.items():
+            chipids, channelids, values = zip(*field_entries)
+            values = np.array(values)
+            if not values.dtype.kind in 'biuf':
+                try:
+                    values = values.astype(np.float64)
+                except (TypeError, ValueError):
+                    print('Warning: skipping calibration field %s with non-numeric '
+                          'values' % field)
+                    continue
+            chipids = np.array(chipids)
+            channelids = np.array(channelids)
+            store.add_field(field, dtype=values.dtype)
+            store.values[field][chipids, channelids] = values
+            store.valid[field][chipids, channelids] = True
+        return store
+
+    def to_dict(self):
+        '''Returns the nested calibration data (json view) of the valid channels'''
+        cal_data = {}
+        for field in self.fields:
+            chipids, channelids = np.nonzero(self.valid[field])
+            values = self.values[field][chipids, channelids].tolist()
+            for chipid, channelid, value in zip(chipids.tolist(), channelids.tolist(),
+                                                values):
+                try:
+                    cal_data[str(chipid)][str(channelid)][field] = value
+                except KeyError:
+                    try:
+                        cal_data[str(chipid)][str(channelid)] = { field: value }
+                    except KeyError:
+                        cal_data[str(chipid)] = { str(channelid): { field: value }}
+        return cal_data
+
+    def save(self, filename):
+        '''Saves the store as .npz, or as nested calibration .json if ``filename`` ends
+        in .json (metadata is not saved)'''
+        directory = os.path.dirname(os.path.abspath(filename))
+        if os.path.splitext(filename)[1] == '.json':
+            fd, temp_file = tempfile.mkstemp(suffix='.json', dir=directory)
+            with os.fdopen(fd, 'w') as fo:
+                json.dump(self.to_dict(), fo, sort_keys=True, indent=4,
+                          separators=(',',': '))
+        else:
+            metadata = dict(self.metadata)
+            metadata['version'] = store_version
+            metadata['saved'] = time.time()
+            arrays = {'metadata': json.dumps(metadata, sort_keys=True)}
+            for field in self.fields:
+                arrays['value_' + field] = self.values[field]
+                arrays['valid_' + field] = self.valid[field]
+            fd, temp_file = tempfile.mkstemp(suffix='.npz', dir=directory)
+            with os.fdopen(fd, 'wb') as fo:
+                np.savez(fo, **arrays)
+        os.replace(temp_file, filename)
+
+    @classmethod
+    def load(cls, filename):
+        '''Loads a store from a .npz file or a nested calibration .json file'''
+        if os.path.splitext(filename)[1] == '.json':
+            with open(filename, 'r') as fi:
+                return cls.from_dict(json.load(fi))
+        with np.load(filename) as fi:
+            metadata = json.loads(str(fi['metadata']))
+            if metadata.get('version', 0) > store_version:
+                raise ValueError('calibration store version %s is not supported' %
+                                 metadata.get('version'))
+            store = None
+            for name in fi.files:
+                if not name.startswith('value_'):
+                    continue
+                field = name[len('value_'):]
+                if store is None:
+                    store = cls(*fi[name].shape, metadata=metadata)
+                store.values[field] = fi[name]
+                store.valid[field] = fi['valid_' + field]
+        if store is None:
+            store = cls(metadata=metadata)
+        return store
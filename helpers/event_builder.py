@@ -0,0 +1,119 @@
+'''
+Helper functions to group converted hits (rows of the ``dat2h5.py`` data table) into
+events. Hits are clustered in time: consecutive hits (sorted by full timestamp) that are
+separated by no more than ``time_window`` ns belong to the same event, and events with
+fewer than ``min_hits`` hits are dropped.
+Events are stored as ragged arrays: a hit table with the same columns as the input and
+an offset table such that event ``i`` is ``hits[offsets[i]:offsets[i+1]]``.
+Typical usage:
+``
+builder = EventBuilder(time_window=5000, min_hits=5)
+for chunk in sorted_chunks:
+    hits, offsets = builder.add(chunk)
+    append_events(group, hits, offsets)
+append_events(group, *builder.flush())
+``
+'''
+
+import numpy as np
+
+timestamp_column = 8 # full timestamp column of the dat2h5.py data table
+
+def find_event_starts(timestamps, time_window):
+    '''
+    Returns the index of the first hit of each event within an array of sorted
+    timestamps
+    '''
+    if len(timestamps) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(([0], np.flatnonzero(np.diff(timestamps) > time_window) + 1))
+
+def select_events(hits, starts, min_hits=1):
+    '''
+    Returns the hits and event offsets of the events (defined by ``starts``) with at
+    least ``min_hits`` hits
+    '''
+    n_hits = np.diff(np.append(starts, len(hits)))
+    keep = n_hits >= min_hits
+    offsets = np.zeros(np.count_nonzero(keep) + 1, dtype=np.int64)
+    np.cumsum(n_hits[keep], out=offsets[1:])
+    return hits[np.repeat(keep, n_hits)], offsets
+
+class EventBuilder(object):
+    '''
+    Streaming event builder. Each call to ``add`` takes a chunk of hits sorted by full
+    timestamp (following the previous chunk) and returns the events that are complete.
+    The last event of each chunk is held back since it may continue in the next chunk;
+    ``flush`` returns it at the end of the input.
+    '''
+    def __init__(self, time_window, min_hits=1, timestamp_column=timestamp_column):
+        self.time_window = time_window
+        self.min_hits = min_hits
+        self.timestamp_column = timestamp_column
+        self.pending = None
+
+    def add(self, hits):
+        if not self.pending is None:
+            hits = np.concatenate((self.pending, hits))
+        if len(hits) == 0:
+            self.pending = None
+            return hits, np.zeros(1, dtype=np.int64)
+        order = np.argsort(hits[:,self.timestamp_column], kind='stable')
+        hits = hits[order]
+        starts = find_event_starts(hits[:,self.timestamp_column], self.time_window)
+        self.pending = hits[starts[-1]:]
+        return select_events(hits[:starts[-1]], starts[:-1], self.min_hits)
+
+    def flush(self):
+        hits = self.pending
+        self.pending = None
+        if hits is None:
+            return np.zeros((0, 0), dtype=np.int64), np.zeros(1, dtype=np.int64)
+        return select_events(hits, np.zeros(1, dtype=np.int64), self.min_hits)
+
+def create_event_datasets(outfile, ncolumns, dtype=np.int64, time_window=None,
+                          min_hits=None, group_name='events'):
+    '''
+    Creates the (resizable) ``events/hits`` and ``events/offsets`` datasets in an open
+    h5py file, replacing any previous events
+    '''
+    if group_name in outfile:
+        del outfile[group_name]
+    group = outfile.create_group(group_name)
+    group.create_dataset('hits', shape=(0, ncolumns), maxshape=(None, ncolumns),
+                         chunks=(10000, ncolumns), dtype=dtype)
+    group.create_dataset('offsets', data=np.zeros(1, dtype=np.int64), maxshape=(None,),
+                         chunks=(10000,))
+    group.attrs['time_window'] = -1 if time_window is None else time_window
+    group.attrs['min_hits'] = -1 if min_hits is None else min_hits
+    group.attrs['description'] = '''
+    hits: same columns as data, grouped by event and sorted by full timestamp
+    offsets: event i is hits[offsets[i]:offsets[i+1]]'''
+    return group
+
+def append_events(group, hits, offsets):
+    '''Appends events (hits and local offsets) to the datasets in an events group'''
+    if len(offsets) <= 1:
+        return
+    hits_dset = group['hits']
+    offsets_dset = group['offsets']
+    n_hits = hits_dset.shape[0]
+    n_events = offsets_dset.shape[0] - 1
+    hits_dset.resize(n_hits + len(hits), axis=0)
+    hits_dset[n_hits:] = hits
+    offsets_dset.resize(n_events + len(offsets), axis=0)
+    offsets_dset[n_events+1:] = offsets[1:] + n_hits
+
+def build_events(outfile, data, time_window, min_hits=1, chunk_size=100000):
+    '''
+    Sorts the hits in ``data`` by full timestamp and writes the events to ``outfile``
+    (an open h5py file), ``chunk_size`` hits at a time. Returns the number of events.
+    '''
+    group = create_event_datasets(outfile, data.shape[1], dtype=data.dtype,
+                                  time_window=time_window, min_hits=min_hits)
+    builder = EventBuilder(time_window, min_hits)
+    order = np.argsort(data[:,builder.timestamp_column], kind='stable')
+    for start in range(0, len(order), chunk_size):
+        append_events(group, *builder.add(data[order[start:start+chunk_size]]))
+    append_events(group, *builder.flush())
+    return group['offsets'].shape[0] - 1
@@ -0,0 +1,129 @@
+'''
+Helper functions for the larpixgeometry sensor plane layouts used by larpix-scripts
+Typical usage:
+``
+pixels = load_compiled_geometry('28chip')
+pixelid = lookup(pixels['pixelid'], chipids, channels) # -1 if not connected
+``
+Compiled geometries are cached as .npz files in ``default_cache_dir()`` (keyed on the
+layout file name and its sha1 hash) so that the yaml layout only needs to be parsed
+once.
+'''
+
+import os
+import hashlib
+import tempfile
+import numpy as np
+from larpixgeometry.pixelplane import PixelPlane
+import larpixgeometry.layouts as layouts
+
+geom_choices = {'4chip': 'sensor_plane_28_simple.yaml',
+        '8chip': 'sensor_plane_28_8chip.yaml',
+        '28chip': 'sensor_plane_28_full.yaml'}
+
+n_chipids = 256
+n_channels = 32
+
+def load_geometry(name):
+    '''
+    Loads a sensor plane layout by its short name (one of ``geom_choices``) or by its
+    larpixgeometry layout file name
+    '''
+    return PixelPlane.fromDict(layouts.load(geom_choices.get(name, name)))
+
+def compile_geometry(geometry):
+    '''
+    Converts the chip/channel -> pixel connections of a ``PixelPlane`` into dense
+    arrays indexed by ``[chipid, channel]``:
+
+        pixelid: pixel id (-1 if not connected)
+        x, y: pixel position (nan if not connected)
+
+    '''
+    pixelid = np.full((n_chipids, n_channels), -1, dtype=np.int64)
+    x = np.full((n_chipids, n_channels), np.nan)
+    y = np.full((n_chipids, n_channels), np.nan)
+    for chipid, chip in geometry.chips.items():
+        for channel, pixel in enumerate(chip.channel_connections):
+            if channel >= n_channels or pixel is None or pixel.pixelid is None:
+                continue
+            pixelid[chipid, channel] = pixel.pixelid
+            x[chipid, channel] = pixel.x
+            y[chipid, channel] = pixel.y
+    return {
+        'pixelid': pixelid,
+        'x': x,
+        'y': y
+        }
+
+def default_cache_dir():
+    '''Directory for cached compiled geometries (set by ``LARPIX_SCRIPTS_CACHE``)'''
+    cache_dir = os.environ.get('LARPIX_SCRIPTS_CACHE',
+                               os.path.join(os.path.expanduser('~'), '.cache',
+                                            'larpix-scripts'))
+    return os.path.join(cache_dir, 'geometry')
+
+def layout_file(name):
+    '''Returns the path of a layout (short name or layout file name) or None'''
+    layout = geom_choices.get(name, name)
+    if os.path.isfile(layout):
+        return layout
+    layout = os.path.join(os.path.dirname(os.path.abspath(layouts.__file__)), layout)
+    if os.path.isfile(layout):
+        return layout
+    return None
+
+def load_compiled_geometry(name, cache_dir=None, verbose=False):
+    '''
+    Returns the compiled geometry (see ``compile_geometry``) of a layout, loading it from
+    the cache if the layout file has not changed
+    '''
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    filename = layout_file(name)
+    if filename is None:
+        # layout file cannot be located - compile without caching
+        return compile_geometry(load_geometry(name))
+    with open(filename, 'rb') as fi:
+        layout_hash = hashlib.sha1(fi.read()).hexdigest()
+    cache_file = os.path.join(cache_dir, '%s_%s.npz' % (
+            os.path.splitext(os.path.basename(filename))[0], layout_hash[:16]))
+    try:
+        with np.load(cache_file) as cached:
+            if str(cached['layout_hash']) == layout_hash:
+                if verbose:
+                    print('geometry loaded from %s' % cache_file)
+                return {
+                    'pixelid': cached['pixelid'],
+                    'x': cached['x'],
+                    'y': cached['y']
+                    }
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+    pixel_arrays = compile_geometry(load_geometry(name))
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, temp_file = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+        with os.fdopen(fd, 'wb') as fo:
+            np.savez(fo, layout_hash=layout_hash, **pixel_arrays)
+        os.replace(temp_file, cache_file)
+        if verbose:
+            print('geometry cached in %s' % cache_file)
+    except (IOError, OSError) as error:
+        if verbose:
+            print('could not cache geometry: %s' % error)
+    return pixel_arrays
+
+def lookup(values, chipid, channel):
+    '''
+    Vectorized chip/channel lookup into an array indexed by ``[chipid, channel]`` (e.g.
+    ``compile_geometry(geometry)['pixelid']``), returns -1 (nan for float arrays) for out
+    of range chip/channel ids
+    '''
+    chipid = np.asarray(chipid, dtype=np.int64)
+    channel = np.asarray(channel, dtype=np.int64)
+    valid = (chipid >= 0) & (chipid < values.shape[0]) & (channel >= 0) & \
+        (channel < values.shape[1])
+    result = values[np.where(valid, chipid, 0), np.where(valid, channel, 0)]
+    return np.where(valid, result, -1 if values.dtype.kind in 'iu' else np.nan)
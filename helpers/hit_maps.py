@@ -0,0 +1,91 @@
+'''
+Accumulates 2-D pixel occupancy / hit maps on the sensor plane grid
+Typical usage:
+``
+hit_map = HitMap(geometry.load_compiled_geometry('28chip'))
+hit_map.fill(chipids, channels, adcs, timestamps) # or hit_map.fill_file('run.h5')
+counts = hit_map.counts()
+mean_adc = hit_map.mean_adc()
+rate = hit_map.rate() # Hz
+``
+Images are indexed ``[iy, ix]`` with pixel centers at ``hit_map.y_centers[iy]``,
+``hit_map.x_centers[ix]``. Grid points without a pixel are nan.
+'''
+
+import numpy as np
+import helpers.geometry as geometry
+
+def grid_index(values, decimals=3):
+    '''Returns the sorted unique values and the index of each value into them'''
+    centers, index = np.unique(np.round(values, decimals), return_inverse=True)
+    return centers, index
+
+class HitMap(object):
+    def __init__(self, pixel_arrays):
+        connected = pixel_arrays['pixelid'] >= 0
+        self.x_centers, ix = grid_index(pixel_arrays['x'][connected])
+        self.y_centers, iy = grid_index(pixel_arrays['y'][connected])
+        self.shape = (len(self.y_centers), len(self.x_centers))
+        # flat image index for each chip/channel (-1 if not connected)
+        self.pixel_index = np.full(pixel_arrays['pixelid'].shape, -1, dtype=np.int64)
+        self.pixel_index[connected] = iy * self.shape[1] + ix
+        self.has_pixel = np.zeros(self.shape[0] * self.shape[1], dtype=bool)
+        self.has_pixel[self.pixel_index[connected]] = True
+        self.n_hits = np.zeros(self.shape[0] * self.shape[1], dtype=np.int64)
+        self.adc_sum = np.zeros(self.shape[0] * self.shape[1])
+        self.n_unconnected = 0
+        self.min_timestamp = None
+        self.max_timestamp = None
+
+    def fill(self, chipid, channel, adc=None, timestamp=None):
+        '''Adds arrays of hits to the maps'''
+        index = geometry.lookup(self.pixel_index, chipid, channel)
+        connected = index >= 0
+        self.n_unconnected += np.count_nonzero(~connected)
+        index = index[connected]
+        size = len(self.n_hits)
+        self.n_hits += np.bincount(index, minlength=size)
+        if not adc is None:
+            self.adc_sum += np.bincount(index, weights=np.asarray(adc)[connected],
+                                        minlength=size)
+        if not timestamp is None and len(timestamp) > 0:
+            min_timestamp = np.min(timestamp)
+            max_timestamp = np.max(timestamp)
+            if self.min_timestamp is None or min_timestamp < self.min_timestamp:
+                self.min_timestamp = min_timestamp
+            if self.max_timestamp is None or max_timestamp > self.max_timestamp:
+                self.max_timestamp = max_timestamp
+
+    def fill_file(self, filename, chunk_size=1000000):
+        '''Adds the hits of a converted (dat2h5.py) h5 file, ``chunk_size`` rows at a time'''
+        import h5py
+        with h5py.File(filename, 'r') as fi:
+            dset = fi['data']
+            for start in range(0, dset.shape[0], chunk_size):
+                data = dset[start:start+chunk_size]
+                self.fill(data[:,1], data[:,0], adc=data[:,5], timestamp=data[:,8])
+
+    def _image(self, values):
+        image = np.where(self.has_pixel, values, np.nan)
+        return image.reshape(self.shape)
+
+    def counts(self):
+        '''Number of hits per pixel'''
+        return self._image(self.n_hits.astype(float))
+
+    def mean_adc(self):
+        '''Mean raw ADC per pixel (nan for pixels without hits)'''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self._image(np.where(self.n_hits > 0, self.adc_sum / self.n_hits,
+                                        np.nan))
+
+    def rate(self, run_time=None):
+        '''
+        Hit rate per pixel in Hz, by default over the time between the first and last
+        hit
+        '''
+        if run_time is None:
+            if self.min_timestamp is None or self.max_timestamp == self.min_timestamp:
+                return self._image(np.full(len(self.n_hits), np.nan))
+            run_time = (self.max_timestamp - self.min_timestamp) * 1e-9
+        return self._image(self.n_hits / float(run_time))
@@ -0,0 +1,506 @@
+'''
+Persistent cache of the decoded packets of a .dat data file, so that the raw data only
+needs to be parsed once. The cache is a directory next to the data file
+(``<run>_packets/``) holding one .npy file per field and a ``meta.json`` describing the
+data file it was built from (size, mtime and sha1 hash). Later passes memory map the
+arrays instead of re-parsing the file.
+Typical usage:
+``
+cache = load_packet_cache('run.dat') # builds the cache on first use
+for trans in iter_transmissions(cache):
+    # same keys as LogAnalyzer.next_transmission()
+    for packet in trans['packets']:
+        ...
+``
+Per packet arrays (in file order):
+
+    chipid | channel_id | dataword | timestamp | register_address | register_data |
+    parity (1 if valid) | packet_type (see ``packet_type_codes``) | block_index | word
+
+where ``word`` holds the raw bits of the packet (see ``packet_word``).
+
+Per block arrays (one entry for each DataLoader block):
+
+    block_time | block_type | data_type | block_offset
+
+with the packets of block ``i`` stored in ``block_offset[i]:block_offset[i+1]`` and the
+block/data types stored as indices into ``meta['block_types']``/``meta['data_types']``.
+'''
+
+from __future__ import print_function
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import larpix.larpix as larpix
+from larpix.dataloader import DataLoader
+
+cache_version = 2
+
+packet_fields = [
+    ('chipid', np.uint8),
+    ('channel_id', np.uint8),
+    ('dataword', np.uint16),
+    ('timestamp', np.uint32),
+    ('register_address', np.uint8),
+    ('register_data', np.uint8),
+    ('parity', np.uint8),
+    ('packet_type', np.uint8),
+    ('block_index', np.int64),
+    ('word', np.uint64)
+    ]
+block_fields = [
+    ('block_time', np.float64),
+    ('block_type', np.uint8),
+    ('data_type', np.uint8),
+    ('block_offset', np.int64)
+    ]
+
+packet_types = [larpix.Packet.DATA_PACKET, larpix.Packet.TEST_PACKET,
+                larpix.Packet.CONFIG_WRITE_PACKET, larpix.Packet.CONFIG_READ_PACKET]
+packet_type_codes = {
+    'data': 0,
+    'test': 1,
+    'config_write': 2,
+    'config_read': 3
+    }
+
+word_mask = (1 << larpix.Packet.size) - 1
+uart_size = larpix.Packet.num_bytes + 3 # start byte | packet | metadata | stop byte
+
+def cache_path(filename):
+    '''Returns the cache directory of a data file'''
+    return os.path.splitext(filename)[0] + '_packets'
+
+def file_hash(filename, size=None, chunk_size=1 << 20):
+    '''Returns the sha1 hash of a file (or of its first ``size`` bytes)'''
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fi:
+        while size is None or size > 0:
+            chunk = fi.read(chunk_size if size is None else min(chunk_size, size))
+            if not chunk: break
+            sha1.update(chunk)
+            if not size is None:
+                size -= len(chunk)
+    return sha1.hexdigest()
+
+def packet_type_code(packet):
+    for code, packet_type in enumerate(packet_types):
+        if packet.packet_type == packet_type:
+            return code
+    return len(packet_types)
+
+def packet_word(packet):
+    '''
+    Returns the raw bits of a packet as an integer (bytes in the order they are sent,
+    first byte least significant)
+    '''
+    return int.from_bytes(packet.bytes(), 'little') & word_mask
+
+def packet_words(packets):
+    '''Returns the raw words of a list of packets (or of a ``CachedPackets``)'''
+    if isinstance(packets, CachedPackets):
+        return np.asarray(packets.field('word'))
+    return np.array([packet_word(packet) for packet in packets], dtype=np.uint64)
+
+def stream_words(bytestream):
+    '''
+    Returns the raw words of the packets in a serial byte stream in a single pass, or
+    None if the stream is not a whole number of framed packets (in which case the
+    packets need to be parsed with ``larpix.Controller.parse_input``)
+    '''
+    frames = np.frombuffer(bytes(bytestream), dtype=np.uint8)
+    if len(frames) % uart_size:
+        return None
+    frames = frames.reshape(-1, uart_size)
+    if not (np.all(frames[:,0] == ord(larpix.Controller.start_byte)) and
+            np.all(frames[:,-1] == ord(larpix.Controller.stop_byte))):
+        return None
+    padded = np.zeros((len(frames), 8), dtype=np.uint8)
+    padded[:,:larpix.Packet.num_bytes] = frames[:,1:1+larpix.Packet.num_bytes]
+    return padded.view('<u8').ravel().astype(np.uint64) & np.uint64(word_mask)
+
+def parity_ok(words):
+    '''Vectorized ``Packet.has_valid_parity`` (odd parity of all bits) of raw words'''
+    words = np.asarray(words, dtype=np.uint64)
+    for shift in [32, 16, 8, 4, 2, 1]:
+        words = words ^ (words >> np.uint64(shift))
+    return (words & np.uint64(1)).astype(bool)
+
+def word_field(words, bits):
+    '''
+    Decodes a field of raw words, ``bits`` is the ``larpix.Packet`` bit slice or index of
+    the field (e.g. ``Packet.chipid_bits``)
+    '''
+    if not isinstance(bits, slice):
+        bits = slice(bits, bits + 1)
+    shift = np.uint64(larpix.Packet.size - bits.stop)
+    mask = np.uint64((1 << (bits.stop - bits.start)) - 1)
+    return (np.asarray(words, dtype=np.uint64) >> shift) & mask
+
+data_packet_word_type = int(larpix.Packet.DATA_PACKET.to01(), 2)
+
+def word_hits(packets, words):
+    '''
+    Returns the valid parity data packets of a list of packets and their chip id,
+    channel id and adc (same as ``calibration.decode_hits``), checked and decoded from
+    their raw ``words``
+    '''
+    good = parity_ok(words) & \
+        (word_field(words, larpix.Packet.packet_type_bits) == data_packet_word_type)
+    if np.all(good):
+        good_packets = packets
+    else:
+        good_packets = [packets[i] for i in np.flatnonzero(good)]
+        words = words[good]
+    return {
+        'packets': good_packets,
+        'chipid': word_field(words, larpix.Packet.chipid_bits).astype(np.int64),
+        'channelid': word_field(words, larpix.Packet.channel_id_bits).astype(np.int64),
+        'adc': word_field(words, larpix.Packet.dataword_bits).astype(np.int64)
+        }
+
+class CachedPacket(object):
+    '''
+    Read-only stand in for ``larpix.Packet`` with the decoded fields of a cached packet
+    '''
+    __slots__ = ['chipid', 'channel_id', 'dataword', 'timestamp', 'register_address',
+                 'register_data', 'parity', 'packet_type', 'word']
+    DATA_PACKET = larpix.Packet.DATA_PACKET
+    TEST_PACKET = larpix.Packet.TEST_PACKET
+    CONFIG_WRITE_PACKET = larpix.Packet.CONFIG_WRITE_PACKET
+    CONFIG_READ_PACKET = larpix.Packet.CONFIG_READ_PACKET
+
+    def __init__(self, chipid, channel_id, dataword, timestamp, register_address,
+                 register_data, parity, packet_type, word):
+        self.chipid = chipid
+        self.channel_id = channel_id
+        self.dataword = dataword
+        self.timestamp = timestamp
+        self.register_address = register_address
+        self.register_data = register_data
+        self.parity = parity
+        self.packet_type = packet_types[packet_type] if packet_type < len(packet_types) \
+            else None
+        self.word = word
+
+    def has_valid_parity(self):
+        return self.parity == 1
+
+class CachedPackets(object):
+    '''
+    Sequence of the cached packets selected by ``index`` (a slice or an index array),
+    packets are only created when accessed
+    '''
+    def __init__(self, cache, index):
+        self.cache = cache
+        self.index = index
+
+    def field(self, name):
+        return self.cache[name][self.index]
+
+    def __len__(self):
+        return len(self.field('packet_type'))
+
+    def __iter__(self):
+        fields = [self.field(name).tolist() for name in CachedPacket.__slots__]
+        for values in zip(*fields):
+            yield CachedPacket(*values)
+
+    def __getitem__(self, i):
+        return CachedPacket(*[self.field(name)[i].item()
+                              for name in CachedPacket.__slots__])
+
+    def select(self, mask):
+        '''Returns the packets selected by a boolean mask'''
+        if isinstance(self.index, slice):
+            index = np.arange(self.index.start, self.index.stop)[mask]
+        else:
+            index = self.index[mask]
+        return CachedPackets(self.cache, index)
+
+class _ArrayBuilder(object):
+    '''Collects values in lists, converting them to arrays every ``chunk_size`` entries'''
+    def __init__(self, fields, chunk_size=100000):
+        self.fields = fields
+        self.chunk_size = chunk_size
+        self.values = dict((name, []) for name, dtype in fields)
+        self.chunks = dict((name, []) for name, dtype in fields)
+
+    def append(self, *values):
+        for (name, dtype), value in zip(self.fields, values):
+            self.values[name].append(value)
+        if len(self.values[self.fields[0][0]]) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        for name, dtype in self.fields:
+            self.chunks[name].append(np.array(self.values[name], dtype=dtype))
+            self.values[name] = []
+
+    def arrays(self):
+        self.flush()
+        return dict((name, np.concatenate(self.chunks[name]))
+                    for name, dtype in self.fields)
+
+def decode_file(filename, verbose=False, start_block=0, block_types=None,
+                data_types=None):
+    '''
+    Parses a .dat file and returns the per packet and per block arrays (see module
+    docstring) and the lists of block and data types. Blocks before ``start_block`` are
+    skipped without being decoded (the block offsets then start at 0 and the types are
+    added to the given lists of block and data types).
+    '''
+    loader = DataLoader(filename)
+    packets = _ArrayBuilder(packet_fields)
+    blocks = _ArrayBuilder(block_fields)
+    block_types = [] if block_types is None else list(block_types)
+    data_types = [] if data_types is None else list(data_types)
+    n_packets = 0
+    block_index = 0
+    while True:
+        block = loader.next_block()
+        if block is None: break
+        if block_index < start_block:
+            block_index += 1
+            continue
+        block_type = block.get('block_type')
+        data_type = block.get('data_type', '')
+        if not block_type in block_types:
+            block_types.append(block_type)
+        if not data_type in data_types:
+            data_types.append(data_type)
+        blocks.append(block.get('time', np.nan), block_types.index(block_type),
+                      data_types.index(data_type), n_packets)
+        if block_type == 'data':
+            for packet in larpix.Controller.parse_input(bytes(block['data'])):
+                packets.append(packet.chipid, packet.channel_id, packet.dataword,
+                               packet.timestamp, packet.register_address,
+                               packet.register_data, int(packet.has_valid_parity()),
+                               packet_type_code(packet), block_index,
+                               packet_word(packet))
+                n_packets += 1
+        block_index += 1
+        if verbose and block_index % 1000 == 0:
+            print('blocks: %d, packets: %d\r' % (block_index, n_packets), end='')
+            sys.stdout.flush()
+    if verbose:
+        print('blocks: %d, packets: %d' % (block_index, n_packets))
+    blocks.append(np.nan, 0, 0, n_packets) # end offset of the last block
+    arrays = packets.arrays()
+    block_arrays = blocks.arrays()
+    for name in ['block_time', 'block_type', 'data_type']:
+        block_arrays[name] = block_arrays[name][:-1]
+    arrays.update(block_arrays)
+    return arrays, block_types, data_types
+
+def file_info(filename):
+    stat = os.stat(filename)
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime
+        }
+
+def is_valid_cache(meta, filename):
+    '''
+    Checks the cache metadata against the data file: the size and mtime must match, or
+    (if only the mtime differs) the sha1 hash
+    '''
+    if meta.get('version') != cache_version:
+        return False
+    info = file_info(filename)
+    if meta['size'] != info['size']:
+        return False
+    if meta['mtime'] == info['mtime']:
+        return True
+    return meta['sha1'] == file_hash(filename)
+
+def read_meta(directory):
+    try:
+        with open(os.path.join(directory, 'meta.json'), 'r') as fi:
+            return json.load(fi)
+    except (IOError, OSError, ValueError):
+        return None
+
+def write_meta(directory, meta):
+    fd, temp_file = tempfile.mkstemp(suffix='.json', dir=directory)
+    with os.fdopen(fd, 'w') as fo:
+        json.dump(meta, fo, sort_keys=True, indent=4, separators=(',',': '))
+    os.replace(temp_file, os.path.join(directory, 'meta.json'))
+
+def is_appended_cache(meta, filename):
+    '''Checks if the data file has only been appended to since the cache was built'''
+    if meta.get('version') != cache_version:
+        return False
+    if file_info(filename)['size'] <= meta['size']:
+        return False
+    return meta['sha1'] == file_hash(filename, size=meta['size'])
+
+def build_packet_cache(filename, directory=None, verbose=False):
+    '''Parses the data file and (re)writes its cache, returns the cache directory'''
+    if directory is None:
+        directory = cache_path(filename)
+    if verbose:
+        print('building packet cache %s' % directory)
+    meta = file_info(filename)
+    meta['sha1'] = file_hash(filename)
+    meta['version'] = cache_version
+    meta['filename'] = os.path.basename(filename)
+    arrays, meta['block_types'], meta['data_types'] = decode_file(filename,
+                                                                 verbose=verbose)
+    return write_packet_cache(directory, arrays, meta)
+
+def extend_packet_cache(filename, directory=None, verbose=False):
+    '''
+    Adds the blocks appended to the data file since its cache was built (see
+    ``is_appended_cache``) to the cache, returns the cache directory
+    '''
+    if directory is None:
+        directory = cache_path(filename)
+    meta = read_meta(directory)
+    arrays = dict((name, np.array(array)) for name, array
+                  in load_arrays(directory, meta).items() if name != 'meta')
+    n_blocks = len(arrays['block_time'])
+    if verbose:
+        print('extending packet cache %s from block %d' % (directory, n_blocks))
+    meta.update(file_info(filename))
+    meta['sha1'] = file_hash(filename)
+    new_arrays, meta['block_types'], meta['data_types'] = decode_file(
+        filename, verbose=verbose, start_block=n_blocks, block_types=meta['block_types'],
+        data_types=meta['data_types'])
+    new_arrays['block_offset'] = new_arrays['block_offset'][1:] + \
+        arrays['block_offset'][-1]
+    for name in arrays:
+        arrays[name] = np.concatenate((arrays[name], new_arrays[name]))
+    return write_packet_cache(directory, arrays, meta)
+
+def write_packet_cache(directory, arrays, meta):
+    '''Writes the cache arrays and metadata, replacing the cache directory'''
+    parent = os.path.dirname(os.path.abspath(directory))
+    temp_dir = tempfile.mkdtemp(prefix='.packets_', dir=parent)
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(temp_dir, name + '.npy'), array)
+        write_meta(temp_dir, meta)
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.rename(temp_dir, directory)
+    except:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    return directory
+
+def load_arrays(directory, meta):
+    cache = {'meta': meta}
+    for name, dtype in packet_fields + block_fields:
+        path = os.path.join(directory, name + '.npy')
+        try:
+            cache[name] = np.load(path, mmap_mode='r')
+        except ValueError:
+            # empty arrays cannot be memory mapped
+            cache[name] = np.load(path)
+    return cache
+
+def load_packet_cache(filename, directory=None, build=True, verbose=False):
+    '''
+    Returns the cached arrays (memory mapped, see module docstring) of a data file plus
+    its ``meta`` dict. The cache is (re)built if it is missing or out of date (only the
+    new blocks are decoded if the data file was appended to), unless ``build`` is False
+    in which case None is returned.
+    '''
+    if directory is None:
+        directory = cache_path(filename)
+    meta = read_meta(directory)
+    if not meta is None and is_valid_cache(meta, filename):
+        info = file_info(filename)
+        if meta['mtime'] != info['mtime']:
+            # same content (hash matched) - remember new mtime
+            meta['mtime'] = info['mtime']
+            try:
+                write_meta(directory, meta)
+            except (IOError, OSError):
+                pass
+        if verbose:
+            print('packets loaded from %s' % directory)
+        return load_arrays(directory, meta)
+    if not build:
+        return None
+    if not meta is None and is_appended_cache(meta, filename):
+        extend_packet_cache(filename, directory=directory, verbose=verbose)
+    else:
+        build_packet_cache(filename, directory=directory, verbose=verbose)
+    return load_arrays(directory, read_meta(directory))
+
+def iter_transmissions(cache, start=0):
+    '''
+    Yields the blocks of a cached file (from block ``start``) as dicts with the same keys
+    as ``LogAnalyzer.next_transmission()`` (``packets`` is a ``CachedPackets``) plus
+    ``block_index`` and the raw ``words`` of the packets
+    '''
+    block_types = cache['meta']['block_types']
+    data_types = cache['meta']['data_types']
+    offsets = cache['block_offset'].tolist()
+    block_type_index = cache['block_type'].tolist()
+    data_type_index = cache['data_type'].tolist()
+    times = cache['block_time'].tolist()
+    for block_index in range(start, len(times)):
+        yield {
+            'block_type': block_types[block_type_index[block_index]],
+            'data_type': data_types[data_type_index[block_index]],
+            'time': times[block_index],
+            'packets': CachedPackets(cache, slice(offsets[block_index],
+                                                 offsets[block_index+1])),
+            'words': cache['word'][offsets[block_index]:offsets[block_index+1]],
+            'block_index': block_index
+            }
+
+def read_transmissions(filename, start=0):
+    '''
+    Yields the blocks of an (uncached) data file in the same format as
+    ``iter_transmissions``, blocks before ``start`` are skipped without being decoded
+    '''
+    loader = DataLoader(filename)
+    block_index = 0
+    while True:
+        block = loader.next_block()
+        if block is None: break
+        if block_index >= start:
+            if block['block_type'] == 'data':
+                block['packets'] = larpix.Controller.parse_input(bytes(block['data']))
+                block['words'] = stream_words(block['data'])
+                if block['words'] is None or len(block['words']) != len(block['packets']):
+                    block['words'] = packet_words(block['packets'])
+            block['block_index'] = block_index
+            yield block
+        block_index += 1
+
+def config_writes(cache):
+    '''
+    Returns the configuration write stream (config write packets of write blocks) as
+    arrays of ``block_index``, ``chipid``, ``register_address``, ``register_data``
+    '''
+    block_index = cache['block_index']
+    write_code = cache['meta']['data_types'].index('write') \
+        if 'write' in cache['meta']['data_types'] else -1
+    is_write = (cache['packet_type'] == packet_type_codes['config_write']) & \
+        (cache['data_type'][block_index] == write_code)
+    return dict((name, np.asarray(cache[name][is_write]))
+                for name in ['block_index', 'chipid', 'register_address',
+                             'register_data'])
+
+def good_hits(packets):
+    '''
+    Returns the valid parity data packets of a ``CachedPackets`` and their chip id,
+    channel id and adc (same as ``calibration.decode_hits``)
+    '''
+    good = (packets.field('packet_type') == packet_type_codes['data']) & \
+        (packets.field('parity') == 1)
+    return {
+        'packets': packets.select(good),
+        'chipid': packets.field('chipid')[good].astype(np.int64),
+        'channelid': packets.field('channel_id')[good].astype(np.int64),
+        'adc': packets.field('dataword')[good].astype(np.int64)
+        }
@@ -61,6 +61,10 @@ def default_data_logfile(start_time):
         time.strftime('%Y_%m_%d_%H_%M_%S_%Z') + '.dat'
     return logfile
 
+def default_catalog_file():
+    catalog_file = 'data/run_catalog.db'
+    return catalog_file
+
 def mkdir_p(path):
     '''shamelessly copied from http://stackoverflow.com/a/600612/190597 (tzot)'''
     try:
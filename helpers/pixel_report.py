@@ -1,37 +1,59 @@
 # Utilities to check pixel data
 
+import numpy as np
+import larpix.larpix as larpix
+import helpers.packet_cache as packet_cache
+
+__all__ = ['pixel_check', 'print_pixel_report', 'pixel_report']
+
+max_bad_packets_shown = 10
+
+def collection_words(packets):
+    '''
+    Returns the raw words of a list of packets, taken from the received bytes at once if
+    available (``PacketCollection.bytestream``)
+    '''
+    words = None
+    bytestream = getattr(packets, 'bytestream', None)
+    if not bytestream is None:
+        words = packet_cache.stream_words(bytestream)
+    if words is None or len(words) != len(packets):
+        words = packet_cache.packet_words(packets)
+    return words
+
 def pixel_check(packets):
-    '''Examine the data returning from the pixels'''
+    '''
+    Examine the data returning from the pixels. The packets with bad parity are listed
+    per chip as ``bad_packets`` (position in ``packets`` and raw bits).
+    '''
+    words = collection_words(packets)
+    position = np.flatnonzero(packet_cache.word_field(
+            words, larpix.Packet.packet_type_bits) == packet_cache.data_packet_word_type)
+    words = words[position]
+    chip_ids = packet_cache.word_field(words, larpix.Packet.chipid_bits).astype(int)
+    chan_ids = packet_cache.word_field(words, larpix.Packet.channel_id_bits).astype(int)
+    datawords = packet_cache.word_field(words, larpix.Packet.dataword_bits).astype(int)
+    fifo_half = packet_cache.word_field(words, larpix.Packet.fifo_half_bit) == 1
+    fifo_full = packet_cache.word_field(words, larpix.Packet.fifo_full_bit) == 1
+    bad_parity = ~packet_cache.parity_ok(words)
     results = {}
-    for pkt in packets:
-        if pkt.packet_type != pkt.DATA_PACKET:
-            continue
-        chip_id = pkt.chipid
-        chip_result = None
-        if chip_id in results.keys():
-            chip_result = results[chip_id]
-        else:
-            chip_result = {'chip_id': chip_id,
-                           'bad_parity':0,
-                           'fifo_half':0,
-                           'fifo_full':0,
-                           'n_hits': [0]*32,
-                           'mean_adc':[0]*32}
-            results[chip_id] = chip_result
-        if not pkt.has_valid_parity():
-            chip_result['bad_parity'] += 1
-        if pkt.fifo_half_flag:
-            chip_result['fifo_half'] += 1
-        if pkt.fifo_full_flag:
-            chip_result['fifo_full'] += 1
-        chan_id = pkt.channel_id
-        chip_result['n_hits'][chan_id] += 1
-        chip_result['mean_adc'][chan_id] += pkt.dataword
-    # Convert ADC sum to ADC mean
-    for chip_id, result in list(results.items()):
-        for chan_id in range(32):
-            if result['n_hits'][chan_id] > 0:
-                result['mean_adc'][chan_id] /= float(result['n_hits'][chan_id])
+    for chip_id in np.unique(chip_ids).tolist():
+        chip = chip_ids == chip_id
+        chip_bad = chip & bad_parity
+        in_chip = chip & (chan_ids < 32)
+        n_hits = np.bincount(chan_ids[in_chip], minlength=32)
+        adc_sum = np.bincount(chan_ids[in_chip], weights=datawords[in_chip],
+                              minlength=32)
+        results[chip_id] = {'chip_id': chip_id,
+                            'bad_parity': int(np.count_nonzero(chip_bad)),
+                            'fifo_half': int(np.count_nonzero(chip & fifo_half)),
+                            'fifo_full': int(np.count_nonzero(chip & fifo_full)),
+                            'n_hits': n_hits.tolist(),
+                            'mean_adc': [adc_sum[chan_id] / n_hits[chan_id]
+                                         if n_hits[chan_id] > 0 else 0
+                                         for chan_id in range(32)],
+                            'bad_packets': list(zip(position[chip_bad].tolist(),
+                                                    words[chip_bad].tolist()))}
     return results
 
 def print_pixel_report(results):
@@ -46,6 +68,12 @@ def print_pixel_report(results):
                 result['bad_parity'],
                 result['fifo_half'],
                 result['fifo_full']))
+        for position, word in result['bad_packets'][:max_bad_packets_shown]:
+            print('  bad parity packet %d: %s' % (position,
+                                                 format(word, '0%db' % larpix.Packet.size)))
+        if len(result['bad_packets']) > max_bad_packets_shown:
+            print('  ... %d more bad parity packets' % (len(result['bad_packets']) -
+                                                       max_bad_packets_shown))
         print('  chan n_hits mean_adc')
         for chan_id in range(32):
             if result['n_hits'][chan_id] == 0:
@@ -0,0 +1,298 @@
+'''
+Helper functions for maintaining a SQLite index of the runs stored under the default
+``data/YYYY_MM_DD/`` directories (see ``helpers.pathnames``)
+Typical usage:
+``
+db = open_catalog('data/run_catalog.db')
+update_catalog(db, ['data/'])
+runs = query_runs(db, script='collect_data', board='pcb-10', since=time.time()-7*86400)
+``
+Each run is identified by its script log file. Script logs, data logs and converted
+outputs are only re-read if their size or modification time has changed since the last
+update.
+'''
+
+from __future__ import print_function
+import os
+import re
+import ast
+import json
+import time
+import sqlite3
+from larpix.dataloader import DataLoader
+from larpix.larpix import Controller
+import helpers.pathnames as pathnames
+parse = Controller.parse_input
+
+schema = '''
+CREATE TABLE IF NOT EXISTS runs (
+    script_logfile TEXT PRIMARY KEY,
+    script_logfile_size INTEGER,
+    script_logfile_mtime REAL,
+    script TEXT,
+    arguments TEXT,
+    board TEXT,
+    chips TEXT,
+    start_time REAL,
+    end_time REAL,
+    data_logfile TEXT,
+    data_logfile_size INTEGER,
+    data_logfile_mtime REAL,
+    n_packets INTEGER,
+    converted TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_script ON runs (script, start_time);
+CREATE INDEX IF NOT EXISTS runs_board ON runs (board, start_time);
+CREATE INDEX IF NOT EXISTS runs_start_time ON runs (start_time);
+'''
+
+run_fields = ['script_logfile', 'script_logfile_size', 'script_logfile_mtime', 'script',
+              'arguments', 'board', 'chips', 'start_time', 'end_time', 'data_logfile',
+              'data_logfile_size', 'data_logfile_mtime', 'n_packets', 'converted']
+
+converted_extensions = ['.h5', '.root', '_calib.json']
+
+script_logdir_regex = re.compile(r'^(?P<script>.+)_\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}'
+                                 r'(_[A-Za-z]*)?$')
+log_line_regex = re.compile(r'^(?P<asctime>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),\d+ '
+                            r'(?P<level>[A-Z]+): (?P<message>.*)$')
+log_time_format = '%Y-%m-%d %H:%M:%S'
+
+def open_catalog(filename=None):
+    '''
+    Opens (and creates if necessary) the catalog database, default location is given by
+    ``pathnames.default_catalog_file()``
+    '''
+    if filename is None:
+        filename = pathnames.default_catalog_file()
+    catalog_dir = os.path.dirname(filename)
+    if catalog_dir:
+        pathnames.mkdir_p(catalog_dir)
+    db = sqlite3.connect(filename)
+    db.row_factory = sqlite3.Row
+    db.executescript(schema)
+    return db
+
+def find_script_logfiles(datadir):
+    '''
+    Returns all script log files found in ``<datadir>/<date>/<script>_<time>/``
+    directories
+    '''
+    logfiles = []
+    for root, dirnames, filenames in os.walk(datadir):
+        dirnames.sort()
+        match = script_logdir_regex.match(os.path.basename(root))
+        if match is None:
+            continue
+        for filename in sorted(filenames):
+            if filename.endswith('.log') and filename.startswith(match.group('script')):
+                logfiles.append(os.path.join(root, filename))
+    return logfiles
+
+def parse_arguments(message):
+    '''
+    Converts the ``'arguments: Namespace(...)'`` string stored in the script log into a
+    dict (any argument that cannot be safely evaluated is kept as a string)
+    '''
+    arguments = {}
+    message = message.strip()
+    try:
+        call = ast.parse(message, mode='eval').body
+    except (ValueError, SyntaxError, RecursionError, MemoryError):
+        return arguments
+    if not isinstance(call, ast.Call):
+        return arguments
+    for keyword in call.keywords:
+        try:
+            arguments[keyword.arg] = ast.literal_eval(keyword.value)
+        except (ValueError, TypeError, SyntaxError, RecursionError, MemoryError):
+            arguments[keyword.arg] = ast.get_source_segment(message, keyword.value)
+    return arguments
+
+def parse_script_logfile(filename):
+    '''
+    Reads the script name, arguments, data log file and start/end times from a script log
+    file
+    '''
+    run_info = {
+        'script': None,
+        'arguments': {},
+        'start_time': None,
+        'end_time': None,
+        'data_logfile': None
+        }
+    match = script_logdir_regex.match(os.path.basename(os.path.dirname(filename)))
+    if not match is None:
+        run_info['script'] = match.group('script')
+    with open(filename, 'r') as fi:
+        for line in fi:
+            match = log_line_regex.match(line.rstrip('\n'))
+            if match is None:
+                continue
+            log_time = time.mktime(time.strptime(match.group('asctime'), log_time_format))
+            if run_info['start_time'] is None:
+                run_info['start_time'] = log_time
+            run_info['end_time'] = log_time
+            message = match.group('message')
+            if message.startswith('storing data to ') and run_info['data_logfile'] is None:
+                run_info['data_logfile'] = message[len('storing data to '):].strip()
+            elif message.startswith('arguments: ') and not run_info['arguments']:
+                run_info['arguments'] = parse_arguments(message[len('arguments: '):])
+    return run_info
+
+def resolve_path(path, base_dirs):
+    '''Returns the first existing location of a (possibly relative) path'''
+    if path is None:
+        return None
+    if os.path.isabs(path):
+        return path
+    for base_dir in base_dirs:
+        candidate = os.path.normpath(os.path.join(base_dir, path))
+        if os.path.exists(candidate):
+            return candidate
+    return os.path.normpath(os.path.abspath(path))
+
+def load_board_info(board_file):
+    '''Returns the board name and chip ids from a chip set info file (if readable)'''
+    try:
+        chip_set = json.load(open(board_file, 'r'))
+    except (IOError, OSError, ValueError, TypeError):
+        return None, None
+    return chip_set.get('board'), [chip_info[0] for chip_info in chip_set.get('chip_set', [])]
+
+def count_packets(data_logfile):
+    '''Returns the number of packets read back in a data log file'''
+    loader = DataLoader(data_logfile)
+    n_packets = 0
+    while True:
+        block = loader.next_block()
+        if block is None: break
+        if block['block_type'] == 'data' and block['data_type'] == 'read':
+            n_packets += len(parse(bytes(block['data'])))
+    return n_packets
+
+def find_converted_outputs(data_logfile):
+    '''Returns the converted files (h5, root, calibration) that exist for a data log file'''
+    if data_logfile is None:
+        return []
+    stem = os.path.splitext(data_logfile)[0]
+    return [stem + extension for extension in converted_extensions
+            if os.path.isfile(stem + extension)]
+
+def file_stat(filename):
+    '''Returns (size, mtime) of a file or (None, None) if it does not exist'''
+    try:
+        stat = os.stat(filename)
+    except (OSError, TypeError):
+        return None, None
+    return stat.st_size, stat.st_mtime
+
+def update_catalog(db, datadirs, count=True, verbose=False):
+    '''
+    Scans the data directories and adds new or modified runs to the catalog. Data log
+    files are only re-read (to count packets) if their size or modification time
+    changed. Set ``count=False`` to skip packet counting.
+    Returns the number of runs added or updated.
+    '''
+    previous = dict((row['script_logfile'], row) for row in
+                    db.execute('SELECT * FROM runs'))
+    n_updated = 0
+    for datadir in datadirs:
+        # data log paths are stored relative to the directory the script was run in
+        base_dirs = [os.path.dirname(os.path.normpath(os.path.abspath(datadir))),
+                     os.getcwd()]
+        for logfile in find_script_logfiles(datadir):
+            logfile = os.path.normpath(os.path.abspath(logfile))
+            log_size, log_mtime = file_stat(logfile)
+            prev_run = previous.get(logfile)
+            if prev_run is None or prev_run['script_logfile_size'] != log_size or \
+                    prev_run['script_logfile_mtime'] != log_mtime:
+                run_info = parse_script_logfile(logfile)
+                arguments = run_info['arguments']
+                board_file = resolve_path(arguments.get('board'), base_dirs) \
+                    if isinstance(arguments.get('board'), str) else None
+                board, chips = load_board_info(board_file)
+                if isinstance(arguments.get('chips'), list):
+                    chips = arguments['chips']
+                run = {
+                    'script_logfile': logfile,
+                    'script_logfile_size': log_size,
+                    'script_logfile_mtime': log_mtime,
+                    'script': run_info['script'],
+                    'arguments': json.dumps(arguments, default=str),
+                    'board': board,
+                    'chips': json.dumps(chips),
+                    'start_time': run_info['start_time'],
+                    'end_time': run_info['end_time'],
+                    'data_logfile': resolve_path(run_info['data_logfile'], base_dirs),
+                    'data_logfile_size': None,
+                    'data_logfile_mtime': None,
+                    'n_packets': None,
+                    'converted': None
+                    }
+            else:
+                run = dict(prev_run)
+            data_size, data_mtime = file_stat(run['data_logfile'])
+            converted = json.dumps(find_converted_outputs(run['data_logfile']))
+            data_changed = run['data_logfile_size'] != data_size or \
+                run['data_logfile_mtime'] != data_mtime
+            if data_changed:
+                run['n_packets'] = None
+            if count and run['n_packets'] is None and not data_size is None:
+                if verbose:
+                    print('counting packets in %s' % run['data_logfile'])
+                try:
+                    run['n_packets'] = count_packets(run['data_logfile'])
+                except Exception as error:
+                    print('could not read %s: %s' % (run['data_logfile'], error))
+            run['data_logfile_size'] = data_size
+            run['data_logfile_mtime'] = data_mtime
+            run['converted'] = converted
+            if not prev_run is None and run == dict(prev_run):
+                continue
+            db.execute('INSERT OR REPLACE INTO runs (%s) VALUES (%s)' % (
+                    ', '.join(run_fields), ', '.join(['?'] * len(run_fields))),
+                       [run[field] for field in run_fields])
+            n_updated += 1
+            if verbose:
+                print('updated %s' % logfile)
+    db.commit()
+    return n_updated
+
+def query_runs(db, script=None, board=None, chip=None, since=None, until=None,
+               data_logfile=None):
+    '''
+    Returns a list of runs (as dicts) matching all of the specified conditions, ordered by
+    start time. ``since`` and ``until`` are unix times.
+    '''
+    conditions = []
+    values = []
+    if not script is None:
+        conditions.append('script = ?')
+        values.append(script)
+    if not board is None:
+        conditions.append('board = ?')
+        values.append(board)
+    if not since is None:
+        conditions.append('start_time >= ?')
+        values.append(since)
+    if not until is None:
+        conditions.append('start_time <= ?')
+        values.append(until)
+    if not data_logfile is None:
+        conditions.append('data_logfile LIKE ?')
+        values.append('%' + data_logfile + '%')
+    query = 'SELECT * FROM runs'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY start_time'
+    runs = []
+    for row in db.execute(query, values):
+        run = dict(row)
+        run['arguments'] = json.loads(run['arguments']) if run['arguments'] else {}
+        run['chips'] = json.loads(run['chips']) if run['chips'] else None
+        run['converted'] = json.loads(run['converted']) if run['converted'] else []
+        if not chip is None and (run['chips'] is None or not chip in run['chips']):
+            continue
+        runs.append(run)
+    return runs
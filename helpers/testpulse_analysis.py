@@ -0,0 +1,380 @@
+'''
+Offline analysis of test pulse runs (``noise_tests.test_csa_gain``,
+``noise_tests.test_testpulse_linearity`` and ``noise_tests.noise_test_internal_pulser``).
+The test pulse DAC settings are followed through the configuration write stream: each
+write of the test pulse DAC register that lowers the DAC value issues a test pulse of
+``previous - new`` DAC counts to the channels with the test pulse enabled, and the hits
+that are read until the next DAC write are associated with that pulse.
+Typical usage:
+``
+accumulator = CsaGainAccumulator()
+calibration.extract_calibration_data('datalog.dat', [accumulator])
+gain = csa_gain_fit(accumulator)
+``
+'''
+
+import warnings
+import numpy as np
+import larpix.larpix as larpix
+from helpers.calibration import PulsedChannelTracker, AdcHistogram
+
+testpulse_dac_address = 46 # csa_testpulse_dac_amplitude register
+
+class TestpulseAccumulator(PulsedChannelTracker):
+    '''
+    Keeps track of the test pulse DAC of each chip and the pulse that was last issued
+    (``pulse_dac``, 0 if the last DAC write was not a pulse, and ``pulse_start``, the DAC
+    value the pulse started from). ``hit_pulses(hits)`` returns the pulse size
+    associated with each hit (0 for hits from channels without the test pulse enabled or
+    not following a pulse).
+    Subclasses accumulate the number of hits, sum and sum of squares of the adc of each
+    channel per pulse key (e.g. the pulse size) with ``fill(keys, hits)``, stored in
+    ``stats[key]``.
+    '''
+    def __init__(self, n_chips=256, n_channels=32):
+        PulsedChannelTracker.__init__(self, n_chips=n_chips, n_channels=n_channels)
+        self.shape = (n_chips, n_channels)
+        self.dac = np.full(n_chips, -1, dtype=np.int64)
+        self.pulse_dac = np.zeros(n_chips, dtype=np.int64)
+        self.pulse_start = np.zeros(n_chips, dtype=np.int64)
+        self.n_pulses = 0
+        self.stats = {}
+
+    def write(self, trans):
+        PulsedChannelTracker.write(self, trans)
+        for packet in trans['packets']:
+            if packet.packet_type != larpix.Packet.CONFIG_WRITE_PACKET or \
+                    packet.register_address != testpulse_dac_address or \
+                    packet.chipid >= len(self.dac):
+                continue
+            chipid = packet.chipid
+            dac = packet.register_data
+            if self.dac[chipid] >= 0 and dac < self.dac[chipid]:
+                self.pulse_dac[chipid] = self.dac[chipid] - dac
+                self.pulse_start[chipid] = self.dac[chipid]
+                self.n_pulses += 1
+            else:
+                # DAC reset
+                self.pulse_dac[chipid] = 0
+                self.pulse_start[chipid] = 0
+            self.dac[chipid] = dac
+
+    def hit_pulses(self, hits):
+        chipids = hits['chipid']
+        pulses = np.zeros(len(chipids), dtype=np.int64)
+        pulsed = self.is_pulsed(hits)
+        pulses[pulsed] = self.pulse_dac[chipids[pulsed]]
+        return pulses
+
+    def fill(self, keys, hits):
+        '''Adds the hits with a key > 0 to the stats of their key'''
+        selected = (keys > 0) & (hits['channelid'] < self.shape[1])
+        if not np.any(selected):
+            return
+        keys = keys[selected]
+        flat_idx = hits['chipid'][selected] * self.shape[1] + hits['channelid'][selected]
+        adc = hits['adc'][selected].astype(float)
+        size = self.shape[0] * self.shape[1]
+        for key in np.unique(keys):
+            in_key = keys == key
+            n = np.bincount(flat_idx[in_key], minlength=size)
+            adc_sum = np.bincount(flat_idx[in_key], weights=adc[in_key], minlength=size)
+            adc_sum2 = np.bincount(flat_idx[in_key], weights=adc[in_key]**2,
+                                   minlength=size)
+            try:
+                self.stats[int(key)] += np.stack((n, adc_sum, adc_sum2))
+            except KeyError:
+                self.stats[int(key)] = np.stack((n, adc_sum, adc_sum2)).astype(float)
+
+    def read(self, trans, hits):
+        pass
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        self.reset()
+        self.dac[:] = -1
+        self.pulse_dac[:] = 0
+        self.pulse_start[:] = 0
+
+    def merge(self, other):
+        self.n_pulses += other.n_pulses
+        for key, stats in other.stats.items():
+            try:
+                self.stats[key] += stats
+            except KeyError:
+                self.stats[key] = stats.copy()
+
+    def response(self):
+        '''
+        Returns the keys and the number of hits, mean and rms adc of each channel for each
+        key (``(n_keys, n_chips, n_channels)`` arrays)
+        '''
+        keys = np.array(sorted(self.stats.keys()), dtype=np.int64)
+        stats = np.array([self.stats[key] for key in keys]).reshape(
+            (len(keys), 3) + self.shape)
+        n = stats[:,0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = stats[:,1] / n
+            rms = np.sqrt(np.maximum(stats[:,2] / n - mean**2, 0))
+        return keys, n, mean, rms
+
+class CsaGainAccumulator(TestpulseAccumulator):
+    '''
+    Accumulates the adc of each channel for each pulse size (``stats[pulse_dac]``), see
+    ``noise_tests.test_csa_gain``
+    '''
+    def read(self, trans, hits):
+        self.fill(self.hit_pulses(hits), hits)
+
+class TestpulseLinearityAccumulator(TestpulseAccumulator):
+    '''
+    Accumulates the adc of each channel for each DAC value the pulses start from
+    (``stats[pulse_start]``), see ``noise_tests.test_testpulse_linearity``. The pulse
+    sizes that were seen are kept in ``pulse_dacs``.
+    '''
+    def __init__(self, n_chips=256, n_channels=32):
+        TestpulseAccumulator.__init__(self, n_chips=n_chips, n_channels=n_channels)
+        self.pulse_dacs = set()
+
+    def read(self, trans, hits):
+        pulses = self.hit_pulses(hits)
+        starts = np.where(pulses > 0, self.pulse_start[hits['chipid']], 0)
+        self.pulse_dacs.update(np.unique(pulses[pulses > 0]).tolist())
+        self.fill(starts, hits)
+
+    def merge(self, other):
+        TestpulseAccumulator.merge(self, other)
+        self.pulse_dacs.update(other.pulse_dacs)
+
+class CrossTriggerAccumulator(TestpulseAccumulator):
+    '''
+    Accumulates the hits following each test pulse of a cross-trigger run
+    (``noise_tests.noise_test_internal_pulser``), where one channel per chip is pulsed
+    and all other channels are read out through the cross-trigger. For each chip and
+    channel the number of pulses without a hit (``missed_triggers``, enabled channels
+    only) and with more than one hit (``extra_triggers``) are counted, and the adc
+    distribution of the cross-triggered (not pulsed) channels is filled (``adc_hist``,
+    1 adc bins). Per chip, the number of pulses (``chip_pulses``) and of pulses with
+    fewer / more hits than enabled channels (``pulses_missed`` / ``pulses_extra``) are
+    counted as in ``noise_test_internal_pulser``.
+    '''
+    def __init__(self, n_chips=256, n_channels=32):
+        TestpulseAccumulator.__init__(self, n_chips=n_chips, n_channels=n_channels)
+        self.adc_hist = AdcHistogram(adc_min=0, adc_max=255, adc_step=1, n_chips=n_chips,
+                                     n_channels=n_channels)
+        self.pulse_hits = np.zeros(self.shape, dtype=np.int64)
+        self.missed_triggers = np.zeros(self.shape, dtype=np.int64)
+        self.extra_triggers = np.zeros(self.shape, dtype=np.int64)
+        self.chip_pulses = np.zeros(n_chips, dtype=np.int64)
+        self.pulses_missed = np.zeros(n_chips, dtype=np.int64)
+        self.pulses_extra = np.zeros(n_chips, dtype=np.int64)
+
+    def enabled_mask(self, chipids):
+        '''Returns a mask of the enabled channels of each chip (from the channel mask)'''
+        mask = np.ones((len(chipids), self.shape[1]), dtype=bool)
+        for idx, chipid in enumerate(chipids):
+            if chipid in self.chip_conf:
+                channel_mask = getattr(self.chip_conf[chipid], 'channel_mask', [])
+                mask[idx,:len(channel_mask)] = np.array(channel_mask[:self.shape[1]]) == 0
+        return mask
+
+    def end_pulses(self, chipids):
+        '''Counts the triggers of the last pulse of each chip (if any)'''
+        chipids = np.asarray(chipids, dtype=np.int64)
+        chipids = chipids[self.pulse_dac[chipids] > 0]
+        if len(chipids) == 0:
+            return
+        hits = self.pulse_hits[chipids]
+        enabled = self.enabled_mask(chipids)
+        self.missed_triggers[chipids] += enabled & (hits == 0)
+        self.extra_triggers[chipids] += hits > 1
+        self.chip_pulses[chipids] += 1
+        n_hits = hits.sum(axis=1)
+        n_enabled = enabled.sum(axis=1)
+        self.pulses_missed[chipids] += n_hits < n_enabled
+        self.pulses_extra[chipids] += n_hits > n_enabled
+        self.pulse_hits[chipids] = 0
+        self.pulse_dac[chipids] = 0
+
+    def write(self, trans):
+        chipids = set()
+        for packet in trans['packets']:
+            if packet.packet_type == larpix.Packet.CONFIG_WRITE_PACKET and \
+                    packet.register_address == testpulse_dac_address and \
+                    packet.chipid < len(self.dac):
+                chipids.add(packet.chipid)
+        self.end_pulses(sorted(chipids))
+        TestpulseAccumulator.write(self, trans)
+
+    def read(self, trans, hits):
+        chipids = hits['chipid']
+        channelids = hits['channelid']
+        after_pulse = (channelids < self.shape[1]) & (self.pulse_dac[chipids] > 0)
+        if not np.any(after_pulse):
+            return
+        flat_idx = chipids[after_pulse] * self.shape[1] + channelids[after_pulse]
+        self.pulse_hits += np.bincount(flat_idx, minlength=self.pulse_hits.size).reshape(
+            self.shape)
+        cross_triggered = after_pulse & ~self.is_pulsed(hits)
+        self.adc_hist.fill(chipids[cross_triggered], channelids[cross_triggered],
+                           hits['adc'][cross_triggered])
+
+    def flush(self):
+        self.adc_hist.flush()
+
+    def finish(self):
+        self.end_pulses(np.arange(self.shape[0]))
+        self.flush()
+        TestpulseAccumulator.finish(self)
+
+    def merge(self, other):
+        TestpulseAccumulator.merge(self, other)
+        self.adc_hist.merge(other.adc_hist)
+        for name in ('missed_triggers', 'extra_triggers', 'chip_pulses', 'pulses_missed',
+                     'pulses_extra'):
+            getattr(self, name)[:] += getattr(other, name)
+
+def linear_fit(x, y, weights):
+    '''
+    Weighted least squares fit of ``y = slope * x + offset`` along the first axis of
+    ``y`` and ``weights`` (``x`` is broadcast against them), for all remaining indices at
+    once. Points with zero weight are ignored. Returns the slope, offset, number of
+    points and the weighted rms of the residuals (nan where fewer than two points).
+    '''
+    x = np.broadcast_to(np.asarray(x, dtype=float).reshape((-1,) + (1,) * (y.ndim-1)),
+                        y.shape)
+    weights = np.where(np.isfinite(y), weights, 0.)
+    y = np.where(weights > 0, y, 0.)
+    s = weights.sum(axis=0)
+    sx = (weights * x).sum(axis=0)
+    sy = (weights * y).sum(axis=0)
+    sxx = (weights * x**2).sum(axis=0)
+    sxy = (weights * x * y).sum(axis=0)
+    n_points = np.count_nonzero(weights > 0, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denominator = s * sxx - sx**2
+        slope = (s * sxy - sx * sy) / denominator
+        offset = (sy - slope * sx) / s
+        residual = np.sqrt((weights * (y - slope * x - offset)**2).sum(axis=0) / s)
+    bad = (n_points < 2) | ~(np.abs(denominator) > 0)
+    slope[bad] = np.nan
+    offset[bad] = np.nan
+    residual[bad] = np.nan
+    return slope, offset, n_points, residual
+
+def csa_gain_fit(accumulator, min_hits=1, max_adc=None):
+    '''
+    Fits the mean adc vs pulse size (DAC counts) of every channel, weighting each pulse
+    size by its number of hits. Pulse sizes with fewer than ``min_hits`` hits or a mean
+    adc above ``max_adc`` (saturation) are excluded. Returns a dict of
+    ``(n_chips, n_channels)`` arrays: ``slope`` (adc/DAC), ``offset`` (adc),
+    ``n_points``, ``residual`` (adc) and ``n_hits``.
+    '''
+    pulse_dacs, n, mean, rms = accumulator.response()
+    weights = np.where(n >= max(min_hits, 1), n, 0.)
+    if not max_adc is None:
+        weights[mean > max_adc] = 0.
+    slope, offset, n_points, residual = linear_fit(pulse_dacs, mean, weights)
+    return {
+        'slope': slope,
+        'offset': offset,
+        'n_points': n_points,
+        'residual': residual,
+        'n_hits': n.sum(axis=0)
+        }
+
+def longest_run(good):
+    '''
+    Returns the first and last index of the longest run of True values (-1, -1 if none)
+    '''
+    best = (-1, -1)
+    start = None
+    for idx, value in enumerate(list(good) + [False]):
+        if value and start is None:
+            start = idx
+        elif not value and not start is None:
+            if idx - start > best[1] - best[0] + 1 or best[0] < 0:
+                best = (start, idx - 1)
+            start = None
+    return best
+
+def testpulse_linearity(accumulator, min_hits=1, max_deviation=2.):
+    '''
+    Compares the response to the same pulse size for each DAC start value. For each
+    channel, the deviation of the mean adc at each DAC start value from the median over
+    all DAC start values is calculated, along with a linear fit of the mean adc vs DAC
+    start value (a linear DAC gives a slope and residual of 0). The deviation of a chip is
+    the median deviation of its channels, and DAC start values with a chip deviation
+    above ``max_deviation`` (adc) are flagged as non-linear. Returns a dict with:
+    ``dac_start`` (sorted DAC start values), ``deviation`` (``(n_dac_start, n_chips,
+    n_channels)`` adc), ``chip_deviation`` and ``nonlinear`` (``(n_dac_start,
+    n_chips)``), ``slope``, ``offset``, ``residual`` (``(n_chips, n_channels)``) and,
+    for each chip, the ``dac_max`` and ``dac_min`` of the longest linear range (-1 if
+    none) taking into account the largest pulse size.
+    '''
+    dac_start, n, mean, rms = accumulator.response()
+    mean = np.where(n >= max(min_hits, 1), mean, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # all-nan channels
+        deviation = mean - np.nanmedian(mean, axis=0)
+        chip_deviation = np.nanmedian(deviation, axis=2)
+    slope, offset, n_points, residual = linear_fit(dac_start, mean, np.isfinite(mean))
+    nonlinear = np.abs(chip_deviation) > max_deviation
+    pulse_dac = max(getattr(accumulator, 'pulse_dacs', [0]) or [0])
+    dac_max = np.full(accumulator.shape[0], -1, dtype=np.int64)
+    dac_min = np.full(accumulator.shape[0], -1, dtype=np.int64)
+    for chipid in np.nonzero(np.any(np.isfinite(chip_deviation), axis=0))[0]:
+        good = np.isfinite(chip_deviation[:,chipid]) & ~nonlinear[:,chipid]
+        first, last = longest_run(good)
+        if first < 0:
+            continue
+        dac_max[chipid] = dac_start[last]
+        dac_min[chipid] = max(dac_start[first] - pulse_dac, 0)
+    return {
+        'dac_start': dac_start,
+        'deviation': deviation,
+        'chip_deviation': chip_deviation,
+        'nonlinear': nonlinear,
+        'slope': slope,
+        'offset': offset,
+        'residual': residual,
+        'dac_max': dac_max,
+        'dac_min': dac_min
+        }
+
+def cross_trigger_noise(accumulator, adc_min=None, adc_max=None, min_hits=1):
+    '''
+    Calculates the pedestal mean and rms adc of each channel from the cross-triggered adc
+    distributions of a ``CrossTriggerAccumulator``, using only adc values within
+    [``adc_min``, ``adc_max``] (default: all). Returns a dict of ``(n_chips,
+    n_channels)`` arrays: ``n``, ``adc_mean``, ``adc_rms`` (nan with fewer than
+    ``min_hits`` hits), ``missed_triggers``, ``extra_triggers`` and, per chip,
+    ``n_pulses``, ``pulses_missed`` and ``pulses_extra``.
+    '''
+    counts = accumulator.adc_hist.counts
+    adc = accumulator.adc_hist.bins[:-1]
+    in_range = np.ones(len(adc), dtype=bool)
+    if not adc_min is None:
+        in_range &= adc >= adc_min
+    if not adc_max is None:
+        in_range &= adc <= adc_max
+    counts = counts[:,:,in_range]
+    adc = adc[in_range]
+    n = counts.sum(axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        adc_mean = counts.dot(adc) / n
+        adc_rms = np.sqrt(np.maximum(counts.dot(adc**2) / n - adc_mean**2, 0))
+    adc_mean[n < max(min_hits, 1)] = np.nan
+    adc_rms[n < max(min_hits, 1)] = np.nan
+    return {
+        'n': n,
+        'adc_mean': adc_mean,
+        'adc_rms': adc_rms,
+        'missed_triggers': accumulator.missed_triggers.copy(),
+        'extra_triggers': accumulator.extra_triggers.copy(),
+        'n_pulses': accumulator.chip_pulses.copy(),
+        'pulses_missed': accumulator.pulses_missed.copy(),
+        'pulses_extra': accumulator.pulses_extra.copy()
+        }
@@ -0,0 +1,75 @@
+'''
+This script produces quick-look pixel hit maps (hit count, mean raw ADC and hit rate per
+pixel) from one or more converted (dat2h5.py) h5 files. The maps are saved to a .npz
+file with the following arrays:
+
+    counts | mean_adc | rate (Hz) | x_centers | y_centers
+
+and images are indexed [iy, ix]. Use --plot to also save a .png (requires matplotlib).
+
+'''
+
+from __future__ import print_function
+import argparse
+import numpy as np
+from os.path import splitext
+import helpers.geometry as geometry
+from helpers.hit_maps import HitMap
+
+parser = argparse.ArgumentParser()
+parser.add_argument('infile', nargs='+', help='converted h5 files')
+parser.add_argument('-o', '--outfile', default=None,
+                    help='output .npz file (default: <first infile>_hitmap.npz)')
+parser.add_argument('-g', '--geometry', choices=geometry.geom_choices.keys(),
+                    required=True, help='The sensor & chip geometry layout')
+parser.add_argument('-t', '--run_time', default=None, type=float,
+                    help='run time used for the rate (s) (default: time between first '
+                    'and last hit)')
+parser.add_argument('--chunk_size', default=1000000, type=int,
+                    help='number of rows read at a time (default: %(default)s)')
+parser.add_argument('--plot', action='store_true', help='save maps as .png')
+parser.add_argument('-v', '--verbose', action='store_true')
+args = parser.parse_args()
+
+outfile = args.outfile
+if outfile is None:
+    outfile = splitext(args.infile[0])[0] + '_hitmap.npz'
+
+hit_map = HitMap(geometry.load_compiled_geometry(args.geometry, verbose=args.verbose))
+for infile in args.infile:
+    if args.verbose:
+        print('filling from %s' % infile)
+    hit_map.fill_file(infile, chunk_size=args.chunk_size)
+maps = {
+    'counts': hit_map.counts(),
+    'mean_adc': hit_map.mean_adc(),
+    'rate': hit_map.rate(args.run_time),
+    'x_centers': hit_map.x_centers,
+    'y_centers': hit_map.y_centers
+    }
+np.savez(outfile, **maps)
+if args.verbose:
+    print('%d hits, %d from unconnected channels' % (np.nansum(maps['counts']),
+                                                     hit_map.n_unconnected))
+    print('maps saved to %s' % outfile)
+
+if args.plot:
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    x, y = hit_map.x_centers, hit_map.y_centers
+    dx = (x[-1] - x[0]) / max(len(x) - 1, 1) / 2.
+    dy = (y[-1] - y[0]) / max(len(y) - 1, 1) / 2.
+    extent = (x[0] - dx, x[-1] + dx, y[0] - dy, y[-1] + dy)
+    fig, axes = plt.subplots(1, 3, figsize=(15, 4.5))
+    for ax, (name, label) in zip(axes, [('counts', 'hits'), ('mean_adc', 'mean ADC'),
+                                        ('rate', 'rate (Hz)')]):
+        image = ax.imshow(maps[name], origin='lower', extent=extent,
+                          interpolation='nearest')
+        ax.set_xlabel('x (mm)')
+        ax.set_ylabel('y (mm)')
+        fig.colorbar(image, ax=ax, label=label)
+    fig.tight_layout()
+    fig.savefig(splitext(outfile)[0] + '.png')
+    if args.verbose:
+        print('plot saved to %s' % (splitext(outfile)[0] + '.png'))
@@ -0,0 +1,62 @@
+'''
+This script lists the packets with bad parity in the read blocks of the datalog(s) to
+help diagnose link problems. The parity of all packets of a block is checked at once from
+their raw bits. The quarantine table is saved to a .npz file with one entry per bad
+packet in each of the following arrays:
+
+    file_index | block_index | position | word | packet_type | chipid | channelid
+
+where ``file_index`` indexes ``infiles``, ``position`` is the position of the packet in
+its block, ``word`` holds the raw bits of the packet (see ``packet_cache.packet_word``)
+and the packet type, chip id and channel id are decoded from the bad packet.
+
+'''
+
+from __future__ import print_function
+import argparse
+import numpy as np
+from os.path import splitext
+import larpix.larpix as larpix
+import helpers.calibration as calibration
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-i', '--infile', nargs='+', required=True,
+                    help='list of files to check')
+parser.add_argument('-o', '--outfile', default=None,
+                    help='output .npz file (default: <first infile>_quarantine.npz)')
+parser.add_argument('--cache', action='store_true',
+                    help='read decoded packets from the packet cache of each infile')
+parser.add_argument('-v', '--verbose', action='store_true',
+                    help='print every bad packet')
+args = parser.parse_args()
+
+outfile = args.outfile
+if outfile is None:
+    outfile = splitext(args.infile[0])[0] + '_quarantine.npz'
+
+tables = []
+for file_index, infile in enumerate(args.infile):
+    if args.verbose:
+        print('Checking %s' % infile)
+    accumulator = calibration.BadPacketAccumulator()
+    calibration.extract_calibration_data(infile, [accumulator], verbose=args.verbose,
+                                         use_cache=args.cache)
+    table = accumulator.table()
+    table['file_index'] = np.full(len(table['word']), file_index, dtype=np.int64)
+    tables.append(table)
+    print('%s: %d of %d packets with bad parity' % (infile, len(table['word']),
+                                                    accumulator.n_packets))
+    chipids, n_bad = np.unique(table['chipid'], return_counts=True)
+    for chipid, chip_bad in zip(chipids, n_bad):
+        print('  c%d (as decoded): %d' % (chipid, chip_bad))
+    if args.verbose:
+        for i in range(len(table['word'])):
+            print('  block %d, packet %d: %s (c%d-ch%d)' % (
+                    table['block_index'][i], table['position'][i],
+                    format(int(table['word'][i]), '0%db' % larpix.Packet.size),
+                    table['chipid'][i], table['channelid'][i]))
+
+quarantine = dict((name, np.concatenate([table[name] for table in tables]))
+                  for name in tables[0])
+np.savez(outfile, infiles=np.array(args.infile), **quarantine)
+print('quarantine table saved to %s' % outfile)
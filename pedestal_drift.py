@@ -0,0 +1,80 @@
+'''
+This script tracks the pedestal of each channel over time with a single pass over each
+data file. The adc distributions are filled in bins of block cpu time and the pedestal
+of every channel in every time bin is calculated at once. The drift table is saved to a
+.npz file with one entry per time bin and channel in each of the following arrays:
+
+    time_start | time_end | chipid | channelid | n | pedestal_adc | pedestal_adc_sigma |
+    drift_adc | pedestal_v | pedestal_v_sigma
+
+where ``drift_adc`` is the pedestal relative to the pedestal over the whole run(s) and the
+voltages are only included if --vref and --vcm are given.
+
+'''
+
+from __future__ import print_function
+import argparse
+import numpy as np
+from os.path import splitext
+import helpers.calibration as calibration
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-i', '--infile', nargs='+', required=True,
+                    help='list of files to process (combined into one drift table)')
+parser.add_argument('-o', '--outfile', default=None,
+                    help='output .npz file (default: <first infile>_drift.npz)')
+parser.add_argument('-t', '--time_bin', default=600., type=float,
+                    help='width of the time bins (s) (default: %(default)s)')
+parser.add_argument('--adc_step', default=calibration.pedestal_adc_step, type=int,
+                    help='bin width of the adc distributions (adc counts, default: '
+                    '%(default)s)')
+parser.add_argument('--min_entries', default=100, type=int,
+                    help='minimum number of hits per channel and time bin '
+                    '(default: %(default)s)')
+parser.add_argument('--pedestal_fit', default=None,
+                    choices=calibration.pedestal_fit_choices,
+                    help='take pedestals from gaussian fits')
+parser.add_argument('--robust', action='store_true',
+                    help='take pedestals from the median and median absolute deviation')
+parser.add_argument('--vref', type=float, default=None)
+parser.add_argument('--vcm', type=float, default=None)
+parser.add_argument('--cache', action='store_true',
+                    help='read decoded packets from the packet cache of each infile')
+parser.add_argument('-v', '--verbose', action='store_true')
+args = parser.parse_args()
+
+outfile = args.outfile
+if outfile is None:
+    outfile = splitext(args.infile[0])[0] + '_drift.npz'
+
+drift = None
+for infile in args.infile:
+    if args.verbose:
+        print('Extracting data from %s' % infile)
+    file_drift = calibration.PedestalDriftAccumulator(
+        time_bin_width=args.time_bin, adc_min=calibration.pedestal_adc_min,
+        adc_max=calibration.pedestal_adc_max, adc_step=args.adc_step)
+    calibration.extract_calibration_data(infile, [file_drift], verbose=args.verbose,
+                                         use_cache=args.cache)
+    file_drift.finish()
+    if drift is None:
+        drift = file_drift
+    else:
+        drift.merge(file_drift)
+
+drift_table = calibration.pedestal_drift(drift, vref=args.vref, vcm=args.vcm,
+                                         fit=args.pedestal_fit,
+                                         min_entries=args.min_entries,
+                                         robust=args.robust)
+np.savez(outfile, **drift_table)
+if args.verbose:
+    n_time_bins = len(np.unique(drift_table['time_start']))
+    print('%d channels in %d time bins of %gs' % (
+            len(np.unique(drift_table['chipid'] * 32 + drift_table['channelid'])),
+            n_time_bins, args.time_bin))
+    if len(drift_table['drift_adc']):
+        worst = np.nanargmax(np.abs(drift_table['drift_adc']))
+        print('largest drift: %.2f adc (c%d-ch%d)' % (drift_table['drift_adc'][worst],
+                                                      drift_table['chipid'][worst],
+                                                      drift_table['channelid'][worst]))
+    print('drift table saved to %s' % outfile)
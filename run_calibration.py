@@ -13,9 +13,19 @@ type. The output calibration data has the following structure:
         'pedestal_adc_sigma' : value,
         'pedestal_v' : value,
         'pedestal_v_sigma' : value,
+        'pedestal_fit_chi2_ndf' : value, (with --pedestal_fit)
+        'pedestal_fit_converged' : value, (with --pedestal_fit)
+        'pedestal_adc_median' : value, (with --robust)
+        'pedestal_adc_mad_sigma' : value, (with --robust)
+        'pedestal_tail_low' : value, (with --robust)
+        'pedestal_tail_high' : value, (with --robust)
+        'pedestal_adc_err' : value, (with --bootstrap, also for the other pedestal
+                                     values)
         'gain_v' : value,
         'gain_vcm' : value,
         'gain_e' : value,
+        'timing_offset_ns' : value,
+        'timing_ref_chipid' : value,
         ...
         },
         ...
@@ -25,128 +35,205 @@ type. The output calibration data has the following structure:
 ``
 Thus to extract a particular chip/channel's pedestal value use
 ``calibration_data[str(chipid)][str(channelid)]['pedestal_v']``.
+If the output file ends in .npz, the calibration is instead saved as dense arrays with
+provenance metadata (see ``helpers.calibration_store``).
+With ``--checkpoint``, the accumulated data of each infile is saved so that later runs
+(e.g. on a data file that is still being written) only process the new blocks.
 '''
 
 from __future__ import print_function
 import argparse
 from os.path import splitext
-from larpix.dataloader import DataLoader
-from larpix.larpix import Controller
 from sys import exit
+from functools import partial
+from multiprocessing import Pool
 import os
-import json
+import time
 import helpers.calibration as calibration
-parse = Controller.parse_input
+from helpers.calibration_store import CalibrationStore
 
-def update_cal_data(cal_data, new_cal_data):
-    if new_cal_data is None:
-        return
-    for chipid in new_cal_data:
-        for channelid in new_cal_data[chipid]:
-            for cal_field in new_cal_data[chipid][channelid]:
-                try:
-                    cal_data[chipid][channelid][cal_field] = \
-                        new_cal_data[chipid][channelid][cal_field]
-                except KeyError:
-                    try:
-                        cal_data[chipid][channelid] = \
-                            { cal_field: new_cal_data[chipid][channelid][cal_field] }
-                    except KeyError:
-                        cal_data[chipid] = \
-                            { channelid:
-                                  { cal_field: new_cal_data[chipid][channelid][cal_field] }}
+def write_cal_data(outfile, cal_store):
+    '''Updates (or creates) a .json or .npz calibration file with new calibration data'''
+    if os.path.isfile(outfile):
+        # File exists - load calibration data and update
+        prev_cal_store = CalibrationStore()
+        try:
+            prev_cal_store = CalibrationStore.load(outfile)
+        except (ValueError, IOError, OSError, KeyError) as e:
+            print('Error: %s' % e)
+            pass
+        prev_cal_store.update(cal_store)
+        prev_cal_store.save(outfile)
+    else:
+        # File does not exist - write calibration data
+        cal_store.save(outfile)
+
+def load_prev_cal_data(prev_calib, metadata, verbose=False):
+    cal_store = CalibrationStore(metadata=metadata)
+    if not prev_calib is None:
+        cal_store.update(CalibrationStore.load(prev_calib))
+        cal_store.metadata.update(metadata)
+        if verbose:
+            print('Using previous calibration %s' % prev_calib)
+    return cal_store
+
+def provenance(infiles, args):
+    return {
+        'script': 'run_calibration.py',
+        'created': time.time(),
+        'infiles': [os.path.abspath(infile) for infile in infiles],
+        'calibration_types': args.calibration,
+        'vref': args.vref,
+        'vcm': args.vcm,
+        'prev_calibration': args.prev_calibration
+        }
+
+def extract_file(job, **kwargs):
+    infile, file_state = job
+    return calibration.update_accumulators(infile, file_state=file_state, **kwargs)
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-i','--infile', nargs='+', required=True,
                     help='list of files to process')
 parser.add_argument('-o','--outfile', nargs='?', default=None,
-                    help='output file (if none specified saves to <infile>_calib.json for '
-                    'each infile)')
+                    help='output .json or .npz file, data from all infiles is combined '
+                    'into a single calibration (if none specified saves to '
+                    '<infile>_calib.json for each infile)')
+parser.add_argument('-j', '--jobs', default=1, type=int,
+                    help='number of input files to process in parallel '
+                    '(default: %(default)s)')
 parser.add_argument('-v', '--verbose', action='store_true')
 parser.add_argument('-f', '--force', action='store_true')
+parser.add_argument('--cache', action='store_true',
+                    help='read decoded packets from the packet cache of each infile '
+                    '(<infile>_packets/, created on first use)')
+parser.add_argument('--pedestal_fit', default=None,
+                    choices=calibration.pedestal_fit_choices,
+                    help='take pedestals from gaussian fits (optionally with a flat '
+                    'background) instead of the mean within the fwhm of the peak')
+parser.add_argument('--adc_step', default=calibration.pedestal_adc_step, type=int,
+                    help='bin width of the pedestal adc distributions (adc counts, '
+                    'default: %(default)s)')
+parser.add_argument('--sparse', action='store_true',
+                    help='only store the occupied pedestal adc bins (less memory for fine '
+                    'binning of many mostly quiet channels)')
+parser.add_argument('--robust', action='store_true',
+                    help='take pedestals from the median and median absolute deviation '
+                    'of the adc distributions and store the fraction of hits in the '
+                    'tails (use with --adc_step 1 to keep each adc value in its own bin)')
+parser.add_argument('--bootstrap', default=0, type=int,
+                    help='number of bootstrap replicas of the adc distributions used to '
+                    'estimate the uncertainties of the pedestal values (split across '
+                    '--jobs processes)')
+parser.add_argument('--max_idle_blocks', default=None, type=int,
+                    help='stop reading a file once this many blocks in a row had no new '
+                    'channels (only if gain is the only calibration)')
+parser.add_argument('--checkpoint', default=None,
+                    help='checkpoint file with the accumulated data of each infile, on '
+                    'later runs only data appended to the infiles is processed')
 parser.add_argument('-c', '--calibration', nargs='+', choices=['pedestal','gain','timing'],
         required=True)
-parser.add_argument('-p', '--prev_calibration', default=None)
+parser.add_argument('-p', '--prev_calibration', default=None,
+                    help='previous calibration .json or .npz file to update')
 parser.add_argument('--vref', type=float, required=False)
 parser.add_argument('--vcm', type=float, required=False)
-args = parser.parse_args()
-
-infiles = args.infile
-outfile = args.outfile
-prev_calib = args.prev_calibration
-verbose = args.verbose
-calibration_type = args.calibration
-force_overwrite = args.force
-vref = args.vref
-vcm = args.vcm
+def main():
+    args = parser.parse_args()
+    if args.adc_step < 1:
+        print('--adc_step must be at least 1')
+        exit(1)
+    if args.robust and not args.pedestal_fit is None:
+        print('--robust and --pedestal_fit cannot be combined')
+        exit(1)
 
-if not args.outfile is None and os.path.isfile(outfile) and not force_overwrite:
-    print('Calibration file already exists! Use -f to update.')
-    exit(1)
-if not args.outfile is None and args.verbose:
-    print(str(infiles) + ' -> ' + outfile)
+    infiles = args.infile
+    outfile = args.outfile
+    prev_calib = args.prev_calibration
+    verbose = args.verbose
+    calibration_type = args.calibration
+    force_overwrite = args.force
+    vref = args.vref
+    vcm = args.vcm
 
-for infile in infiles:
-    loader = DataLoader(infile)
+    if not args.outfile is None and os.path.isfile(outfile) and not force_overwrite:
+        print('Calibration file already exists! Use -f to update.')
+        exit(1)
+    if not args.outfile is None and args.verbose:
+        print(str(infiles) + ' -> ' + outfile)
 
-    cal_data = {}
-    if not prev_calib is None:
-        cal_data = json.load(open(prev_calib, 'r'))
-        if verbose:
-            print('Using previous calibration %s' % prev_calib)
+    checkpoint = None
+    file_states = [None] * len(infiles)
+    if not args.checkpoint is None:
+        checkpoint = calibration.load_checkpoint(args.checkpoint)
+        file_states = [checkpoint['files'].get(os.path.abspath(infile))
+                       for infile in infiles]
 
-    if args.outfile is None:
-        outfile = splitext(infile)[0] + '_calib.json'
-        if verbose:
-            print(infile + ' -> ' + outfile)
+    extract = partial(extract_file, calibration_types=calibration_type, vref=vref,
+                      vcm=vcm, verbose=verbose, use_cache=args.cache,
+                      max_idle_blocks=args.max_idle_blocks, adc_step=args.adc_step,
+                      sparse=args.sparse)
+    pool = None
+    file_results = map(extract, zip(infiles, file_states))
+    if args.jobs > 1:
+        pool = Pool(args.jobs)
+        file_results = pool.imap(extract, zip(infiles, file_states))
 
-    if 'pedestal' in calibration_type:
-        if verbose:
-            print('Performing pedestal calibration...')
-        new_cal_data = calibration.do_pedestal_calibration(infile, vref=vref, vcm=vcm,
-                                                           verbose=verbose)
-        update_cal_data(cal_data, new_cal_data)
-    if 'gain' in calibration_type:
-        if verbose:
-            print('Performing gain calibration...')
-        new_cal_data = calibration.do_gain_calibration(infile, vref=vref, vcm=vcm,
-                                                       verbose=verbose)
-        update_cal_data(cal_data, new_cal_data)
-    if 'timing' in calibration_type:
-        if verbose:
-            print('Performing timing calibration...')
-        new_cal_data = calibration.do_timing_calibration(infile, verbose=verbose)
-        update_cal_data(cal_data, new_cal_data)
+    def file_accumulators():
+        '''Yields the accumulators of each infile, updating the checkpoint'''
+        for infile, (accumulators, file_state) in zip(infiles, file_results):
+            if not checkpoint is None:
+                checkpoint['files'][os.path.abspath(infile)] = file_state
+            yield infile, accumulators
 
-    if os.path.isfile(outfile):
-        # File exists - load calibration data and update
-        prev_cal_data = {}
-        try:
-            prev_cal_data = json.load(open(outfile, 'r'))
-        except ValueError as e:
-            print('Error: %s' % e)
-            pass
-        for chipid in cal_data:
-            for channelid in cal_data[chipid]:
-                if chipid in prev_cal_data and channelid in prev_cal_data[chipid]:
-                    # Previous data exists - update
-                    for cal_field in cal_data[chipid][channelid]:
-                        prev_cal_data[chipid][channelid][cal_field] = \
-                            cal_data[chipid][channelid][cal_field]
-                else:
-                    # Previous data does not exist
-                    try:
-                        prev_cal_data[chipid][channelid] = cal_data[chipid][channelid]
-                    except KeyError:
-                        prev_cal_data[chipid] = {channelid : cal_data[chipid][channelid]}
-        #fill_missing_with_default(prev_cal_data)
-        with open(outfile, 'w') as fo:
-            json.dump(prev_cal_data, fo, sort_keys=True, indent=4, separators=(',',': '))
-    else:
-        # File does not exist - write calibration data
-        #fill_missing_with_default(cal_data)
-        with open(outfile, 'w') as fo:
-            # File exisits
-            json.dump(cal_data, fo, sort_keys=True, indent=4, separators=(',',': '))
+    if verbose:
+        print('Performing %s calibration...' % ', '.join(calibration_type))
+    try:
+        if args.outfile is None:
+            # Separate calibration for each file
+            for infile, accumulators in file_accumulators():
+                outfile = splitext(infile)[0] + '_calib.json'
+                if verbose:
+                    print(infile + ' -> ' + outfile)
+                cal_store = load_prev_cal_data(prev_calib, provenance([infile], args),
+                                               verbose=verbose)
+                for new_cal_data in calibration.finish_calibrations(
+                    accumulators, calibration_type, vref=vref, vcm=vcm, verbose=verbose,
+                    pedestal_fit=args.pedestal_fit, pedestal_robust=args.robust,
+                    pedestal_bootstrap=args.bootstrap,
+                    jobs=args.jobs):
+                    cal_store.update_dict(new_cal_data)
+                write_cal_data(outfile, cal_store)
+        else:
+            # Combine data from all files into one calibration
+            accumulators = {}
+            for infile, new_accumulators in file_accumulators():
+                if verbose:
+                    print('Merging data from %s' % infile)
+                calibration.merge_accumulators(accumulators, new_accumulators)
+            cal_store = load_prev_cal_data(prev_calib, provenance(infiles, args),
+                                           verbose=verbose)
+            for new_cal_data in calibration.finish_calibrations(
+                accumulators, calibration_type, vref=vref, vcm=vcm, verbose=verbose,
+                pedestal_fit=args.pedestal_fit, pedestal_robust=args.robust,
+                pedestal_bootstrap=args.bootstrap,
+                jobs=args.jobs):
+                cal_store.update_dict(new_cal_data)
+            write_cal_data(outfile, cal_store)
+        if not checkpoint is None:
+            calibration.save_checkpoint(args.checkpoint, checkpoint)
+            if verbose:
+                print('Checkpoint saved to %s' % args.checkpoint)
+    except:
+        if not pool is None:
+            pool.terminate()
+            pool.join()
+            pool = None
+        raise
+    finally:
+        if not pool is None:
+            pool.close()
+            pool.join()
 
-exit(0)
+if __name__ == '__main__':
+    main()
+    exit(0)
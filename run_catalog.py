@@ -0,0 +1,83 @@
+'''
+This script maintains and queries a SQLite catalog of the runs stored in the data
+directories. The first update scans the full directory tree, later updates only re-read
+new or modified script logs and data logs. For example, to find all collect_data runs on
+pcb-10 from the last week:
+``
+python run_catalog.py --update --script collect_data --board pcb-10 --since 7d
+``
+'''
+
+from __future__ import print_function
+import argparse
+import json
+import time
+from sys import exit
+import helpers.pathnames as pathnames
+import helpers.run_catalog as run_catalog
+
+def parse_time(value):
+    '''
+    Converts a relative time (``<n>d``, ``<n>h``, ``<n>m``), a date (``YYYY_MM_DD``) or a
+    unix time into a unix time
+    '''
+    units = {'d': 86400., 'h': 3600., 'm': 60.}
+    if value[-1] in units:
+        return time.time() - float(value[:-1]) * units[value[-1]]
+    try:
+        return float(value)
+    except ValueError:
+        return time.mktime(time.strptime(value, '%Y_%m_%d'))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-d', '--datadir', nargs='+', default=['data/'],
+                    help='data directories to scan (default: %(default)s)')
+parser.add_argument('--catalog', default=pathnames.default_catalog_file(),
+                    help='catalog file (default: %(default)s)')
+parser.add_argument('-u', '--update', action='store_true',
+                    help='scan data directories for new or modified runs before querying')
+parser.add_argument('--no_count', action='store_true',
+                    help='do not count packets in new data log files')
+parser.add_argument('-s', '--script', default=None, help='select runs of this script')
+parser.add_argument('-b', '--board', default=None, help='select runs on this board')
+parser.add_argument('-c', '--chip', default=None, type=int,
+                    help='select runs that include this chip')
+parser.add_argument('--since', default=None, type=parse_time,
+                    help='select runs started after this time (<n>d, <n>h, <n>m, '
+                    'YYYY_MM_DD or unix time)')
+parser.add_argument('--until', default=None, type=parse_time,
+                    help='select runs started before this time')
+parser.add_argument('--datalog', default=None,
+                    help='select runs whose data log path contains this string')
+parser.add_argument('--json', action='store_true', help='print matching runs as json')
+parser.add_argument('-v', '--verbose', action='store_true')
+args = parser.parse_args()
+
+db = run_catalog.open_catalog(args.catalog)
+if args.update:
+    n_updated = run_catalog.update_catalog(db, args.datadir, count=not args.no_count,
+                                           verbose=args.verbose)
+    if args.verbose:
+        print('%d runs added or updated' % n_updated)
+
+runs = run_catalog.query_runs(db, script=args.script, board=args.board, chip=args.chip,
+                              since=args.since, until=args.until,
+                              data_logfile=args.datalog)
+if args.json:
+    print(json.dumps(runs, sort_keys=True, indent=4, separators=(',',': ')))
+else:
+    for run in runs:
+        start = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['start_time'])) \
+            if not run['start_time'] is None else '?'
+        duration = run['end_time'] - run['start_time'] \
+            if not run['start_time'] is None else 0
+        print('%s %-35s %-8s %8.1fs %10s pkts %s' % (
+                start, run['script'], run['board'], duration,
+                run['n_packets'] if not run['n_packets'] is None else '?',
+                run['data_logfile']))
+        if args.verbose:
+            print('    script log: %s' % run['script_logfile'])
+            print('    chips: %s' % run['chips'])
+            print('    converted: %s' % ', '.join(run['converted']))
+db.close()
+exit(0)